@@ -0,0 +1,106 @@
+import json
+import os
+import time
+
+
+def enable_download_events(chrome_options):
+    """
+    Turns on Chrome's performance log, which carries the DevTools download events.
+    Call on the Options before starting the driver.
+    """
+    chrome_options.set_capability('goog:loggingPrefs', {'performance': 'ALL'})
+
+
+def set_download_dir(driver, download_dir):
+    """
+    Sends downloads to download_dir with download events enabled, and drops any events
+    still buffered from earlier pages.
+    """
+    driver.execute_cdp_cmd('Browser.setDownloadBehavior', {
+        'behavior': 'allow',
+        'downloadPath': os.path.abspath(download_dir),
+        'eventsEnabled': True
+    })
+    drain_events(driver)
+
+
+def drain_events(driver):
+    try:
+        driver.get_log('performance')
+    except Exception:
+        # Performance logging not enabled on this driver
+        pass
+
+
+def _download_events(driver):
+    try:
+        entries = driver.get_log('performance')
+    except Exception:
+        return
+    for entry in entries:
+        message = json.loads(entry['message']).get('message', {})
+        method = message.get('method', '')
+        if method.endswith('.downloadWillBegin') or method.endswith('.downloadProgress'):
+            yield method.split('.')[-1], message.get('params', {})
+
+
+def _finished_files(download_dir, ignore):
+    return [
+        name for name in os.listdir(download_dir)
+        if name not in ignore and not name.endswith('.crdownload')
+    ]
+
+
+def wait_for_download(driver, download_dir, timeout=30, ignore=(), poll_interval=0.1):
+    """
+    Waits for the download started by the last action and returns its path, or None if it
+    was canceled or didn't finish within timeout.
+
+    Completion comes from the DevTools downloadWillBegin/downloadProgress events, so this
+    returns as soon as the transfer ends. If the driver doesn't deliver the events, a
+    finished file appearing in download_dir also counts. Files named in ignore (present
+    before the download started) are never returned.
+    """
+    ignore = set(ignore)
+    deadline = time.monotonic() + timeout
+    guid = None
+    filename = None
+    while time.monotonic() < deadline:
+        for event, params in _download_events(driver):
+            if event == 'downloadWillBegin':
+                guid = params.get('guid')
+                filename = params.get('suggestedFilename')
+            elif guid and params.get('guid') == guid:
+                if params.get('state') == 'canceled':
+                    return None
+                if params.get('state') == 'completed':
+                    return _completed_path(download_dir, params.get('filePath'), filename, ignore, deadline)
+        finished = _finished_files(download_dir, ignore)
+        if finished and not any(name.endswith('.crdownload') for name in os.listdir(download_dir)):
+            return os.path.join(download_dir, finished[0])
+        time.sleep(poll_interval)
+    return None
+
+
+def _completed_path(download_dir, file_path, filename, ignore, deadline):
+    # Newer Chromes report the final path; otherwise look for the suggested name, which
+    # Chrome may have suffixed to avoid a clash
+    if file_path and os.path.exists(file_path):
+        return file_path
+    while time.monotonic() < deadline:
+        if filename and os.path.exists(os.path.join(download_dir, filename)):
+            return os.path.join(download_dir, filename)
+        finished = _finished_files(download_dir, ignore)
+        if finished:
+            return os.path.join(download_dir, finished[0])
+        time.sleep(0.05)
+    return None
+
+
+def read_download(driver, download_dir, timeout=30, ignore=()):
+    """Like wait_for_download, but returns the downloaded bytes."""
+    path = wait_for_download(driver, download_dir, timeout=timeout, ignore=ignore)
+    if not path:
+        return None
+    with open(path, 'rb') as f:
+        return f.read()
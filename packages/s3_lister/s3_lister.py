@@ -0,0 +1,166 @@
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+_DONE = object()
+
+
+class _ListingError:
+    def __init__(self, exception: Exception) -> None:
+        self.exception = exception
+
+
+class S3PrefixLister:
+    """
+    Lists an S3 bucket by fanning out over its top-level prefixes.
+
+    The prefixes directly under the requested prefix (jurisdiction or job folders) are
+    discovered with a Delimiter listing and then listed concurrently. Objects are streamed
+    back through a generator as pages arrive, with key filters applied by the workers.
+    Objects come back grouped by prefix in no particular order; sort them if order matters.
+    """
+
+    def __init__(self,
+                 s3_client,
+                 max_workers: int = 16,
+                 delimiter: str = '/',
+                 max_depth: int = 3,
+                 queue_size: int = 10000,
+                 logger: Optional[logging.Logger] = None) -> None:
+        """
+        Initialize the S3PrefixLister.
+
+        :param s3_client: boto3 S3 client, shared by all listing threads. Give it a
+            connection pool at least max_workers wide.
+        :param max_workers: Number of prefixes listed at once.
+        :param delimiter: Delimiter used to discover prefixes.
+        :param max_depth: How many levels to descend while there is only a single prefix.
+        :param queue_size: Objects buffered between the listing threads and the consumer.
+        :param logger: Optional logger instance. If None, a default logger is used.
+        """
+        self.s3 = s3_client
+        self.max_workers = max_workers
+        self.delimiter = delimiter
+        self.max_depth = max_depth
+        self.queue_size = queue_size
+        self.logger = logger or logging.getLogger(self.__class__.__name__)
+
+    def discover_prefixes(self, bucket_name: str, prefix: str = '') -> Tuple[List[str], List[dict]]:
+        """
+        Find the prefixes to list in parallel.
+
+        Descends while a level has a single prefix and no objects, so a folder such as
+        'Colorado' fans out over its subfolders instead of being listed by one thread.
+
+        :return: The prefixes to list, and the objects found above them.
+        """
+        prefixes = [prefix]
+        root_objects = []
+        for _ in range(self.max_depth):
+            level_prefixes, level_objects = self._list_level(bucket_name, prefixes[0])
+            root_objects.extend(level_objects)
+            if not level_prefixes:
+                return [], root_objects
+            prefixes = level_prefixes
+            if len(prefixes) > 1 or level_objects:
+                break
+        return prefixes, root_objects
+
+    def _list_level(self, bucket_name: str, prefix: str) -> Tuple[List[str], List[dict]]:
+        paginator = self.s3.get_paginator('list_objects_v2')
+        prefixes = []
+        objects = []
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix, Delimiter=self.delimiter):
+            prefixes.extend(p['Prefix'] for p in page.get('CommonPrefixes', []))
+            objects.extend(page.get('Contents', []))
+        return prefixes, objects
+
+    def iter_objects(self,
+                     bucket_name: str,
+                     prefix: str = '',
+                     suffixes: Optional[Iterable[str]] = None,
+                     exclude_suffixes: Optional[Iterable[str]] = None,
+                     key_filter: Optional[Callable[[str], bool]] = None) -> Iterator[dict]:
+        """
+        Stream the objects under a prefix, as returned in list_objects_v2 'Contents'.
+
+        :param bucket_name: Name of the S3 bucket.
+        :param prefix: Only list keys under this prefix.
+        :param suffixes: Only yield keys ending with one of these suffixes.
+        :param exclude_suffixes: Skip keys ending with one of these suffixes.
+        :param key_filter: Only yield keys for which this returns True.
+        """
+        matches = self._build_filter(suffixes, exclude_suffixes, key_filter)
+        prefixes, root_objects = self.discover_prefixes(bucket_name, prefix)
+        self.logger.info(f"Listing s3://{bucket_name}/{prefix} across {len(prefixes)} prefixes")
+
+        for obj in root_objects:
+            if matches(obj['Key']):
+                yield obj
+        if not prefixes:
+            return
+
+        results = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+
+        def put(item) -> bool:
+            # Give up if the consumer has stopped reading
+            while not stop.is_set():
+                try:
+                    results.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def list_prefix(listing_prefix: str) -> None:
+            try:
+                paginator = self.s3.get_paginator('list_objects_v2')
+                for page in paginator.paginate(Bucket=bucket_name, Prefix=listing_prefix):
+                    for obj in page.get('Contents', []):
+                        if matches(obj['Key']) and not put(obj):
+                            return
+            except Exception as e:
+                put(_ListingError(e))
+            finally:
+                put(_DONE)
+
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            for listing_prefix in prefixes:
+                executor.submit(list_prefix, listing_prefix)
+            remaining = len(prefixes)
+            while remaining:
+                item = results.get()
+                if item is _DONE:
+                    remaining -= 1
+                elif isinstance(item, _ListingError):
+                    raise item.exception
+                else:
+                    yield item
+        finally:
+            stop.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def iter_keys(self, bucket_name: str, prefix: str = '', **filters) -> Iterator[str]:
+        """
+        Stream the keys under a prefix. Accepts the same filters as iter_objects.
+        """
+        for obj in self.iter_objects(bucket_name, prefix, **filters):
+            yield obj['Key']
+
+    @staticmethod
+    def _build_filter(suffixes, exclude_suffixes, key_filter) -> Callable[[str], bool]:
+        suffixes = tuple(suffixes) if suffixes else None
+        exclude_suffixes = tuple(exclude_suffixes) if exclude_suffixes else None
+
+        def matches(key: str) -> bool:
+            if suffixes and not key.endswith(suffixes):
+                return False
+            if exclude_suffixes and key.endswith(exclude_suffixes):
+                return False
+            return key_filter is None or key_filter(key)
+
+        return matches
@@ -0,0 +1,69 @@
+import hashlib
+import os
+import tempfile
+from io import BytesIO
+
+MB = 1024 * 1024
+# Enough of a file for libmagic to recognise PDFs, Office documents and archives
+SNIFF_BYTES = 8192
+
+
+class BodySpool:
+    """
+    A write-only buffer for a document body that moves to a temp file once it grows past
+    threshold bytes, so large bodies are never held in memory whole.
+    """
+    def __init__(self, threshold, spool_dir=None):
+        self.threshold = threshold
+        self.spool_dir = spool_dir
+        self.buffer = BytesIO()
+        self.file = None
+        self.path = None
+
+    def write(self, data):
+        if self.file is None and self.buffer.tell() + len(data) > self.threshold:
+            fd, self.path = tempfile.mkstemp(prefix='body-', dir=self.spool_dir)
+            self.file = os.fdopen(fd, 'wb')
+            self.file.write(self.buffer.getvalue())
+            self.buffer = BytesIO()
+        (self.file or self.buffer).write(data)
+        return len(data)
+
+    def truncate(self, size=0):
+        # Only ever used to drop a body that went over the download size limit
+        self.discard()
+        self.buffer = BytesIO()
+
+    def discard(self):
+        if self.file is not None:
+            self.file.close()
+            remove_spooled(self.path)
+            self.file = None
+            self.path = None
+
+    def finish(self):
+        """Returns (body, None) for a body kept in memory, or (b'', path) for a spooled one."""
+        if self.file is None:
+            return self.buffer.getvalue(), None
+        self.file.close()
+        return b'', self.path
+
+
+def read_head(path, size=SNIFF_BYTES):
+    with open(path, 'rb') as f:
+        return f.read(size)
+
+
+def sha256_file(path, chunk_size=MB):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def remove_spooled(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,159 @@
+import json
+import logging
+import threading
+from datetime import datetime, timezone
+
+from botocore.exceptions import ClientError
+
+
+class S3JsonState:
+    """
+    A dict kept as a single JSON object in S3, loaded at the start of a crawl and saved at the end.
+    Safe to update from the upload threads. Saving merges this crawl's changes into the
+    latest saved copy, so workers crawling the same job don't drop each other's entries.
+    """
+    def __init__(self, s3_client, bucket_name, key, logger=None):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.key = key
+        self.logger = logger or logging.getLogger(self.__class__.__name__)
+        self.lock = threading.Lock()
+        self.entries = {}
+        # name -> value set by this crawl (None for removed)
+        self.changes = {}
+
+    def _read(self):
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket_name, Key=self.key)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+                return None
+            raise
+        return json.loads(response['Body'].read()).get('entries', {})
+
+    def load(self):
+        entries = self._read()
+        if entries is None:
+            self.logger.info(f"No crawl state at '{self.bucket_name}/{self.key}', starting empty")
+            return self
+        self.entries = entries
+        self.logger.info(f"Loaded {len(self.entries)} entries from '{self.bucket_name}/{self.key}'")
+        return self
+
+    def save(self):
+        with self.lock:
+            changes = dict(self.changes)
+            self.changes = {}
+        if not changes:
+            return
+        entries = self._read() or {}
+        for name, value in changes.items():
+            if value is None:
+                entries.pop(name, None)
+            else:
+                entries[name] = value
+        body = json.dumps({
+            'updated': datetime.now(timezone.utc).isoformat(),
+            'entries': entries
+        }, indent=2)
+        self.s3_client.put_object(Bucket=self.bucket_name, Key=self.key, Body=body)
+        self.logger.info(f"Saved {len(changes)} changes, {len(entries)} entries to '{self.bucket_name}/{self.key}'")
+
+    def get(self, name):
+        with self.lock:
+            return self.entries.get(name)
+
+    def set(self, name, value):
+        with self.lock:
+            self.entries[name] = value
+            self.changes[name] = value
+
+
+class ValidatorStore(S3JsonState):
+    """
+    HTTP validators per source URL: the ETag and Last-Modified the server sent, the hash
+    of the content and the S3 key it was stored under. Google Drive files are kept by
+    file ID instead, with the modifiedTime Drive reported.
+    """
+    def __init__(self, s3_client, bucket_name, key='crawl_state/validators.json', logger=None):
+        super().__init__(s3_client, bucket_name, key, logger)
+
+    def conditional_headers(self, url):
+        """Headers that let the server answer 304 if the URL hasn't changed since it was stored."""
+        entry = self.get(url)
+        if not entry or not entry.get('s3_key'):
+            return {}
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def record(self, url, s3_key, content_hash, etag=None, last_modified=None):
+        self.set(url, {
+            'etag': etag,
+            'last_modified': last_modified,
+            'content_hash': content_hash,
+            's3_key': s3_key
+        })
+
+    def unchanged_drive_file(self, file_id, modified_time):
+        """The S3 key a Drive file was stored under, if it hasn't been modified since."""
+        entry = self.get(drive_file_name(file_id))
+        if not entry or not entry.get('s3_key') or not modified_time:
+            return None
+        return entry['s3_key'] if entry.get('modified_time') == modified_time else None
+
+    def record_drive_file(self, file_id, s3_key, content_hash, modified_time):
+        self.set(drive_file_name(file_id), {
+            'modified_time': modified_time,
+            'content_hash': content_hash,
+            's3_key': s3_key
+        })
+
+
+def drive_file_name(file_id):
+    # Kept apart from the URL entries, which Drive file IDs could never collide with
+    return f"gdrive:{file_id}"
+
+
+class ContentIndex(S3JsonState):
+    """
+    sha256 of a document's content -> the S3 key it was first stored under.
+    An upload in progress is only pending; other items see its key once it completes.
+    """
+    def __init__(self, s3_client, bucket_name, key='crawl_state/content_index.json', logger=None):
+        super().__init__(s3_client, bucket_name, key, logger)
+        # sha256 -> key of the upload in progress
+        self.pending = {}
+
+    def claim(self, content_hash, key):
+        """
+        Claims the upload of this content for key. Returns (existing_key, pending_key):
+        the key already holding the content, or the key of another upload of it still in
+        progress, or (None, None) if the claim succeeded. Claiming is atomic, so two items
+        with the same content don't both upload it.
+        """
+        with self.lock:
+            existing = self.entries.get(content_hash)
+            if existing:
+                return existing, None
+            if content_hash in self.pending:
+                return None, self.pending[content_hash]
+            self.pending[content_hash] = key
+            return None, None
+
+    def complete(self, content_hash, key):
+        """Makes a claimed upload visible once the content is stored."""
+        with self.lock:
+            if self.pending.get(content_hash) == key:
+                del self.pending[content_hash]
+            self.entries[content_hash] = key
+            self.changes[content_hash] = key
+
+    def release(self, content_hash, key):
+        """Forgets a claim whose upload failed."""
+        with self.lock:
+            if self.pending.get(content_hash) == key:
+                del self.pending[content_hash]
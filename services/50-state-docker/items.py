@@ -4,6 +4,8 @@ class PageContentItem(scrapy.Item):
     source_url = scrapy.Field()
     pi_url = scrapy.Field()
     content = scrapy.Field()
+    # Set instead of content for bodies spooled to a temp file; the upload pipeline removes it
+    content_path = scrapy.Field()
     title = scrapy.Field()
     description = scrapy.Field()
     jurisdiction = scrapy.Field()
@@ -11,3 +13,16 @@ class PageContentItem(scrapy.Item):
     tombstone = scrapy.Field()
     language = scrapy.Field()
     mime_type = scrapy.Field()
+    # Set for pages crawled over HTTP; the conditional request headers for the next crawl
+    sheet_url = scrapy.Field()
+    etag = scrapy.Field()
+    last_modified = scrapy.Field()
+    # Set for Google Drive files; the modifiedTime skips the download next crawl if it still matches
+    drive_file_id = scrapy.Field()
+    modified_time = scrapy.Field()
+    # The server answered 304: content is empty and existing_key is where it was stored
+    unchanged = scrapy.Field()
+    existing_key = scrapy.Field()
+    # Work queue task (or, crawling standalone, sheet URL) the item came from; the task
+    # is finished once every one of its items is stored
+    task_id = scrapy.Field()
@@ -0,0 +1,93 @@
+from urllib.parse import urlparse
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.common.by import By
+from selenium.common.exceptions import NoSuchElementException
+
+# Cookie fields Scrapy understands
+COOKIE_FIELDS = ('name', 'value', 'domain', 'path', 'secure')
+
+
+def query_params(url):
+    # Raw (still percent-encoded) query values, so they match the document URL as written
+    return [
+        tuple(param.split('=', 1)) for param in urlparse(url).query.split('&') if '=' in param
+    ]
+
+
+def document_url_template(page_url, document_url):
+    """
+    Turns the document URL found on one OnBase viewer page into a template for every page
+    on the host, by replacing the values of the page's query parameters (docid, chksum, ...)
+    with '{name}' placeholders. Returns None if no parameter shows up in the document URL.
+    """
+    template = document_url
+    names = []
+    # Longest first, so a value that contains another is replaced whole
+    for name, value in sorted(query_params(page_url), key=lambda param: len(param[1]), reverse=True):
+        # Short values like 'en' or '1' could match anywhere in the URL
+        if len(value) < 3 or value not in template:
+            continue
+        template = template.replace(value, '{' + name + '}')
+        names.append(name)
+    return (template, names) if names else None
+
+
+class OnBaseSession:
+    """
+    What a browser learned on an OnBase (hylandcloud) host: the URL template for fetching
+    a document directly, and the cookies and user agent the host expects with it.
+    """
+    def __init__(self, template, names, cookies, user_agent):
+        self.template = template
+        self.names = names
+        self.cookies = cookies
+        self.user_agent = user_agent
+
+    def document_url(self, page_url):
+        """The direct URL of the document behind a viewer page, or None if it can't be built."""
+        params = dict(query_params(page_url))
+        if not all(params.get(name) for name in self.names):
+            return None
+        url = self.template
+        for name in self.names:
+            url = url.replace('{' + name + '}', params[name])
+        return url
+
+
+def learn_onbase_session(driver, url, timeout=15):
+    """
+    Opens an OnBase viewer page in the browser and returns the OnBaseSession for its host.
+    Raises if the page has no direct document link to learn from.
+    """
+    driver.get(url)
+    WebDriverWait(driver, timeout).until(
+        EC.presence_of_element_located((By.ID, "DocSelectPage"))
+    )
+    driver.switch_to.frame("DocSelectPage")
+    WebDriverWait(driver, timeout).until(
+        EC.presence_of_element_located((By.ID, "pdfViewerContainer"))
+    )
+    viewer_src = driver.find_element(By.ID, "pdfViewerContainer").get_attribute('src')
+    driver.switch_to.frame("pdfViewerContainer")
+    # The viewer's download link is the document itself; the viewer frame is the next best guess
+    document_url = None
+    try:
+        anchor = driver.find_element(By.ID, "main-content").find_element(By.TAG_NAME, "a")
+        document_url = anchor.get_attribute('href')
+    except NoSuchElementException:
+        pass
+    if not document_url or not document_url.startswith('http'):
+        document_url = viewer_src
+    driver.switch_to.default_content()
+
+    learned = document_url and document_url_template(url, document_url)
+    if not learned:
+        raise ValueError(f"No document URL to learn from on {url} (found {document_url})")
+    template, names = learned
+    cookies = [
+        {field: cookie[field] for field in COOKIE_FIELDS if field in cookie}
+        for cookie in driver.get_cookies()
+    ]
+    user_agent = driver.execute_script('return navigator.userAgent')
+    return OnBaseSession(template, names, cookies, user_agent)
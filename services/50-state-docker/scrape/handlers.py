@@ -0,0 +1,145 @@
+import logging
+import shutil
+import tempfile
+
+import scrapy
+from scrapy.core.downloader.handlers import http11
+from scrapy.core.downloader.handlers.http11 import HTTP11DownloadHandler, ScrapyAgent
+
+from body_spool import MB, BodySpool, remove_spooled
+
+# request.meta key holding the temp file of a spooled response body
+SPOOLED_BODY = 'spooled_body'
+
+
+class SpoolingHTTPDownloadHandler(HTTP11DownloadHandler):
+    """
+    The HTTP/HTTPS download handler, except that a body larger than DOWNLOAD_SPOOL_THRESHOLD
+    bytes is written to a temp file as it arrives. Such a response has an empty body and
+    the file's path in request.meta['spooled_body']; whoever consumes it removes the file.
+    Anything left over is removed when the crawl ends.
+
+    Compressed bodies are always read into memory, since they are decoded there.
+    Set request.meta['spool_body'] = False to keep a response in memory.
+    """
+    def __init__(self, settings, crawler=None):
+        super().__init__(settings, crawler)
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.spool_threshold = settings.getint('DOWNLOAD_SPOOL_THRESHOLD', 8 * MB)
+        if self.spool_threshold:
+            check_scrapy_internals()
+        # One directory per crawl, shared by the http and https handlers and by the spider's
+        # Google Drive downloads; the handler that created it removes it
+        self.owns_spool_dir = getattr(crawler, 'spool_dir', None) is None
+        if self.owns_spool_dir:
+            self.spool_dir = tempfile.mkdtemp(prefix='scrapy-spool-', dir=settings.get('DOWNLOAD_SPOOL_DIR'))
+            if crawler is not None:
+                crawler.spool_dir = self.spool_dir
+        else:
+            self.spool_dir = crawler.spool_dir
+
+    def download_request(self, request, spider):
+        # Left over from an earlier download of the same request, e.g. a retry; the
+        # response that carried it was dropped
+        stale_path = request.meta.pop(SPOOLED_BODY, None)
+        if stale_path:
+            remove_spooled(stale_path)
+        if not self.spool_threshold or not request.meta.get('spool_body', True):
+            return super().download_request(request, spider)
+        agent = SpoolingAgent(
+            spool_threshold=self.spool_threshold,
+            spool_dir=self.spool_dir,
+            contextFactory=self._contextFactory,
+            pool=self._pool,
+            maxsize=getattr(spider, "download_maxsize", self._default_maxsize),
+            warnsize=getattr(spider, "download_warnsize", self._default_warnsize),
+            fail_on_dataloss=self._fail_on_dataloss,
+            crawler=self._crawler,
+        )
+        deferred = agent.download_request(request)
+        deferred.addErrback(self._remove_spooled_body, request)
+        return deferred
+
+    def _remove_spooled_body(self, failure, request):
+        # The body was spooled but the download still failed, e.g. it timed out afterwards
+        path = request.meta.pop(SPOOLED_BODY, None)
+        if path:
+            remove_spooled(path)
+        return failure
+
+    def close(self):
+        # Runs after the item pipelines are done with every response
+        deferred = super().close()
+        deferred.addBoth(self._remove_spool_dir)
+        return deferred
+
+    def _remove_spool_dir(self, result):
+        if self.owns_spool_dir:
+            shutil.rmtree(self.spool_dir, ignore_errors=True)
+        return result
+
+
+class SpoolingAgent(ScrapyAgent):
+    def __init__(self, *, spool_threshold, spool_dir, **kwargs):
+        super().__init__(**kwargs)
+        self.spool_threshold = spool_threshold
+        self.spool_dir = spool_dir
+
+    def _cb_bodyready(self, txresponse, request):
+        if txresponse.headers.hasHeader(b'content-encoding'):
+            return super()._cb_bodyready(txresponse, request)
+        spool = _RequestBodySpool(self.spool_threshold, self.spool_dir, request)
+        deferred = super()._cb_bodyready(_SpoolingResponse(txresponse, spool), request)
+        # Failed, cancelled or timed out mid-body: close and remove the partial file
+        deferred.addErrback(self._discard_spool, spool)
+        return deferred
+
+    def _discard_spool(self, failure, spool):
+        spool.discard()
+        return failure
+
+
+def check_scrapy_internals():
+    """
+    Spooling replaces the body buffer of Scrapy's private _ResponseReader from
+    ScrapyAgent._cb_bodyready. requirements.txt pins a Scrapy where that holds; fail at
+    startup rather than mid-crawl if another version is installed.
+    """
+    reader = getattr(http11, '_ResponseReader', None)
+    if (
+        not callable(getattr(ScrapyAgent, '_cb_bodyready', None))
+        or reader is None
+        or '_bodybuf' not in reader.dataReceived.__code__.co_names
+        or '_bodybuf' not in reader._finish_response.__code__.co_names
+    ):
+        raise RuntimeError(
+            f"SpoolingHTTPDownloadHandler doesn't support Scrapy {scrapy.__version__}; "
+            "install the version in requirements.txt or set DOWNLOAD_SPOOL_THRESHOLD = 0"
+        )
+
+
+class _RequestBodySpool(BodySpool):
+    """Stands in for the response reader's BytesIO; the body ends up in memory or in meta."""
+    def __init__(self, threshold, spool_dir, request):
+        super().__init__(threshold, spool_dir)
+        self.request = request
+
+    def getvalue(self):
+        body, path = self.finish()
+        if path:
+            self.request.meta[SPOOLED_BODY] = path
+        return body
+
+
+class _SpoolingResponse:
+    """A Twisted response whose body is delivered into a spool instead of memory."""
+    def __init__(self, txresponse, spool):
+        self._txresponse = txresponse
+        self._spool = spool
+
+    def __getattr__(self, name):
+        return getattr(self._txresponse, name)
+
+    def deliverBody(self, protocol):
+        protocol._bodybuf = self._spool
+        self._txresponse.deliverBody(protocol)
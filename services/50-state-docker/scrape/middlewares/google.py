@@ -1,14 +1,32 @@
+import logging
 import os
 import re
+import threading
+from scrapy import signals
 from scrapy.http import Response
+from scrapy.utils.defer import maybe_deferred_to_future
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
+from twisted.internet import threads
+from twisted.python.threadpool import ThreadPool
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+LIST_FIELDS = 'nextPageToken, files(id, name, mimeType, modifiedTime, webViewLink, size)'
 
 # This class catches google drive folder requests and turns them into file requests
 class GoogleDriveMiddleware:
-    def __init__(self, credentials_path):
+    def __init__(self, credentials_path, list_concurrency=2, modified_since=None):
+        self.logger = logging.getLogger(self.__class__.__name__)
         self.credentials_path = credentials_path
-        self.service = self._build_service()
+        self.credentials = self._build_credentials()
+        # googleapiclient services are not thread-safe, so each listing thread builds its own
+        self.thread_local = threading.local()
+        self.list_pool = ThreadPool(minthreads=1, maxthreads=list_concurrency, name='google-drive-list')
+        self.list_pool.start()
+        # Only list files modified after this RFC 3339 time, e.g. '2024-11-01T00:00:00'
+        self.modified_since = modified_since
+        # folder id -> future of the folder's files, shared by every request for that folder
+        self.folder_listings = {}
 
     @classmethod
     def from_crawler(cls, crawler):
@@ -17,22 +35,35 @@ class GoogleDriveMiddleware:
             raise ValueError(
                 "GOOGLE_DRIVE_CREDENTIALS_FILE setting is required and must point to a valid credentials file."
             )
-        return cls(credentials_path)
+        middleware = cls(
+            credentials_path,
+            list_concurrency=crawler.settings.getint('GOOGLE_DRIVE_LIST_CONCURRENCY', 2),
+            modified_since=crawler.settings.get('GOOGLE_DRIVE_MODIFIED_SINCE')
+        )
+        crawler.signals.connect(middleware.spider_closed, signal=signals.spider_closed)
+        return middleware
 
-    def _build_service(self):
+    def spider_closed(self, spider):
+        self.list_pool.stop()
+
+    def _build_credentials(self):
         scopes = ['https://www.googleapis.com/auth/drive.readonly']
-        credentials = service_account.Credentials.from_service_account_file(
+        return service_account.Credentials.from_service_account_file(
             self.credentials_path, scopes=scopes
         )
-        service = build('drive', 'v3', credentials=credentials)
-        return service
 
-    def process_request(self, request, spider):
+    @property
+    def service(self):
+        if not hasattr(self.thread_local, 'service'):
+            self.thread_local.service = build('drive', 'v3', credentials=self.credentials, cache_discovery=False)
+        return self.thread_local.service
+
+    async def process_request(self, request, spider):
         # Check if the URL is a Google Drive folder
         if 'drive.google.com' in request.url:
             if (folder_id := self._extract_folder_id(request.url)) != None:
                 # List all files in the folder
-                files = self._list_files_in_folder(folder_id)
+                files = await self._get_folder_files(folder_id)
                 # Return a Response with the list of files in meta
                 request.meta['google_drive_folder'] = files
                 return Response(
@@ -75,14 +106,41 @@ class GoogleDriveMiddleware:
             return match.group(1)
         return None
 
+    async def _get_folder_files(self, folder_id):
+        """
+        Returns the files in a folder, listing it at most once per crawl.
+        The listing runs on the listing pool; concurrent requests for the same folder share it.
+        """
+        if folder_id not in self.folder_listings:
+            from twisted.internet import reactor
+            deferred = threads.deferToThreadPool(reactor, self.list_pool, self._list_files_in_folder, folder_id)
+            self.folder_listings[folder_id] = maybe_deferred_to_future(deferred)
+        try:
+            return await self.folder_listings[folder_id]
+        except Exception:
+            # Don't cache failures, so a retried request lists the folder again
+            self.folder_listings.pop(folder_id, None)
+            raise
+
     def _list_files_in_folder(self, folder_id):
-        # List all files in the folder using Google Drive API
-        query = f"'{folder_id}' in parents and trashed = false"
-        results = self.service.files().list(
-            q=query,
-            fields="files(id, name, mimeType)"
-        ).execute()
-        files = results.get('files', [])
+        # List all files in the folder using Google Drive API, following every page
+        query = f"'{folder_id}' in parents and trashed = false and mimeType != '{FOLDER_MIME_TYPE}'"
+        if self.modified_since:
+            query += f" and modifiedTime > '{self.modified_since}'"
+        files = []
+        page_token = None
+        while True:
+            results = self.service.files().list(
+                q=query,
+                fields=LIST_FIELDS,
+                pageSize=1000,
+                pageToken=page_token
+            ).execute()
+            files.extend(results.get('files', []))
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                break
+        self.logger.info(f"Listed {len(files)} files in Drive folder {folder_id}")
         return files
     
 
@@ -6,36 +6,159 @@
 # myproject/middlewares.py
 
 import os
+import queue
 import shutil
-import time
+import threading
 import logging
 import re
+from urllib.parse import urlparse
 from uuid import uuid4
 from scrapy import signals
 import scrapy
 from scrapy.http import Response
+from scrapy.utils.defer import maybe_deferred_to_future
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.common.by import By
-from selenium.common.exceptions import TimeoutException
+from selenium.common.exceptions import TimeoutException, WebDriverException
+from twisted.internet import threads
+from twisted.python.threadpool import ThreadPool
+from download_events import enable_download_events, read_download, set_download_dir
+from onbase_session import learn_onbase_session
+
+# Failed session learns or handed off fetches on a host where none has worked yet before it
+# is left to the browser
+ONBASE_MAX_FAILURES = 3
+
+class BrowserPool:
+    """
+    A fixed number of long-lived headless Chrome sessions.
+
+    Browsers are started on first use and reused for later requests, so startup is paid
+    once per session rather than once per document. lease() blocks until a browser is
+    free; release() hands it back, or replaces it if it broke.
+    """
+    def __init__(self, size, download_dir):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.size = size
+        self.download_dir = os.path.abspath(download_dir)
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.started = 0
+        self.drivers = []
+        self.closed = False
+
+    def new_driver(self):
+        chrome_options = Options()
+        chrome_options.add_argument('--headless')
+        prefs = {
+            "download.default_directory": self.download_dir,
+            "download.prompt_for_download": False,
+            "download.directory_upgrade": True,
+            "safebrowsing.enabled": True,
+            "plugins.always_open_pdf_externally": True,  # To download PDFs instead of opening them
+            "profile.default_content_setting_values.automatic_downloads": 1
+        }
+        chrome_options.add_experimental_option("prefs", prefs)
+        enable_download_events(chrome_options)
+        return webdriver.Chrome(options=chrome_options)
+
+    def lease(self):
+        while True:
+            with self.lock:
+                if self.closed:
+                    raise RuntimeError("Browser pool is closed")
+                # Start another browser only if none is idle and the pool isn't full
+                start_new = self.idle.empty() and self.started < self.size
+                if start_new:
+                    self.started += 1
+            if start_new:
+                return self._start_driver()
+            try:
+                # Wake up now and then in case a broken browser freed a slot
+                return self.idle.get(timeout=1)
+            except queue.Empty:
+                continue
+
+    def _start_driver(self):
+        try:
+            driver = self.new_driver()
+        except Exception:
+            with self.lock:
+                self.started -= 1
+            raise
+        with self.lock:
+            self.drivers.append(driver)
+        self.logger.info(f"Started browser {self.started}/{self.size}")
+        return driver
+
+    def release(self, driver, broken=False):
+        if broken or self.closed:
+            self._quit(driver)
+            with self.lock:
+                self.started -= 1
+                if driver in self.drivers:
+                    self.drivers.remove(driver)
+            return
+        self.idle.put(driver)
+
+    def reset(self, driver, download_dir):
+        """Points a leased browser at a fresh download directory and a blank page."""
+        driver.switch_to.default_content()
+        driver.get('about:blank')
+        set_download_dir(driver, download_dir)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            drivers = list(self.drivers)
+            self.drivers = []
+        for driver in drivers:
+            self._quit(driver)
+
+    def _quit(self, driver):
+        try:
+            driver.quit()
+        except Exception as e:
+            self.logger.warning(f"Error closing browser: {e}")
 
 class SeleniumDownload:
-    def __init__(self, download_dir):
+    def __init__(self, download_dir, pool_size=3, onbase_handoff=False):
         self.logger = logging.getLogger(self.__class__.__name__)
         logging.getLogger('selenium.webdriver.remote.remote_connection').setLevel(logging.INFO)
         self.download_dir = download_dir
+        self.browsers = BrowserPool(pool_size, download_dir)
+        # One thread per browser; Selenium calls block, so they stay off the reactor
+        self.thread_pool = ThreadPool(minthreads=1, maxthreads=pool_size, name='selenium')
+        self.thread_pool.start()
+        # In handoff mode a browser only learns each OnBase host's cookies and document URL
+        # template; the documents themselves are fetched by Scrapy over plain HTTP
+        self.onbase_handoff = onbase_handoff
+        # host -> future of the OnBaseSession learned there; dropped again if learning fails
+        self.onbase_sessions = {}
+        # Hosts where a handed off request has worked, and failures in a row per host
+        self.onbase_worked = set()
+        self.onbase_failures = {}
+        # Hosts where handed off requests never worked; they stay on the browser path
+        self.onbase_disabled = set()
 
     @classmethod
     def from_crawler(cls, crawler):
         # Get the download directory from settings or set a default one
         download_dir = crawler.settings.get('SELENIUM_DOWNLOAD_DIR', '/tmp')
-        middleware = cls(download_dir)
+        pool_size = crawler.settings.getint('SELENIUM_POOL_SIZE', 3)
+        onbase_handoff = crawler.settings.getbool('SELENIUM_ONBASE_HANDOFF', False)
+        middleware = cls(download_dir, pool_size, onbase_handoff)
         crawler.signals.connect(middleware.spider_closed, signals.spider_closed)
         return middleware
 
-    def process_request(self, request:scrapy.Request, spider):
+    async def process_request(self, request:scrapy.Request, spider):
+        if request.meta.get('onbase_handoff'):
+            # Already pointed at the document itself; Scrapy downloads it
+            return None
+
         # Define the URL patterns that need Selenium for PDF downloads
         pdf_url_patterns = [
             r'hylandcloud',
@@ -44,44 +167,138 @@ class SeleniumDownload:
         # Check if the request URL matches any of the patterns
         for pattern in pdf_url_patterns:
             if re.search(pattern, request.url):
+                if self.onbase_handoff and not request.meta.get('onbase_browser'):
+                    handoff = await self.handoff_request(request)
+                    if handoff:
+                        return handoff
                 self.logger.info(f"Starting {request.url} with Selenium for file download")
-                return self.selenium_download(request, pattern)
+                from twisted.internet import reactor
+                deferred = threads.deferToThreadPool(
+                    reactor, self.thread_pool, self.selenium_download, request, pattern
+                )
+                return await maybe_deferred_to_future(deferred)
         # If no pattern matches, let Scrapy handle the request
         return None
     
+    async def handoff_request(self, request:scrapy.Request):
+        """
+        Rewrites a viewer page request into a plain HTTP request for the document, carrying
+        the browser session's cookies. Returns None if the host's session isn't usable.
+        """
+        session = await self.onbase_session(request.url)
+        document_url = session.document_url(request.url) if session else None
+        if not document_url:
+            return None
+        headers = request.headers.copy()
+        headers['User-Agent'] = session.user_agent
+        headers['Referer'] = request.url
+        meta = dict(request.meta)
+        meta['onbase_handoff'] = request.url
+        return request.replace(
+            url=document_url,
+            headers=headers,
+            cookies=session.cookies,
+            meta=meta,
+            dont_filter=True
+        )
+
+    async def onbase_session(self, url):
+        # Learned once per host by one browser; concurrent requests share the result
+        host = urlparse(url).netloc
+        if host in self.onbase_disabled:
+            return None
+        if host not in self.onbase_sessions:
+            from twisted.internet import reactor
+            deferred = threads.deferToThreadPool(
+                reactor, self.thread_pool, self.learn_session, url
+            )
+            self.onbase_sessions[host] = maybe_deferred_to_future(deferred)
+        future = self.onbase_sessions[host]
+        session = await future
+        if session is None and self.onbase_sessions.get(host) is future:
+            # Learning failed; later requests try again until the host is disabled
+            del self.onbase_sessions[host]
+            self.count_onbase_failure(host)
+        return session
+
+    def learn_session(self, url):
+        # Runs on the selenium thread pool
+        driver = self.browsers.lease()
+        broken = False
+        try:
+            self.browsers.reset(driver, self.browsers.download_dir)
+            session = learn_onbase_session(driver, url)
+            self.logger.info(f"Learned OnBase session for {urlparse(url).netloc}: {session.template}")
+            return session
+        except Exception as e:
+            broken = isinstance(e, WebDriverException)
+            self.logger.warning(f"Could not learn an OnBase session from {url}, using the browser: {e}")
+            return None
+        finally:
+            self.browsers.release(driver, broken=broken)
+
+    def process_response(self, request, response, spider):
+        page_url = request.meta.get('onbase_handoff')
+        if not page_url:
+            return response
+        content_type = response.headers.get('Content-Type', b'').decode('latin-1')
+        # An expired session usually comes back as a login page rather than an error
+        if response.status in (200, 304) and not content_type.startswith('text/html'):
+            host = urlparse(page_url).netloc
+            self.onbase_worked.add(host)
+            self.onbase_failures[host] = 0
+            # Look like the viewer page the spider asked for, as the browser path does
+            return response.replace(url=page_url, request=request.replace(url=page_url))
+        return self.browser_fallback(request, f"status {response.status}, {content_type or 'no content type'}")
+
+    def process_exception(self, request, exception, spider):
+        if request.meta.get('onbase_handoff'):
+            return self.browser_fallback(request, exception)
+        return None
+
+    def browser_fallback(self, request, reason):
+        # Send the viewer page back through the browser and stop trusting the session
+        page_url = request.meta['onbase_handoff']
+        host = urlparse(page_url).netloc
+        self.logger.warning(f"Handed off fetch of {page_url} failed ({reason}), retrying with the browser")
+        self.count_onbase_failure(host)
+        future = self.onbase_sessions.get(host)
+        if future is not None and future.done():
+            # Probably expired; the next request learns the session again
+            del self.onbase_sessions[host]
+        meta = dict(request.meta)
+        del meta['onbase_handoff']
+        meta['onbase_browser'] = True
+        return request.replace(url=page_url, meta=meta, dont_filter=True)
+
+    def count_onbase_failure(self, host):
+        failures = self.onbase_failures.get(host, 0) + 1
+        self.onbase_failures[host] = failures
+        if host not in self.onbase_worked and failures >= ONBASE_MAX_FAILURES:
+            # Never worked, so learning again won't help
+            self.logger.warning(f"Disabling OnBase handoff for {host}")
+            self.onbase_disabled.add(host)
+
     def selenium_download(self, request:scrapy.Request, pattern):
-        #Setup the browser
-        chrome_options = Options()
-        chrome_options.add_argument('--headless')
-        prefs = {
-            "download.default_directory": self.download_dir,
-            "download.prompt_for_download": False,
-            "download.directory_upgrade": True,
-            "safebrowsing.enabled": True,
-            "plugins.always_open_pdf_externally": True,  # To download PDFs instead of opening them
-            "profile.default_content_setting_values.automatic_downloads": 1
-        }
-        chrome_options.add_experimental_option("prefs", prefs)
-        self.driver= webdriver.Chrome(options=chrome_options)
+        # Runs on the selenium thread pool with a browser leased from the pool
+        driver = self.browsers.lease()
+        broken = False
         
         # Generate a unique download directory for each request
         unique_id = str(uuid4())
-        unique_download_dir = os.path.join(self.download_dir, unique_id)
+        unique_download_dir = os.path.join(os.path.abspath(self.download_dir), unique_id)
         os.makedirs(unique_download_dir, exist_ok=True)
 
         try:
-            # Update browser preferences to use the unique directory
-            self.driver.execute_cdp_cmd('Page.setDownloadBehavior', {
-                'behavior': 'allow',
-                'downloadPath': unique_download_dir
-            })
-            self.driver.get(request.url)
+            # Point the browser at the unique directory
+            self.browsers.reset(driver, unique_download_dir)
+            driver.get(request.url)
             
             # These methods wait for the right button to be active, and then start the download
             if pattern == r'hylandcloud':
-                self.onbase_click_button(download_dir=unique_download_dir)
+                self.onbase_click_button(driver, download_dir=unique_download_dir)
                 # Wait for the download to complete
-                downloaded_data = self.wait_for_download_and_read(download_dir=unique_download_dir)
+                downloaded_data = self.wait_for_download_and_read(driver, download_dir=unique_download_dir)
                 # Read the data into an http response and return
                 if downloaded_data:
                     response = Response(
@@ -90,7 +307,6 @@ class SeleniumDownload:
                         request=request
                     )
                     self.logger.info(f"Completing {request.url} with Selenium for file download")
-                    self.driver.quit()
                     return response
             else:
                 logging.warning(f"Failed to download file from {request.url}")
@@ -107,6 +323,8 @@ class SeleniumDownload:
                 request=request
             )
         except Exception as e:
+            # A dead browser session is replaced rather than handed to the next request
+            broken = isinstance(e, WebDriverException)
             self.logger.warning(f"Failed to download file from {request.url}")
             self.logger.error("An error occurred: %s", e, exc_info=True)
             return Response(
@@ -115,47 +333,37 @@ class SeleniumDownload:
                     request=request
                 )
         finally:
+            self.browsers.release(driver, broken=broken)
             # remove the file after processing
             shutil.rmtree(unique_download_dir)                        
         
-    def onbase_click_button(self, download_dir):
+    def onbase_click_button(self, driver, download_dir):
         # Wait for the PDF to load and switch to proper frame
-        WebDriverWait(self.driver, 15).until(
+        WebDriverWait(driver, 15).until(
             EC.presence_of_element_located((By.ID, "DocSelectPage"))
         )
-        self.driver.switch_to.frame("DocSelectPage")
+        driver.switch_to.frame("DocSelectPage")
         try:
-            WebDriverWait(self.driver, 15).until(
+            WebDriverWait(driver, 15).until(
                 EC.presence_of_element_located((By.ID, "pdfViewerContainer"))
             )
         except TimeoutException as e:
             self.logger.info("Could be an XLS")
             return None
         raise Exception('Skipping right now')
-        self.driver.switch_to.frame("pdfViewerContainer")
+        driver.switch_to.frame("pdfViewerContainer")
                 
         # Find and click the download link
-        mainContentElement = self.driver.find_element(By.ID, "main-content")
+        mainContentElement = driver.find_element(By.ID, "main-content")
         target_anchor = mainContentElement.find_element(By.TAG_NAME, "a")
         target_anchor.click()
         return None
 
-    def wait_for_download_and_read(self, download_dir, timeout=30):
-        seconds = 0
-        downloaded_file = None
-        while seconds < timeout:
-            files = os.listdir(download_dir)
-            if files:
-                for file_name in files:
-                    if not file_name.endswith('.crdownload'):
-                        downloaded_file = file_name
-                        downloaded_file_path = os.path.join(download_dir, downloaded_file)
-                        with open(downloaded_file_path, 'rb') as f:
-                            return f.read()
-            time.sleep(1)
-            seconds += 1
-        return None
+    def wait_for_download_and_read(self, driver, download_dir, timeout=30):
+        # Chrome's download events say when the file is complete, so there's no polling delay
+        return read_download(driver, download_dir, timeout=timeout)
 
     def spider_closed(self):
-        self.logger.debug("Closing Selenium WebDriver")
-        self.driver.quit()
+        self.logger.debug("Closing Selenium WebDrivers")
+        self.browsers.close()
+        self.thread_pool.stop()
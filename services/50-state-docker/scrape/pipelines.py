@@ -4,44 +4,226 @@
 # See: https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 
 # useful for handling different item types with a single interface
+import hashlib
 import json
 import mimetypes
+import os
 from itemadapter import ItemAdapter
 
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import ClientError
+from io import BytesIO
 import logging
 from urllib.parse import urlparse
-from twisted.internet import threads
+from twisted.internet import defer, task, threads
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
 
+from body_spool import MB, remove_spooled, sha256_file
+from crawl_state import ContentIndex
 from items import PageContentItem
 from s3_sanitize import sanitize_metadata, sanitize_s3_key
+from work_queue import UPLOAD_DONE, UPLOAD_IN_PROGRESS
+
+def sha256_hex(content):
+    return hashlib.sha256(content).hexdigest()
+
+class ByteBudget:
+    """
+    Limits the bytes held in memory by in-flight uploads.
+
+    acquire() returns a Deferred that fires once the bytes fit under the limit. An item
+    bigger than the whole limit is let through alone, when nothing else is in flight.
+    Only used from the reactor thread.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self.waiting = []
+
+    def acquire(self, size):
+        deferred = defer.Deferred()
+        self.waiting.append((size, deferred))
+        self._wake()
+        return deferred
+
+    def release(self, size):
+        self.in_flight -= size
+        self._wake()
+
+    def _wake(self):
+        # First come, first served, so a large item is not starved by small ones
+        while self.waiting:
+            size, deferred = self.waiting[0]
+            if self.in_flight and self.in_flight + size > self.limit:
+                return
+            self.waiting.pop(0)
+            self.in_flight += size
+            deferred.callback(size)
 
 class S3Upload_Pipeline:
-    def __init__(self, bucket_name, job_folder):
+    def __init__(self, bucket_name, job_folder, threads=16, multipart_threshold=16 * MB, max_in_flight_bytes=256 * MB,
+                 dedup_mode='copy', claim_poll_seconds=5):
         self.logger = logging.getLogger(self.__class__.__name__)
         self.bucket_name = bucket_name
         self.job_folder = job_folder
-        self.s3_client = boto3.client('s3')
+        # Multipart uploads send up to max_concurrency parts at once from each upload thread
+        self.transfer_config = TransferConfig(
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=8 * MB,
+            max_concurrency=4
+        )
+        self.s3_client = boto3.client(
+            's3',
+            config=Config(max_pool_connections=threads * self.transfer_config.max_concurrency)
+        )
+        # Our own pool, so uploads don't compete with DNS lookups on the reactor's default one
+        self.upload_pool = ThreadPool(minthreads=1, maxthreads=threads, name='s3-upload')
+        self.byte_budget = ByteBudget(max_in_flight_bytes)
+        self.stats = None
+        self.validators = None
+        self.work_queue = None
+        self.worker_id = None
+        # How often to check on a URL another worker is uploading
+        self.claim_poll_seconds = claim_poll_seconds
+        # 'copy': server-side copy of known content into this job folder
+        # 'sidecar': only write the sidecar, pointing at the stored object
+        # 'off': always upload
+        self.dedup_mode = dedup_mode
+        self.content_index = None
+        # sha256 -> Deferreds of items waiting for another upload of the same content
+        self.upload_waiters = {}
 
     @classmethod
     def from_crawler(cls, crawler):
         bucket_name = crawler.settings.get('BUCKET_NAME')
         job_folder = crawler.settings.get('JOB_FOLDER')
 
-        return cls(
+        pipeline = cls(
             bucket_name,
-            job_folder
+            job_folder,
+            threads=crawler.settings.getint('S3_UPLOAD_THREADS', 16),
+            multipart_threshold=crawler.settings.getint('S3_MULTIPART_THRESHOLD', 16 * MB),
+            max_in_flight_bytes=crawler.settings.getint('S3_MAX_IN_FLIGHT_BYTES', 256 * MB),
+            dedup_mode=crawler.settings.get('S3_DEDUP_MODE', 'copy'),
+            claim_poll_seconds=crawler.settings.getfloat('S3_UPLOAD_CLAIM_POLL_SECONDS', 5)
         )
+        pipeline.stats = crawler.stats
+        return pipeline
+
+    def open_spider(self, spider):
+        self.upload_pool.start()
+        # The spider owns the validator store and saves it when it closes
+        self.validators = getattr(spider, 'validators', None)
+        # Shared with other workers in worker mode, to upload each URL once
+        self.work_queue = getattr(spider, 'work_queue', None)
+        self.worker_id = getattr(spider, 'worker_id', None)
+        if self.dedup_mode != 'off':
+            self.content_index = ContentIndex(self.s3_client, self.bucket_name, logger=self.logger).load()
+
+    def close_spider(self, spider):
+        self.upload_pool.stop()
+        if self.content_index is not None:
+            self.content_index.save()
+        if self.stats:
+            self.logger.info(
+                f"Deduplicated {self.stats.get_value('s3_upload/deduplicated_count', 0)} items "
+                f"({self.stats.get_value('s3_upload/deduplicated_bytes', 0)} bytes), uploaded "
+                f"{self.stats.get_value('s3_upload/uploaded_count', 0)} items "
+                f"({self.stats.get_value('s3_upload/uploaded_bytes', 0)} bytes)"
+            )
 
     def process_item(self, item, spider):
-        # Use deferToThread to offload the blocking operation
-        deferred = threads.deferToThread(self.s3_put_synch, item)
-        # Add callbacks to handle success or error
-        deferred.addCallback(self.handle_result, item, spider)
-        deferred.addErrback(self.handle_error, item, spider)
-        return deferred  # Return the Deferred to inform Scrapy
-    
+        deferred = self.upload_item(item, spider)
+        # The spooled body isn't needed once the item is stored, whatever happened
+        if item.get('content_path'):
+            deferred.addBoth(self.remove_spooled_content, item)
+        return deferred
+
+    def remove_spooled_content(self, result, item):
+        remove_spooled(item['content_path'])
+        return result
+
+    @defer.inlineCallbacks
+    def upload_item(self, item, spider):
+        stored = False
+        try:
+            stored = yield self.store_item(item, spider)
+        finally:
+            # In worker mode the spider acks the item's task once all of its items are stored
+            if item.get('task_id') and hasattr(spider, 'item_stored'):
+                spider.item_stored(item, stored)
+        return self.handle_result(item, item, spider)
+
+    @defer.inlineCallbacks
+    def store_item(self, item, spider):
+        """Uploads an item unless it is already stored. Returns True if it is stored now."""
+        if item.get('unchanged'):
+            # 304 from the server: the stored object is still current, nothing to upload
+            self.logger.info(f"Unchanged {item['source_url']}, keeping {item['existing_key']}")
+            if self.stats:
+                self.stats.inc_value('s3_upload/unchanged')
+            return True
+        # Work queue calls block on SQLite or Redis, so they run on the upload pool
+        upload_url = item['source_url']
+        if self.work_queue:
+            claim = yield self.claim_upload(upload_url)
+            if claim == UPLOAD_DONE:
+                self.logger.info(f"{upload_url} was already uploaded by another worker")
+                self.inc_stat('s3_upload/claimed_elsewhere')
+                return True
+        # Wait for room under the in-flight byte limit. Until then the item holds its
+        # response in Scrapy's scraper slot, which makes the engine back off.
+        size = self.memory_size(item)
+        yield self.byte_budget.acquire(size)
+        uploaded = False
+        failure = None
+        try:
+            uploaded = yield self.s3_put(item)
+        except Exception:
+            # Logged here, then passed on so Scrapy records the failed item
+            failure = Failure()
+            self.handle_error(failure, item, spider)
+        finally:
+            self.byte_budget.release(size)
+        if self.work_queue:
+            finish = self.work_queue.finish_upload if uploaded else self.work_queue.release_upload
+            try:
+                yield self.defer_to_pool(finish, upload_url, self.worker_id)
+            except Exception as e:
+                self.logger.error(f"Updating the upload claim of {upload_url} failed: {e}")
+        if failure:
+            failure.raiseException()
+        return uploaded
+
+    @defer.inlineCallbacks
+    def claim_upload(self, upload_url):
+        """
+        Claims the upload of a URL in the work queue. While another worker holds the claim,
+        waits for it to finish (UPLOAD_DONE) or give up (we then claim it ourselves).
+        """
+        from twisted.internet import reactor
+        while True:
+            claim = yield self.defer_to_pool(self.work_queue.begin_upload, upload_url, self.worker_id)
+            if claim != UPLOAD_IN_PROGRESS:
+                return claim
+            self.inc_stat('s3_upload/claim_waits')
+            yield task.deferLater(reactor, self.claim_poll_seconds, lambda: None)
+
+    def content_size(self, item):
+        if item.get('content_path'):
+            return os.path.getsize(item['content_path'])
+        return len(item['content'] or b'')
+
+    def memory_size(self, item):
+        # A spooled body is streamed from disk, a few multipart chunks at a time
+        size = self.content_size(item)
+        if item.get('content_path'):
+            size = min(size, self.transfer_config.multipart_chunksize * self.transfer_config.max_concurrency)
+        return size
+
     def handle_result(self, result, item, spider):
         # This callback is called when the blocking operation completes successfully
         self.logger.debug(f"Successfully uploaded item: {item['source_url']}")
@@ -54,7 +236,106 @@ class S3Upload_Pipeline:
         # For this example, we'll just pass the failure along
         return failure
 
-    def s3_put_synch(self, item:PageContentItem):
+    def defer_to_pool(self, func, *args):
+        from twisted.internet import reactor
+        return threads.deferToThreadPool(reactor, self.upload_pool, func, *args)
+
+    @defer.inlineCallbacks
+    def s3_put(self, item:PageContentItem):
+        """
+        Uploads the content, then its .metadata.json sidecar. Returns True on success.
+
+        Content already in the content index is not uploaded again: it is copied server-side
+        from the stored object ('copy' dedup mode), or the sidecar points at the stored
+        object ('sidecar' mode).
+        """
+        content = item['content']
+        content_path = item.get('content_path')
+        size = self.content_size(item)
+        sanitized_key, composite_title = self.build_key(item)
+        if content_path:
+            content_hash = yield self.defer_to_pool(sha256_file, content_path)
+        else:
+            content_hash = yield self.defer_to_pool(sha256_hex, content)
+        existing_key = None
+        while self.content_index is not None:
+            existing_key, pending_key = self.content_index.claim(content_hash, sanitized_key)
+            if not pending_key:
+                break
+            # Another item is uploading the same content; use its key only once it is stored
+            self.logger.debug(f"Waiting for the upload of {pending_key} before storing {item['source_url']}")
+            yield self.wait_for_upload(content_hash)
+
+        pi_key = sanitized_key
+        if existing_key and self.dedup_mode == 'sidecar':
+            pi_key = existing_key
+        metadata_utf8_json = self.build_sidecar(item, composite_title, pi_key)
+
+        try:
+            if not existing_key:
+                copied = yield self.defer_to_pool(self.upload_content, sanitized_key, content, content_path)
+            elif self.dedup_mode == 'copy' and existing_key != sanitized_key:
+                copied = yield self.defer_to_pool(self.copy_content, existing_key, sanitized_key, content, content_path)
+            else:
+                copied = True
+        except Exception as e:
+            if not existing_key and self.content_index is not None:
+                self.content_index.release(content_hash, sanitized_key)
+                self.upload_finished(content_hash)
+            if not isinstance(e, ClientError):
+                raise
+            self.logger.error(f"Failed to upload {item['source_url']} to S3: {e}")
+            return False
+        if not existing_key and self.content_index is not None:
+            self.content_index.complete(content_hash, sanitized_key)
+            self.upload_finished(content_hash)
+        # Only once the content is stored, so a sidecar never points at a missing object
+        try:
+            yield self.defer_to_pool(self.upload_sidecar, sanitized_key, metadata_utf8_json)
+        except ClientError as e:
+            self.logger.error(f"Failed to upload the sidecar of {item['source_url']} to S3: {e}")
+            return False
+
+        deduplicated = existing_key and copied
+        if deduplicated:
+            self.logger.info(f"Deduplicated {item['source_url']}: same content as {existing_key}")
+            self.inc_stat('s3_upload/deduplicated_count')
+            self.inc_stat('s3_upload/deduplicated_bytes', size)
+        else:
+            if existing_key:
+                # The indexed object was gone, so it was uploaded after all
+                self.content_index.complete(content_hash, sanitized_key)
+            self.logger.info(f"Uploaded {item['source_url']} to S3 bucket {self.bucket_name} as {sanitized_key}")
+            self.inc_stat('s3_upload/uploaded_count')
+            self.inc_stat('s3_upload/uploaded_bytes', size)
+        if self.validators is not None and item.get('sheet_url'):
+            self.validators.record(
+                item['sheet_url'],
+                pi_key,
+                content_hash,
+                etag=item.get('etag'),
+                last_modified=item.get('last_modified')
+            )
+        if self.validators is not None and item.get('drive_file_id'):
+            self.validators.record_drive_file(item['drive_file_id'], pi_key, content_hash, item.get('modified_time'))
+        return True
+
+    def wait_for_upload(self, content_hash):
+        deferred = defer.Deferred()
+        self.upload_waiters.setdefault(content_hash, []).append(deferred)
+        return deferred
+
+    def upload_finished(self, content_hash):
+        # Waiters claim again: they dedup against the stored object, or take over the upload
+        for deferred in self.upload_waiters.pop(content_hash, []):
+            deferred.callback(None)
+
+    def inc_stat(self, name, count=1):
+        if self.stats:
+            self.stats.inc_value(name, count)
+
+    def build_key(self, item:PageContentItem):
+        """Returns the object key and the composite title for an item."""
         composite_title = item['jurisdiction'] + " - " + item['title']
         if item['description'] != '':
             composite_title += " - " + item['description']
@@ -66,9 +347,13 @@ class S3Upload_Pipeline:
         sanitized_title = sanitize_s3_key(f"{composite_title}.{extension}")
         sanitized_jurisdiction = sanitize_s3_key(f"{item['jurisdiction']}")
         sanitized_key = f"{self.job_folder}/{sanitized_jurisdiction}/{sanitized_title}"
+        return sanitized_key, composite_title
+
+    def build_sidecar(self, item:PageContentItem, composite_title, pi_key):
+        """Returns the sidecar body for an item whose content is stored at pi_key."""
         attributes = sanitize_metadata({
             '_source_uri': item['source_url'],
-            'pi_url': f"s3://{self.bucket_name}/{sanitized_key}",
+            'pi_url': f"s3://{self.bucket_name}/{pi_key}",
             'jurisdiction': item['jurisdiction'],
             'title': item['title'],
             'description': item['description'],
@@ -81,22 +366,47 @@ class S3Upload_Pipeline:
             'Attributes': attributes
         }
         json_str = json.dumps(sanitized_metadata, indent=2)
-        metadata_utf8_json = json_str.encode('utf-8')
-        try:
-            self.s3_client.put_object(
-                Bucket=self.bucket_name,
-                Key=sanitized_key,
-                Body=item['content'],
+        return json_str.encode('utf-8')
+
+    def upload_content(self, key, content, content_path=None):
+        # Both switch to a parallel multipart upload above the threshold; a spooled
+        # body is streamed from its file
+        if content_path:
+            self.s3_client.upload_file(content_path, self.bucket_name, key, Config=self.transfer_config)
+        else:
+            self.s3_client.upload_fileobj(
+                BytesIO(content),
+                self.bucket_name,
+                key,
+                Config=self.transfer_config
             )
-            self.s3_client.put_object(
-                Bucket=self.bucket_name,
-                Key=f'{sanitized_key}.metadata.json',
-                Body=metadata_utf8_json,                
+        return False
+
+    def copy_content(self, source_key, key, content, content_path=None):
+        """
+        Copies an already stored object server-side. Returns True if it was copied, or
+        False if the source was gone and the content was uploaded instead.
+        """
+        try:
+            self.s3_client.copy(
+                {'Bucket': self.bucket_name, 'Key': source_key},
+                self.bucket_name,
+                key,
+                Config=self.transfer_config
             )
-            self.logger.info(f"Uploaded {item['source_url']} to S3 bucket {self.bucket_name} as {sanitized_key}")
+            return True
         except ClientError as e:
-            self.logger.error(f"Failed to upload {item['source_url']} to S3: {str(e)}")
-        return item
+            if e.response.get('Error', {}).get('Code') not in ('NoSuchKey', '404'):
+                raise
+            self.logger.warning(f"Indexed object {source_key} is missing, uploading {key}")
+            return self.upload_content(key, content, content_path)
+
+    def upload_sidecar(self, key, metadata_utf8_json):
+        self.s3_client.put_object(
+            Bucket=self.bucket_name,
+            Key=f'{key}.metadata.json',
+            Body=metadata_utf8_json,
+        )
 
     def get_object_key(self, item):
         # Use URL path as object key, defaulting to 'index.html' if necessary
@@ -7,6 +7,8 @@
 #     https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
 #     https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
+import os
+
 BOT_NAME = "scrape"
 
 SPIDER_MODULES = ["scrape.spiders"]
@@ -104,4 +106,39 @@ LOG_LEVEL = "INFO"
 LOG_FILE = None  # Ensure Scrapy doesn’t log to its own file
 STATS_DUMP = True
 
-GOOGLE_DRIVE_CREDENTIALS_FILE = './sbx-kendra-8e724bd9a0ce.json'
\ No newline at end of file
+GOOGLE_DRIVE_CREDENTIALS_FILE = './sbx-kendra-8e724bd9a0ce.json'
+
+# Concurrent Google Drive API downloads (googleapis.com), run on their own thread pool
+GOOGLE_DRIVE_DOWNLOAD_CONCURRENCY = 4
+# Concurrent Google Drive folder listings
+GOOGLE_DRIVE_LIST_CONCURRENCY = 2
+# Only crawl Drive folder files modified after this RFC 3339 time, e.g. '2024-11-01T00:00:00'.
+# Independently of it, a Drive file whose modifiedTime matches the one stored when it was
+# last uploaded is not downloaded again
+GOOGLE_DRIVE_MODIFIED_SINCE = os.environ.get('GOOGLE_DRIVE_MODIFIED_SINCE')
+
+# S3 upload pipeline: upload threads, size above which uploads go multipart, and the
+# bytes allowed in flight before the pipeline stops accepting items
+S3_UPLOAD_THREADS = 16
+S3_MULTIPART_THRESHOLD = 16 * 1024 * 1024
+S3_MAX_IN_FLIGHT_BYTES = 256 * 1024 * 1024
+# Content already stored under another key: 'copy' it server-side, write only a 'sidecar'
+# pointing at it, or 'off' to always upload
+S3_DEDUP_MODE = 'copy'
+# In worker mode, how often to check on a URL another worker is still uploading
+S3_UPLOAD_CLAIM_POLL_SECONDS = 5
+# Long-lived headless browsers shared by Selenium downloads; also how many run at once
+SELENIUM_POOL_SIZE = 3
+# Let one browser per OnBase host learn its cookies and document URLs, then fetch the
+# documents over plain HTTP, falling back to the browser when that fails
+SELENIUM_ONBASE_HANDOFF = os.environ.get('SELENIUM_ONBASE_HANDOFF', 'false')
+# Response bodies (and Drive downloads) larger than this are written to temp files as they
+# arrive, instead of being held in memory; 0 keeps everything in memory. The files go in a
+# directory per crawl, created in DOWNLOAD_SPOOL_DIR (default: the system temp dir) and
+# removed when the crawl ends
+DOWNLOAD_SPOOL_THRESHOLD = 8 * 1024 * 1024
+DOWNLOAD_SPOOL_DIR = os.environ.get('DOWNLOAD_SPOOL_DIR')
+DOWNLOAD_HANDLERS = {
+    'http': 'scrape.handlers.SpoolingHTTPDownloadHandler',
+    'https': 'scrape.handlers.SpoolingHTTPDownloadHandler',
+}
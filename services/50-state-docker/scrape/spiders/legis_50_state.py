@@ -1,4 +1,4 @@
-from io import BytesIO
+import threading
 import traceback
 import boto3
 import scrapy
@@ -10,104 +10,290 @@ import magic
 from googleapiclient.http import MediaIoBaseDownload
 from googleapiclient.discovery import build
 from google.oauth2 import service_account
-from typing import List
 from urllib.parse import urlparse
+from scrapy import signals
+from scrapy.exceptions import DontCloseSpider
+from scrapy.utils.defer import maybe_deferred_to_future
+from twisted.internet import defer, threads
+from twisted.python.threadpool import ThreadPool
 
 
 from items import PageContentItem  # For random delay
+from body_spool import MB, SNIFF_BYTES, BodySpool, read_head
+from crawl_state import ValidatorStore
+from work_queue import default_worker_id, open_work_queue
 
 class LegisSpider(scrapy.Spider):
     name = "legis"
 
-    def __init__(self, legis_file=None, job_folder=None, *args, **kwargs):
+    def __init__(self, legis_file=None, job_folder=None, work_queue_url=None, worker_id=None, *args, **kwargs):
         super(LegisSpider, self).__init__(*args, **kwargs)
         self.credentials_path = './sbx-kendra-8e724bd9a0ce.json'
 
         # Initialize the S3 client
         self.s3_client = boto3.client('s3')
         
-        self.service = self._build_service()
+        # googleapiclient services (httplib2) are not thread-safe, so each download thread builds its own
+        self.credentials = self._build_credentials()
+        self.thread_local = threading.local()
+        self.drive_pool = None
+        # Drive downloads bigger than this go to a temp file, like spooled HTTP responses
+        self.spool_threshold = 8 * MB
         self.mimeDetector = magic.Magic(mime=True)
         self.job_folder = job_folder
+        # ETag/Last-Modified from earlier crawls, so unchanged documents come back as 304s
+        self.validators = ValidatorStore(self.s3_client, 'sbx-piai-docs', logger=self.logger).load()
         
+        # In worker mode rows are leased from a queue shared with other containers
+        self.work_queue = None
+        self.worker_id = worker_id or default_worker_id()
+        # task -> items not yet stored by the pipeline, and whether the task failed. A task
+        # is a work queue task in worker mode, and a sheet row (its URL) otherwise.
+        self.open_tasks = {}
+        # Sheet URLs of the rows that failed, so the change feed retries them next run
+        self.failed_rows = set()
+        # Work queue calls block, so they run on a thread; these track them
+        self.leasing = False
+        self.queue_drained = False
+        self.queue_calls = 0
+        if work_queue_url:
+            self.work_queue = open_work_queue(work_queue_url, job_folder)
+            self.docs = []
+            return
+
         # Read the dictionary from the file
         try:
             self.docs = self.read_from_s3('sbx-piai-docs', f'{job_folder}/{legis_file}')
         except Exception as e:
             raise Exception(f"Error reading file from S3: {e}")
 
-    def _build_service(self):
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        # Drive downloads run on their own pool so they never block the reactor or
+        # compete with DNS lookups on the reactor's default pool
+        concurrency = crawler.settings.getint('GOOGLE_DRIVE_DOWNLOAD_CONCURRENCY', 4)
+        spider.drive_pool = ThreadPool(minthreads=1, maxthreads=concurrency, name='google-drive')
+        spider.drive_pool.start()
+        spider.spool_threshold = crawler.settings.getint('DOWNLOAD_SPOOL_THRESHOLD', 8 * MB)
+        crawler.signals.connect(spider.spider_closed, signal=signals.spider_closed)
+        if spider.work_queue:
+            spider.lease_batch = crawler.settings.getint('WORK_QUEUE_BATCH', 8)
+            crawler.signals.connect(spider.spider_idle, signal=signals.spider_idle)
+        return spider
+
+    def spider_idle(self, spider):
+        # Lease more rows whenever the crawl runs dry; stay open while other workers
+        # hold leases that may expire back to us, and until acks have been sent
+        if self.queue_drained and not self.queue_calls:
+            return
+        if not self.leasing:
+            self.leasing = True
+            deferred = self.call_queue(self.lease_tasks)
+            deferred.addCallback(self.schedule_tasks)
+            deferred.addErrback(lambda failure: self.logger.error(f"Leasing from the work queue failed: {failure.getErrorMessage()}"))
+            deferred.addBoth(self.lease_done)
+        raise DontCloseSpider
+
+    def call_queue(self, func, *args):
+        # Runs a blocking work queue call on the reactor's thread pool
+        self.queue_calls += 1
+        deferred = threads.deferToThread(func, *args)
+
+        def done(result):
+            self.queue_calls -= 1
+            return result
+        return deferred.addBoth(done)
+
+    def lease_tasks(self):
+        # Runs on a thread; returns the leased tasks and whether the queue is drained
+        tasks = self.work_queue.lease(self.worker_id, self.lease_batch)
+        return tasks, not tasks and self.work_queue.is_drained()
+
+    def schedule_tasks(self, result):
+        tasks, self.queue_drained = result
+        for task, doc in tasks:
+            request = self.build_request(doc, task)
+            if request:
+                self.crawler.engine.crawl(request)
+            else:
+                self.finish_task(task, success=True)
+
+    def lease_done(self, result):
+        self.leasing = False
+
+    def spider_closed(self, spider):
+        if self.drive_pool:
+            self.drive_pool.stop()
+
+    def _build_credentials(self):
         scopes = ['https://www.googleapis.com/auth/drive.readonly']
-        credentials = service_account.Credentials.from_service_account_file(
+        return service_account.Credentials.from_service_account_file(
             self.credentials_path, scopes=scopes
         )
-        service = build('drive', 'v3', credentials=credentials)
-        return service
+
+    def _build_service(self):
+        return build('drive', 'v3', credentials=self.credentials, cache_discovery=False)
+
+    @property
+    def service(self):
+        # One Drive service per thread
+        if not hasattr(self.thread_local, 'service'):
+            self.thread_local.service = self._build_service()
+        return self.thread_local.service
         
     def start_requests(self):
+        if self.work_queue:
+            # Rows are leased when the spider goes idle, which it does straight away
+            return
         try:
             # Iterate over the dictionary and create requests for each URL
             for doc in self.docs:
-                url:str = doc['url']
-                if urlparse(url):
-                    meta:dict ={
-                        'jurisdiction': doc['jurisdiction'],
-                        'title': doc['title'],
-                        'description': doc.get('description', ''),
-                        'doc_type': doc.get('doc_type', ''),
-                        'tombstone': doc.get('tombstone', ''),
-                        'language': doc.get('language', 'en')
-                    }
-                    if 'folders' in url:
-                        folder_id = url.split('?')[0].rstrip('/').split('/')[-1]
-                        meta["google_drive_folder_id"] = folder_id
-                    yield scrapy.Request(
-                        url=url,
-                        meta=meta
-                    )                    
-                else:
-                    self.logger.warning(f'invalid url [{url}]')
+                request = self.build_request(doc)
+                if request:
+                    yield request
         except Exception as e:
             self.logger.error(e)            
-        
-    def parse(self, response:Response):
+
+    def build_request(self, doc, task=None):
+        """Builds the Request for a sheet row; task is the work queue task it came from."""
+        url:str = doc['url']
+        if urlparse(url):
+            meta:dict ={
+                'jurisdiction': doc['jurisdiction'],
+                'title': doc['title'],
+                'description': doc.get('description', ''),
+                'doc_type': doc.get('doc_type', ''),
+                'tombstone': doc.get('tombstone', ''),
+                'language': doc.get('language', 'en')
+            }
+            if 'folders' in url:
+                folder_id = url.split('?')[0].rstrip('/').split('/')[-1]
+                meta["google_drive_folder_id"] = folder_id
+            # Validators are keyed by the sheet URL, which survives redirects in meta
+            meta['sheet_url'] = url
+            meta['handle_httpstatus_list'] = [304]
+            if task:
+                meta['task_id'] = task
+            return scrapy.Request(
+                url=url,
+                headers=self.validators.conditional_headers(url),
+                meta=meta,
+                errback=self.request_failed,
+                dont_filter=task is not None
+            )                    
+        else:
+            self.logger.warning(f'invalid url [{url}]')
+            return None
+
+    def request_failed(self, failure):
+        self.logger.error(f"Request failed: {failure.request.url}: {failure.getErrorMessage()}")
+        self.parse_finished(failure.request.meta, success=False)
+
+    def task_key(self, meta):
+        return meta.get('task_id') if self.work_queue else meta.get('sheet_url')
+
+    def task_state(self, task, meta):
+        return self.open_tasks.setdefault(task, {
+            'items': 0, 'failed': False, 'parsed': False, 'sheet_url': meta.get('sheet_url')
+        })
+
+    def track_item(self, meta, item):
+        # The task is finished once the pipeline has stored each of its items
+        task = self.task_key(meta)
+        if task:
+            item['task_id'] = task
+            self.task_state(task, meta)['items'] += 1
+
+    def parse_finished(self, meta, success):
+        task = self.task_key(meta)
+        if task:
+            state = self.task_state(task, meta)
+            state['failed'] = state['failed'] or not success
+            state['parsed'] = True
+            self.maybe_finish_task(task)
+
+    def item_stored(self, item, success):
+        """Called by the upload pipeline for each item of a task."""
+        state = self.open_tasks.get(item['task_id'])
+        if state is None:
+            return
+        state['items'] -= 1
+        state['failed'] = state['failed'] or not success
+        self.maybe_finish_task(item['task_id'])
+
+    def maybe_finish_task(self, task):
+        state = self.open_tasks[task]
+        if state['parsed'] and state['items'] <= 0:
+            del self.open_tasks[task]
+            if state['failed'] and state['sheet_url']:
+                self.failed_rows.add(state['sheet_url'])
+            if self.work_queue:
+                self.finish_task(task, success=not state['failed'])
+
+    def finish_task(self, task, success):
+        method = self.work_queue.ack if success else self.work_queue.nack
+        deferred = self.call_queue(method, task, self.worker_id)
+        deferred.addErrback(lambda failure: self.logger.error(f"Updating work queue task {task} failed: {failure.getErrorMessage()}"))
+
+    async def parse(self, response:Response):
         self.logger.info(f"Parsing {response.url}")                
+        success = False
+        items = []
+        # Drive files of a folder that failed to download; the row fails, so it is retried
+        failed_files = []
         try:           
             # Check if the response has Google Drive files
             if 'google_drive_folder' in response.meta:
-                    items = self._download_drive_folder(response)
-                    for item in items:
-                        yield item
+                    items, failed_files = await maybe_deferred_to_future(self._download_drive_folder(response))
             elif 'google_drive_file' in response.meta:
                 file_id = response.meta['google_drive_file']
-                item = self._download_to_item(response, file_id)
-                yield item
+                items = [await maybe_deferred_to_future(self._defer_download(response, file_id))]
+            elif response.status == 304:
+                items = [self.build_unchanged_item(response)]
             else:
+                # Large bodies were written to a temp file by the download handler
+                content_path = response.meta.get('spooled_body')
+                content = None if content_path else response.body
                 # Rename files based on MIME type with unique name check
-                mime_type = self.detect_mime(response.body)
+                mime_type = self.detect_mime(read_head(content_path) if content_path else content)
                 request:scrapy.Request = response.request
                 item = self.build_item(
                     response.url,
                     request.url,
-                    response.body,
+                    content,
                     response.meta['title'],
                     response.meta['description'],
                     response.meta['jurisdiction'],
                     response.meta['doc_type'],
                     response.meta['tombstone'],
                     response.meta['language'],
-                    mime_type
+                    mime_type,
+                    content_path
                 )
+                item['sheet_url'] = response.meta.get('sheet_url')
+                item['etag'] = response.headers.get('ETag', b'').decode('latin-1') or None
+                item['last_modified'] = response.headers.get('Last-Modified', b'').decode('latin-1') or None
+                items = [item]
+            for item in items:
+                self.track_item(response.meta, item)
                 yield item
+            if failed_files:
+                self.logger.warning(f"{len(failed_files)} Drive files of {response.url} failed; the row will be retried")
+            success = not failed_files
         except Exception as e:
             self.logger.error(f"Error parsing {response.url}: {e}")
             self.logger.error("Stack trace:\n%s", traceback.format_exc())
+        finally:
+            self.parse_finished(response.meta, success)
 
-    def build_item(self, url, pi_url, content, title, description, jurisdiction, doc_type, tombstone, language, mime_type):
+    def build_item(self, url, pi_url, content, title, description, jurisdiction, doc_type, tombstone, language, mime_type,
+                   content_path=None):
         item = PageContentItem()
         item['source_url'] = url
         item['pi_url'] = pi_url
-        item['content'] = content  # raw content
+        item['content'] = content  # raw content, or None when it is in content_path
+        item['content_path'] = content_path
         item['title'] = title
         item['description'] = description
         item['jurisdiction'] = jurisdiction
@@ -117,8 +303,36 @@ class LegisSpider(scrapy.Spider):
         item['mime_type'] = mime_type
         return item
 
+    def build_unchanged_item(self, response:Response):
+        # Not modified since the last crawl: point at the object we already stored
+        entry = self.validators.get(response.meta['sheet_url'])
+        self.logger.info(f"Unchanged since last crawl: {response.url}")
+        item = self.build_item(
+            response.url,
+            response.request.url,
+            b'',
+            response.meta['title'],
+            response.meta['description'],
+            response.meta['jurisdiction'],
+            response.meta['doc_type'],
+            response.meta['tombstone'],
+            response.meta['language'],
+            None
+        )
+        item['sheet_url'] = response.meta['sheet_url']
+        item['unchanged'] = True
+        item['existing_key'] = entry['s3_key']
+        return item
+
+    def closed(self, reason):
+        # Runs after the pipelines have finished, so every upload is recorded
+        self.validators.save()
+        if self.work_queue:
+            self.work_queue.save_stats(self.worker_id, self.crawler.stats.get_stats())
+
     def detect_mime(self, buffer):
-        return self.mimeDetector.from_buffer(buffer)
+        # The first few KB identify the type; scanning a whole large document is slow
+        return self.mimeDetector.from_buffer(buffer[:SNIFF_BYTES])
     
     def put_object(self, bucket_name, object_name, body, metadata=None):
         # Upload the data
@@ -130,40 +344,90 @@ class LegisSpider(scrapy.Spider):
         payload = response['Body'].read()
         return json.loads(payload)
     
-    def _download_file_content(self, request):
-        # Download file content using Google Drive API
-        buffer = BytesIO()
-        downloader = MediaIoBaseDownload(buffer, request)
+    @property
+    def spool_dir(self):
+        # The crawl's spool directory, which the download handler removes when the crawl ends
+        return getattr(getattr(self, 'crawler', None), 'spool_dir', None)
 
-        done = False
-        while not done:
-            status, done = downloader.next_chunk()
+    def _download_file_content(self, request):
+        """
+        Downloads file content using Google Drive API. Returns (content, None), or
+        (None, path) when the file was big enough to be spooled to a temp file.
+        """
+        spool = BodySpool(self.spool_threshold, self.spool_dir)
+        try:
+            downloader = MediaIoBaseDownload(spool, request)
 
-        buffer.seek(0)
-        return buffer.read()
+            done = False
+            while not done:
+                status, done = downloader.next_chunk()
+        except Exception:
+            spool.discard()
+            raise
+        content, path = spool.finish()
+        return (None, path) if path else (content, None)
     
     def _build_file_request(self, file_id):
         # Build a request for a file from Google Drive API
         request = self.service.files().get_media(fileId=file_id)
         return request
     
+    def _defer_download(self, response:scrapy.http.Response, file_id, file=None):
+        # Imported here so that loading the spider doesn't install the default reactor
+        from twisted.internet import reactor
+        return threads.deferToThreadPool(reactor, self.drive_pool, self._download_to_item, response, file_id, file)
+
+    @defer.inlineCallbacks
     def _download_drive_folder(self, response:scrapy.http.Response):
-        files = response.meta['google_drive_files']
-        items = List[item]
-        # For each file, create a request to download the file content
-        for file in files:            
-            file_id = file['id']
-            item = self._download_to_item(response, file_id)
-            items.append(item)
-        return items
-
-    def _download_to_item(self, response:scrapy.http.Response, file_id):
+        """Downloads every file of a Drive folder. Returns (items, IDs of the files that failed)."""
+        files = response.meta['google_drive_folder']
+        # Download all the files in the folder at once, bounded by the Drive pool
+        results = yield defer.DeferredList(
+            [self._defer_download(response, file['id'], file) for file in files],
+            consumeErrors=True
+        )
+        items = []
+        failed = []
+        for file, (success, result) in zip(files, results):
+            if success:
+                items.append(result)
+            else:
+                self.logger.error(f"Error downloading Drive file {file['id']} from {response.url}: {result.getErrorMessage()}")
+                failed.append(file['id'])
+        if failed:
+            self.crawler.stats.inc_value('google_drive/failed_files', len(failed))
+        return items, failed
+
+    def _download_to_item(self, response:scrapy.http.Response, file_id, file=None):
+        # Runs on the Drive pool, never on the reactor thread
+        # Folder listings already carry the link, type and modifiedTime; only single files need a lookup
+        if not file or 'webViewLink' not in file:
+            file = self.service.files().get(
+                    fileId=file_id,
+                    fields='webViewLink, mimeType, modifiedTime'
+                ).execute()
+        modified_time = file.get('modifiedTime')
+        existing_key = self.validators.unchanged_drive_file(file_id, modified_time)
+        if existing_key:
+            # Not modified since we stored it: point at the stored object instead of downloading
+            self.logger.info(f"Unchanged since last crawl: Drive file {file_id}")
+            item = self.build_item(
+                    file.get('webViewLink'),
+                    response.request.url,
+                    b'',
+                    response.meta['title'],
+                    response.meta['description'],
+                    response.meta['jurisdiction'],
+                    response.meta['doc_type'],
+                    response.meta['tombstone'],
+                    response.meta['language'],
+                    file.get("mimeType")
+                )
+            item['unchanged'] = True
+            item['existing_key'] = existing_key
+            return item
         request = self._build_file_request(file_id)
-        content = self._download_file_content(request)
-        file = self.service.files().get(
-                fileId=file_id,
-                fields='webViewLink'
-            ).execute()
+        content, content_path = self._download_file_content(request)
         shareable_link = file.get('webViewLink')
         item = self.build_item(
                 shareable_link,
@@ -175,7 +439,10 @@ class LegisSpider(scrapy.Spider):
                 response.meta['doc_type'],
                 response.meta['tombstone'],
                 response.meta['language'],
-                file.get("mimeType")
+                file.get("mimeType"),
+                content_path
             )
+        item['drive_file_id'] = file_id
+        item['modified_time'] = modified_time
         return item
     
\ No newline at end of file
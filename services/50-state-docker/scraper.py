@@ -7,9 +7,29 @@ from scrapy.crawler import CrawlerProcess
 from scrapy.utils.project import get_project_settings
 from scrapy.utils.log import configure_logging
 from scrape.spiders.legis_50_state import LegisSpider
+import argparse
 import json
+import os
+import time
+from sheet_change_feed import SheetChangeFeed
+from work_queue import default_worker_id, open_work_queue
 
-def scraper():
+# How often a producer checks whether the workers have drained its job
+PRODUCER_POLL_SECONDS = 30
+
+def scraper(full=False, seed=False, sources=None, role='standalone', work_queue_url=None, job_folder=None):
+    """
+    Crawl the sheet rows that are new or changed since the last successful run.
+
+    :param full: Crawl every row, ignoring the saved snapshots.
+    :param seed: Only save snapshots of the sheets as they are now, without crawling.
+    :param sources: Names from SHEET_SOURCES to read; all of them if None.
+    :param role: 'standalone' reads the sheets and crawls them. 'producer' reads the sheets
+        into the work queue for job_folder, and any number of 'worker' containers crawl it;
+        the producer waits for the job to drain before saving the sheet snapshots.
+    :param work_queue_url: Work queue for producer and worker roles, see open_work_queue.
+    :param job_folder: Job to work on; workers need the producer's job folder.
+    """
     # Set logging level for boto3 and botocore
     logging.getLogger('boto3').setLevel(logging.INFO)
     logging.getLogger('botocore').setLevel(logging.INFO)
@@ -65,13 +85,37 @@ def scraper():
     legis_file = '50_state_legis.json'
     
     try:
-        job_folder = datetime.now().strftime("%Y-%m-%d_%H.%M.%S")
+        if role == 'worker':
+            return crawl_work_queue(scrapy_settings, s3_client, bucket_name, job_folder, work_queue_url, log_file)
+
+        job_folder = job_folder or datetime.now().strftime("%Y-%m-%d_%H.%M.%S")
         ## Get urls from sheet and write them to file
         s3_object_key = f'{job_folder}/{legis_file}'
         
-        json_data = gsheet_to_json()
+        change_feed = SheetChangeFeed(s3_client, bucket_name, full=full, logger=logger)
+        json_data, row_count = gsheet_to_json(change_feed, sources)
+        if seed:
+            change_feed.commit()
+            logger.info("Saved sheet snapshots without crawling.")
+            return 0
+        if row_count == 0:
+            logger.info("No new or changed rows, nothing to crawl.")
+            change_feed.commit()
+            return 0
         s3_client.put_object(Bucket=bucket_name, Key=s3_object_key, Body=json_data)
-        logger.info(f"Data uploaded to '{bucket_name}/{s3_object_key}' successfully.")
+        logger.info(f"Data uploaded to '{bucket_name}/{s3_object_key}' successfully ({row_count} rows).")
+
+        if role == 'producer':
+            work_queue = open_work_queue(work_queue_url, job_folder)
+            added = work_queue.put_many(json.loads(json_data))
+            logger.info(f"Queued {added} rows for job {job_folder}; start workers with JOB_FOLDER={job_folder}")
+            # The rows only count as crawled once the workers are done with them
+            while not work_queue.is_drained():
+                time.sleep(PRODUCER_POLL_SECONDS)
+            failed_urls = [doc['url'] for doc in work_queue.failed_docs()]
+            logger.info(f"Job {job_folder} drained, queue: {work_queue.counts()}")
+            change_feed.commit(failed_urls)
+            return 0
                 
         ## Crawl and write 
         # Initialize a Scrapy CrawlerProcess with your project's settings
@@ -81,9 +125,18 @@ def scraper():
         scrapy_settings.set('BUCKET_NAME', bucket_name)
         process = CrawlerProcess(scrapy_settings)    
         # Schedule the spider to run
-        process.crawl(LegisSpider, legis_file=legis_file, job_folder=job_folder)
+        crawler = process.create_crawler(LegisSpider)
+        process.crawl(crawler, legis_file=legis_file, job_folder=job_folder)
         # Start the crawling process (it will block here until the spider is done)
         process.start()
+        # Only mark the rows as crawled once the crawl has finished, and leave out the
+        # rows whose documents weren't stored so the next run retries them
+        if crawler.spider and crawler.stats.get_value('finish_reason') == 'finished':
+            if crawler.spider.failed_rows:
+                logger.info(f"{len(crawler.spider.failed_rows)} rows failed and will be crawled again next run")
+            change_feed.commit(crawler.spider.failed_rows)
+        else:
+            logger.warning("The crawl did not finish, so the sheet snapshots were not saved")
         
         # upload log to s3 for posterity
         s3_client.upload_file(log_file, bucket_name, f'{job_folder}/{log_file}')
@@ -92,7 +145,60 @@ def scraper():
         return 1        
     return 0
 
-def gsheet_to_json():
+def crawl_work_queue(scrapy_settings, s3_client, bucket_name, job_folder, work_queue_url, log_file):
+    """
+    Crawl rows leased from the job's work queue until it is drained. The last worker to
+    finish writes the stats of every worker to <job_folder>/job_stats.json.
+    """
+    logger = logging.getLogger('scraper')
+    if not job_folder or not work_queue_url:
+        raise ValueError("Workers need JOB_FOLDER and WORK_QUEUE_URL")
+    worker_id = default_worker_id()
+    scrapy_settings.set('JOB_FOLDER', job_folder)
+    scrapy_settings.set('BUCKET_NAME', bucket_name)
+    process = CrawlerProcess(scrapy_settings)
+    process.crawl(LegisSpider, job_folder=job_folder, work_queue_url=work_queue_url, worker_id=worker_id)
+    process.start()
+
+    work_queue = open_work_queue(work_queue_url, job_folder)
+    logger.info(f"Worker {worker_id} done, queue: {work_queue.counts()}")
+    if work_queue.is_drained():
+        summary = {'job_folder': job_folder, 'tasks': work_queue.counts(), 'stats': work_queue.merged_stats()}
+        s3_client.put_object(
+            Bucket=bucket_name,
+            Key=f'{job_folder}/job_stats.json',
+            Body=json.dumps(summary, indent=4, default=str)
+        )
+        logger.info(f"Job {job_folder} complete, summary written to '{bucket_name}/{job_folder}/job_stats.json'")
+    s3_client.upload_file(log_file, bucket_name, f'{job_folder}/scraper-{worker_id}.log')
+    return 0
+
+# Worksheets to crawl. Rows are normalized in wanted_fields order: jurisdiction, title,
+# description, url, doc_type, tombstone, language. Only rows that are new or changed
+# since the last successful crawl are emitted, see SheetChangeFeed.
+SHEET_SOURCES = [
+    {
+        'name': 'colorado_guidance',
+        'sheet_id': '1Iey3LEPm9rZYMZ0dSkPnL9IN7vYCbnwkBLlogJarKBs',
+        'worksheet': 'support_docs',
+        'wanted_fields': ['jurisdiction', 'page_title', 'link_title', 'pdf_link', 'doc_type', 'tombstone', 'language'],
+        'title_suffix': '| Colorado Department of Public Health and Environment',
+    },
+    {
+        'name': '50_state',
+        'sheet_id': '1pvqmNPP_22wvKdiCYFqcj1z55Z3lgZOX0nDDHhmmIZg',
+        'worksheet': 'Individual doc links',
+        'wanted_fields': ['State', 'Regulation Name', 'Description', 'Link', 'doc_type', 'tombstone', 'language'],
+    },
+    {
+        'name': 'carb',
+        'sheet_id': '1pvqmNPP_22wvKdiCYFqcj1z55Z3lgZOX0nDDHhmmIZg',
+        'worksheet': 'CARB Current Air District Rule Data',
+        'wanted_fields': ['Air District Name', 'Regulation', 'Rules', 'Regulatory Text', 'doc_type', 'tombstone', 'language'],
+    },
+]
+
+def gsheet_to_json(change_feed, sources=None):
         logger = logging.getLogger('scraper')
 
         # Path to your service account credentials JSON file
@@ -103,68 +209,24 @@ def gsheet_to_json():
         gspread_map = GsheetArrayMap(creds_file)
         # Retrieve data
         normalized_result = []
-        
-        # Colorado guidance
-        guidance = True
-        if (guidance):
-            logger.info("Reading Colorado guidance")        
-            sheet_url = get_sheet_url('1Iey3LEPm9rZYMZ0dSkPnL9IN7vYCbnwkBLlogJarKBs')
-            worksheet_name = 'support_docs'
-            wanted_fields = ['jurisdiction', 'page_title', 'link_title', 'pdf_link', 'doc_type', 'tombstone', 'language']        
-            docs = gspread_map.get_fields(sheet_url, wanted_fields, worksheet_name)
-            current_doc = 2
-            start_doc = 627 # set to start doc in guidance sheet
-            end_doc = -1
-            for doc in docs:       
-                if (current_doc >= start_doc):
-                    if (end_doc != -1 and current_doc > end_doc):
-                        break
-                    if 'drive' in wanted_fields[3]:
-                        break
-                    title:str = doc[wanted_fields[1]]
-                    # hack
-                    doc[wanted_fields[1]] = title.replace("| Colorado Department of Public Health and Environment", "").strip()
-                    normalized_result.append((normalize(wanted_fields, doc)))
-                current_doc += 1
-                
-        # 50 states
-        FiddyState = False
-        if FiddyState:
-            logger.info("Reading 50 state")
-            sheet_url = get_sheet_url('1pvqmNPP_22wvKdiCYFqcj1z55Z3lgZOX0nDDHhmmIZg')
-            worksheet_name = 'Individual doc links'
-            wanted_fields = ['State', 'Regulation Name', 'Description', 'Link', 'doc_type', 'tombstone', 'language']
-            docs = gspread_map.get_fields(sheet_url, wanted_fields, worksheet_name)
-            current_doc = 2
-            start_doc = 6079 # set to start doc in guidance sheet
-            end_doc = 6128 # -1 for to the end
-            for doc in docs:
-                if (current_doc >= start_doc):
-                    if (end_doc != -1 and current_doc > end_doc):
-                        break
-                    normalized_result.append((normalize(wanted_fields, doc)))
-                current_doc += 1
-
-        # CARB            
-        carb = False
-        current_doc = 2
-        start_doc = 418 # set to start doc in guidance sheet
-        end_doc = -1
-        if carb:
-            logger.info("Reading CARB")
-            sheet_url = get_sheet_url('1pvqmNPP_22wvKdiCYFqcj1z55Z3lgZOX0nDDHhmmIZg')
-            worksheet_name = 'CARB Current Air District Rule Data'
-            wanted_fields = ['Air District Name', 'Regulation', 'Rules', 'Regulatory Text', 'doc_type', 'tombstone', 'language']
-            docs = gspread_map.get_fields(sheet_url, wanted_fields, worksheet_name) 
+
+        for source in SHEET_SOURCES:
+            if sources and source['name'] not in sources:
+                continue
+            logger.info(f"Reading {source['name']}")
+            sheet_url = get_sheet_url(source['sheet_id'])
+            wanted_fields = source['wanted_fields']
+            docs = gspread_map.get_fields(sheet_url, wanted_fields, source['worksheet'])
+            rows = []
             for doc in docs:
-                if (current_doc >= start_doc):
-                    if (end_doc != -1 and current_doc > end_doc):
-                        break
-                    normalized_result.append((normalize(wanted_fields, doc)))
-                current_doc += 1
-                
+                if source.get('title_suffix'):
+                    title: str = doc[wanted_fields[1]]
+                    doc[wanted_fields[1]] = title.replace(source['title_suffix'], "").strip()
+                rows.append(normalize(wanted_fields, doc))
+            normalized_result.extend(change_feed.changed_rows(source['name'], rows))
+
         # Convert the list to JSON
-        return json.dumps(normalized_result, indent=4)
+        return json.dumps(normalized_result, indent=4), len(normalized_result)
 
 def normalize(wanted_fields, doc):
     return {
@@ -184,5 +246,27 @@ def jurisdiction_filter(jurisdiction):
     if jurisdiction != 'California (SCAQMD)':
         return False
     return True
+def parse_args():
+    parser = argparse.ArgumentParser(description='Crawl the documents linked from the source sheets')
+    parser.add_argument('--full', action='store_true',
+                        default=os.environ.get('SCRAPER_FULL_CRAWL', '').lower() in ('1', 'true', 'yes'),
+                        help='Crawl every row instead of only new or changed ones (or set SCRAPER_FULL_CRAWL=1)')
+    parser.add_argument('--seed', action='store_true',
+                        help='Record the current sheets as crawled without crawling')
+    parser.add_argument('--sources', nargs='+', choices=[source['name'] for source in SHEET_SOURCES],
+                        help='Only read these sheet sources')
+    parser.add_argument('--role', choices=['standalone', 'producer', 'worker'],
+                        default=os.environ.get('SCRAPER_ROLE', 'standalone'),
+                        help='standalone crawls by itself; a producer queues the rows that workers crawl (or set SCRAPER_ROLE)')
+    parser.add_argument('--work-queue', default=os.environ.get('WORK_QUEUE_URL'),
+                        help='sqlite:///path or redis://host:port/db (or set WORK_QUEUE_URL)')
+    parser.add_argument('--job-folder', default=os.environ.get('JOB_FOLDER'),
+                        help='Job folder for workers to crawl (or set JOB_FOLDER)')
+    return parser.parse_args()
+
 if __name__ == '__main__':
-    scraper()
+    args = parse_args()
+    if args.role != 'standalone' and not args.work_queue:
+        raise SystemExit("--role producer/worker needs --work-queue or WORK_QUEUE_URL")
+    scraper(full=args.full, seed=args.seed, sources=args.sources, role=args.role,
+            work_queue_url=args.work_queue, job_folder=args.job_folder)
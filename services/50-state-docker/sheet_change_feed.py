@@ -0,0 +1,116 @@
+import hashlib
+import json
+import logging
+from datetime import datetime, timezone
+
+from botocore.exceptions import ClientError
+
+
+def row_hash(row):
+    """Content hash of a normalized row, independent of key order."""
+    canonical = json.dumps(row, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def row_keys(rows, key_field='url'):
+    """
+    Yields (key, row) pairs. Rows sharing a key get '#2', '#3', ... appended so
+    duplicate links in a sheet are tracked separately.
+    """
+    seen = {}
+    for row in rows:
+        key = str(row.get(key_field, '')).strip()
+        seen[key] = seen.get(key, 0) + 1
+        if seen[key] > 1:
+            key = f"{key}#{seen[key]}"
+        yield key, row
+
+
+class SheetChangeFeed:
+    """
+    Tracks which worksheet rows have already been crawled.
+
+    Each source's snapshot maps row key (the link) to the hash of the normalized row and
+    is kept in S3. changed_rows() returns only rows that are new or whose content changed
+    since the last snapshot; commit() saves the new snapshots once the crawl has finished,
+    so a failed run is retried in full the next time, and rows that failed are retried.
+    """
+    def __init__(self, s3_client, bucket_name, prefix='sheet_snapshots', full=False, logger=None):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.full = full
+        self.logger = logger or logging.getLogger(self.__class__.__name__)
+        self.pending = {}
+        # Per source: the last committed snapshot, and the URL of each row key
+        self.previous = {}
+        self.row_urls = {}
+
+    def snapshot_key(self, source_name):
+        return f"{self.prefix}/{source_name}.json"
+
+    def load_snapshot(self, source_name):
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket_name, Key=self.snapshot_key(source_name))
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+                return {}
+            raise
+        return json.loads(response['Body'].read()).get('rows', {})
+
+    def changed_rows(self, source_name, rows, key_field='url'):
+        """
+        Returns the rows that are new or modified since the last committed snapshot.
+        With full=True every row is returned, and the snapshot is still refreshed.
+        """
+        previous = {} if self.full else self.load_snapshot(source_name)
+        current = {}
+        urls = {}
+        changed = []
+        for key, row in row_keys(rows, key_field):
+            digest = row_hash(row)
+            current[key] = digest
+            urls[key] = str(row.get(key_field, '')).strip()
+            if previous.get(key) != digest:
+                changed.append(row)
+        added = sum(1 for key in current if key not in previous)
+        removed = sum(1 for key in previous if key not in current)
+        self.logger.info(
+            f"{source_name}: {len(current)} rows, {added} added, {len(changed) - added} changed, "
+            f"{removed} removed"
+        )
+        self.pending[source_name] = current
+        self.previous[source_name] = previous
+        self.row_urls[source_name] = urls
+        return changed
+
+    def commit(self, failed_urls=()):
+        """
+        Saves the snapshots computed by changed_rows(). Rows whose URL is in failed_urls keep
+        their previous hash, so they are crawled again by the next run.
+        """
+        failed_urls = {str(url).strip() for url in failed_urls}
+        for source_name, hashes in self.pending.items():
+            if failed_urls:
+                hashes = self.without_failed(source_name, hashes, failed_urls)
+            body = json.dumps({
+                'updated': datetime.now(timezone.utc).isoformat(),
+                'rows': hashes
+            }, indent=2)
+            self.s3_client.put_object(Bucket=self.bucket_name, Key=self.snapshot_key(source_name), Body=body)
+            self.logger.info(f"Saved snapshot of {len(hashes)} rows to '{self.bucket_name}/{self.snapshot_key(source_name)}'")
+        self.pending = {}
+        self.previous = {}
+        self.row_urls = {}
+
+    def without_failed(self, source_name, hashes, failed_urls):
+        previous = self.previous[source_name]
+        hashes = dict(hashes)
+        for key, url in self.row_urls[source_name].items():
+            if url not in failed_urls:
+                continue
+            if key in previous:
+                hashes[key] = previous[key]
+            else:
+                del hashes[key]
+        return hashes
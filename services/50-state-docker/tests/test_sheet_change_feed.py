@@ -0,0 +1,78 @@
+import boto3
+import pytest
+from moto import mock_aws
+
+from sheet_change_feed import SheetChangeFeed, row_keys
+
+BUCKET = 'snapshots'
+ROWS = [
+    {'url': 'https://example.com/a.pdf', 'title': 'A'},
+    {'url': 'https://example.com/b.pdf', 'title': 'B'},
+]
+
+
+@pytest.fixture
+def s3_client(monkeypatch):
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    with mock_aws():
+        client = boto3.client('s3')
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def crawl(s3_client, rows, failed_urls=(), full=False):
+    feed = SheetChangeFeed(s3_client, BUCKET, full=full)
+    changed = feed.changed_rows('sheet', rows)
+    feed.commit(failed_urls=failed_urls)
+    return changed
+
+
+def test_first_crawl_returns_every_row(s3_client):
+    assert crawl(s3_client, ROWS) == ROWS
+
+
+def test_unchanged_rows_are_skipped(s3_client):
+    crawl(s3_client, ROWS)
+    assert crawl(s3_client, ROWS) == []
+
+
+def test_new_and_modified_rows_are_returned(s3_client):
+    crawl(s3_client, ROWS)
+    modified = {'url': 'https://example.com/b.pdf', 'title': 'B, amended'}
+    added = {'url': 'https://example.com/c.pdf', 'title': 'C'}
+    assert crawl(s3_client, [ROWS[0], modified, added]) == [modified, added]
+
+
+def test_key_order_is_not_a_change(s3_client):
+    crawl(s3_client, ROWS)
+    reordered = [dict(reversed(list(row.items()))) for row in ROWS]
+    assert crawl(s3_client, reordered) == []
+
+
+def test_snapshot_is_only_saved_on_commit(s3_client):
+    SheetChangeFeed(s3_client, BUCKET).changed_rows('sheet', ROWS)
+    assert crawl(s3_client, ROWS) == ROWS
+
+
+def test_failed_rows_are_crawled_again(s3_client):
+    crawl(s3_client, ROWS, failed_urls=[ROWS[1]['url']])
+    assert crawl(s3_client, ROWS) == [ROWS[1]]
+    assert crawl(s3_client, ROWS) == []
+
+
+def test_failed_modified_row_keeps_its_previous_hash(s3_client):
+    crawl(s3_client, ROWS)
+    modified = {'url': 'https://example.com/b.pdf', 'title': 'B, amended'}
+    crawl(s3_client, [ROWS[0], modified], failed_urls=[modified['url']])
+    assert crawl(s3_client, [ROWS[0], modified]) == [modified]
+
+
+def test_full_returns_every_row_and_refreshes_the_snapshot(s3_client):
+    crawl(s3_client, ROWS[:1])
+    assert crawl(s3_client, ROWS, full=True) == ROWS
+    assert crawl(s3_client, ROWS) == []
+
+
+def test_duplicate_links_are_tracked_separately():
+    rows = [{'url': 'u'}, {'url': 'u '}, {'url': 'v'}]
+    assert [key for key, _ in row_keys(rows)] == ['u', 'u#2', 'v']
@@ -0,0 +1,131 @@
+import time
+
+import fakeredis
+import pytest
+import redis
+
+from work_queue import (UPLOAD_CLAIMED, UPLOAD_DONE, UPLOAD_IN_PROGRESS, RedisWorkQueue, SqliteWorkQueue,
+                        open_work_queue)
+
+DOCS = [{'url': f'https://example.com/{n}.pdf', 'title': str(n)} for n in range(3)]
+
+
+@pytest.fixture(params=['sqlite', 'redis'])
+def make_queue(request, tmp_path, monkeypatch):
+    """Opens queues for the same job, as separate workers would."""
+    if request.param == 'redis':
+        server = fakeredis.FakeServer()
+        monkeypatch.setattr(redis.Redis, 'from_url', lambda url, **kwargs: fakeredis.FakeRedis(server=server, **kwargs))
+        url = 'redis://localhost:6379/0'
+    else:
+        url = f"sqlite:///{tmp_path / 'queue.db'}"
+
+    def make(**kwargs):
+        return open_work_queue(url, 'job', **kwargs)
+    return make
+
+
+def test_opens_the_backend_of_the_url(make_queue, request):
+    expected = RedisWorkQueue if request.node.callspec.params['make_queue'] == 'redis' else SqliteWorkQueue
+    assert isinstance(make_queue(), expected)
+
+
+def test_put_many_adds_each_row_once(make_queue):
+    queue = make_queue()
+    assert queue.put_many(DOCS) == 3
+    assert queue.put_many(DOCS + [DOCS[0]]) == 0
+    assert queue.counts().get('pending') == 3
+
+
+def test_workers_lease_disjoint_tasks(make_queue):
+    first, second = make_queue(), make_queue()
+    first.put_many(DOCS)
+    leased = first.lease('w1', 2) + second.lease('w2', 2)
+    assert sorted(doc['title'] for _, doc in leased) == ['0', '1', '2']
+    assert first.lease('w1', 2) == []
+    assert not first.is_drained()
+
+
+def test_ack_drains_the_queue(make_queue):
+    queue = make_queue()
+    queue.put_many(DOCS)
+    for task, _ in queue.lease('w1', 3):
+        queue.ack(task, 'w1')
+    assert queue.is_drained()
+    assert queue.counts().get('done') == 3
+
+
+def test_only_the_owner_can_ack(make_queue):
+    queue = make_queue()
+    queue.put_many(DOCS[:1])
+    (task, _), = queue.lease('w1', 1)
+    queue.ack(task, 'w2')
+    assert not queue.is_drained()
+
+
+def test_nack_requeues_then_fails_after_max_attempts(make_queue):
+    queue = make_queue(max_attempts=2)
+    queue.put_many(DOCS[:1])
+    (task, _), = queue.lease('w1', 1)
+    queue.nack(task, 'w1')
+    assert queue.failed_docs() == []
+    (again, _), = queue.lease('w2', 1)
+    assert again == task
+    queue.nack(task, 'w2')
+    assert queue.lease('w1', 1) == []
+    assert queue.is_drained()
+    assert queue.failed_docs() == DOCS[:1]
+    assert queue.counts().get('failed') == 1
+
+
+def test_expired_lease_goes_to_the_next_worker(make_queue):
+    queue = make_queue(lease_seconds=0.05)
+    queue.put_many(DOCS[:1])
+    (task, _), = queue.lease('w1', 1)
+    time.sleep(0.1)
+    (again, _), = queue.lease('w2', 1)
+    assert again == task
+    # The first worker lost the lease, so its ack doesn't count
+    queue.ack(task, 'w1')
+    assert not queue.is_drained()
+    queue.ack(task, 'w2')
+    assert queue.is_drained()
+
+
+def test_upload_claims(make_queue):
+    first, second = make_queue(), make_queue()
+    url = DOCS[0]['url']
+    assert first.begin_upload(url, 'w1') == UPLOAD_CLAIMED
+    assert second.begin_upload(url, 'w2') == UPLOAD_IN_PROGRESS
+    first.finish_upload(url, 'w1')
+    assert second.begin_upload(url, 'w2') == UPLOAD_DONE
+
+
+def test_released_upload_can_be_claimed_again(make_queue):
+    first, second = make_queue(), make_queue()
+    url = DOCS[0]['url']
+    assert first.begin_upload(url, 'w1') == UPLOAD_CLAIMED
+    # Only the claim's owner can release it
+    second.release_upload(url, 'w2')
+    assert second.begin_upload(url, 'w2') == UPLOAD_IN_PROGRESS
+    first.release_upload(url, 'w1')
+    assert second.begin_upload(url, 'w2') == UPLOAD_CLAIMED
+
+
+def test_expired_upload_claim_can_be_taken_over(make_queue):
+    first, second = make_queue(lease_seconds=1), make_queue(lease_seconds=1)
+    url = DOCS[0]['url']
+    assert first.begin_upload(url, 'w1') == UPLOAD_CLAIMED
+    time.sleep(1.1)
+    assert second.begin_upload(url, 'w2') == UPLOAD_CLAIMED
+
+
+def test_merged_stats(make_queue):
+    queue = make_queue()
+    queue.save_stats('w1', {'item_scraped_count': 2, 'finish_reason': 'finished'})
+    queue.save_stats('w2', {'item_scraped_count': 3, 'finish_reason': 'shutdown'})
+    assert queue.merged_stats() == {
+        'workers': 2,
+        'item_scraped_count': 5,
+        'finish_reason': {'w1': 'finished', 'w2': 'shutdown'},
+    }
@@ -0,0 +1,348 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import urlparse
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+# What begin_upload found: the claim is ours, another worker stored the URL, or another
+# worker holds an unexpired claim and may still succeed or give up
+UPLOAD_CLAIMED = 'claimed'
+UPLOAD_DONE = 'done'
+UPLOAD_IN_PROGRESS = 'in_progress'
+
+
+def task_id(doc):
+    """Stable id for a sheet row, so enqueueing the same rows twice adds them once."""
+    return hashlib.sha256(json.dumps(doc, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def merge_stats(all_stats):
+    """Sums the numeric crawl stats of every worker; other values are kept per worker."""
+    merged = {'workers': len(all_stats)}
+    for worker, stats in sorted(all_stats.items()):
+        for name, value in stats.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                merged[name] = merged.get(name, 0) + value
+            else:
+                merged.setdefault(name, {})
+                if isinstance(merged[name], dict):
+                    merged[name][worker] = value
+    return merged
+
+
+class SqliteWorkQueue:
+    """
+    Work queue for one crawl job, in a SQLite file.
+
+    Workers lease tasks for lease_seconds; a task whose lease runs out (its worker died)
+    is handed to the next worker that asks. Uploads are claimed per URL so each document
+    is uploaded once even when a task runs twice. All containers need the same file, so
+    this suits a shared volume or local testing; use RedisWorkQueue across hosts.
+    """
+    def __init__(self, path, job, lease_seconds=1800, max_attempts=3):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.job = job
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS tasks (
+                job TEXT, id TEXT, payload TEXT, state TEXT DEFAULT 'pending',
+                owner TEXT, lease_expires REAL, attempts INTEGER DEFAULT 0,
+                PRIMARY KEY (job, id));
+            CREATE TABLE IF NOT EXISTS uploads (
+                job TEXT, url TEXT, owner TEXT, state TEXT, expires REAL,
+                PRIMARY KEY (job, url));
+            CREATE TABLE IF NOT EXISTS stats (
+                job TEXT, worker TEXT, stats TEXT,
+                PRIMARY KEY (job, worker));
+        ''')
+
+    def _transaction(self, func):
+        # BEGIN IMMEDIATE takes the write lock up front, so concurrent workers serialize
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                result = func()
+                self.db.execute('COMMIT')
+                return result
+            except Exception:
+                self.db.execute('ROLLBACK')
+                raise
+
+    def put_many(self, docs):
+        """Enqueues sheet rows. Returns how many were new."""
+        rows = [(self.job, task_id(doc), json.dumps(doc)) for doc in docs]
+
+        def put():
+            before = self.db.total_changes
+            self.db.executemany('INSERT OR IGNORE INTO tasks (job, id, payload) VALUES (?, ?, ?)', rows)
+            return self.db.total_changes - before
+        return self._transaction(put)
+
+    def lease(self, worker, count):
+        """Leases up to count pending or expired tasks. Returns [(task_id, doc)]."""
+        def lease():
+            now = time.time()
+            tasks = self.db.execute(
+                "SELECT id, payload FROM tasks WHERE job = ? AND "
+                "(state = 'pending' OR (state = 'leased' AND lease_expires < ?)) LIMIT ?",
+                (self.job, now, count)
+            ).fetchall()
+            self.db.executemany(
+                "UPDATE tasks SET state = 'leased', owner = ?, lease_expires = ? WHERE job = ? AND id = ?",
+                [(worker, now + self.lease_seconds, self.job, task) for task, _ in tasks]
+            )
+            return [(task, json.loads(payload)) for task, payload in tasks]
+        return self._transaction(lease)
+
+    def ack(self, task, worker):
+        self._transaction(lambda: self.db.execute(
+            "UPDATE tasks SET state = 'done' WHERE job = ? AND id = ? AND owner = ?", (self.job, task, worker)
+        ))
+
+    def nack(self, task, worker):
+        """Returns a failed task to the queue, or marks it failed after max_attempts."""
+        self._transaction(lambda: self.db.execute(
+            "UPDATE tasks SET attempts = attempts + 1, owner = NULL, "
+            "state = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END "
+            "WHERE job = ? AND id = ? AND owner = ?",
+            (self.max_attempts, self.job, task, worker)
+        ))
+
+    def is_drained(self):
+        """True when no task is pending or leased."""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT COUNT(*) FROM tasks WHERE job = ? AND state IN ('pending', 'leased')", (self.job,)
+            ).fetchone()
+        return row[0] == 0
+
+    def counts(self):
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT state, COUNT(*) FROM tasks WHERE job = ? GROUP BY state", (self.job,)
+            ).fetchall()
+        return dict(rows)
+
+    def failed_docs(self):
+        """The rows that failed max_attempts times."""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT payload FROM tasks WHERE job = ? AND state = 'failed'", (self.job,)
+            ).fetchall()
+        return [json.loads(payload) for payload, in rows]
+
+    def begin_upload(self, url, worker):
+        """
+        Claims the upload of a URL. Returns UPLOAD_CLAIMED, UPLOAD_DONE if a worker has
+        uploaded it, or UPLOAD_IN_PROGRESS if one is uploading it and its claim hasn't expired.
+        """
+        def claim():
+            now = time.time()
+            row = self.db.execute(
+                'SELECT state, expires FROM uploads WHERE job = ? AND url = ?', (self.job, url)
+            ).fetchone()
+            if row and row[0] == 'done':
+                return UPLOAD_DONE
+            if row and row[1] > now:
+                return UPLOAD_IN_PROGRESS
+            self.db.execute(
+                "INSERT OR REPLACE INTO uploads (job, url, owner, state, expires) VALUES (?, ?, ?, 'started', ?)",
+                (self.job, url, worker, now + self.lease_seconds)
+            )
+            return UPLOAD_CLAIMED
+        return self._transaction(claim)
+
+    def finish_upload(self, url, worker):
+        self._transaction(lambda: self.db.execute(
+            "UPDATE uploads SET state = 'done' WHERE job = ? AND url = ? AND owner = ?", (self.job, url, worker)
+        ))
+
+    def release_upload(self, url, worker):
+        self._transaction(lambda: self.db.execute(
+            "DELETE FROM uploads WHERE job = ? AND url = ? AND owner = ? AND state = 'started'",
+            (self.job, url, worker)
+        ))
+
+    def save_stats(self, worker, stats):
+        body = json.dumps(stats, default=str)
+        self._transaction(lambda: self.db.execute(
+            'INSERT OR REPLACE INTO stats (job, worker, stats) VALUES (?, ?, ?)', (self.job, worker, body)
+        ))
+
+    def merged_stats(self):
+        with self.lock:
+            rows = self.db.execute('SELECT worker, stats FROM stats WHERE job = ?', (self.job,)).fetchall()
+        return merge_stats({worker: json.loads(stats) for worker, stats in rows})
+
+
+class RedisWorkQueue:
+    """
+    The SqliteWorkQueue interface on Redis, for workers on different hosts. Each operation
+    is one MULTI/EXEC transaction, so a worker dying halfway can't lose a task and other
+    workers never see it between states.
+    """
+    def __init__(self, url, job, lease_seconds=1800, max_attempts=3):
+        if redis is None:
+            raise RuntimeError("redis is required for redis:// work queues: pip install redis")
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.redis = redis.Redis.from_url(url, decode_responses=True)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.prefix = f"crawl:{job}:"
+
+    def key(self, name):
+        return self.prefix + name
+
+    def put_many(self, docs):
+        tasks = {}
+        for doc in docs:
+            tasks.setdefault(task_id(doc), json.dumps(doc))
+
+        def put(pipe):
+            ids = list(tasks)
+            existing = pipe.hmget(self.key('tasks'), ids) if ids else []
+            new = [task for task, payload in zip(ids, existing) if payload is None]
+            pipe.multi()
+            if new:
+                pipe.hset(self.key('tasks'), mapping={task: tasks[task] for task in new})
+                pipe.rpush(self.key('pending'), *new)
+            return len(new)
+        return self.transaction(put, 'tasks')
+
+    def lease(self, worker, count):
+        def lease(pipe):
+            now = time.time()
+            # Expired leases go first; only the transaction that commits hands them out
+            expired = pipe.zrangebyscore(self.key('leases'), 0, now)
+            taken = expired[:count]
+            pending = pipe.lrange(self.key('pending'), 0, count - len(taken) - 1) if len(taken) < count else []
+            taken += pending
+            payloads = pipe.hmget(self.key('tasks'), taken) if taken else []
+            pipe.multi()
+            if pending:
+                pipe.ltrim(self.key('pending'), len(pending), -1)
+            # Leases that expired beyond count are queued again for the next worker
+            for task in expired[count:]:
+                pipe.zrem(self.key('leases'), task)
+                pipe.rpush(self.key('pending'), task)
+            if taken:
+                pipe.zadd(self.key('leases'), {task: now + self.lease_seconds for task in taken})
+                pipe.hset(self.key('owners'), mapping={task: worker for task in taken})
+            return [(task, json.loads(payload)) for task, payload in zip(taken, payloads)]
+        return self.transaction(lease, 'leases', 'pending')
+
+    def ack(self, task, worker):
+        def ack(pipe):
+            owner = pipe.hget(self.key('owners'), task)
+            pipe.multi()
+            if owner == worker:
+                pipe.zrem(self.key('leases'), task)
+                pipe.sadd(self.key('done'), task)
+        self.transaction(ack, 'owners')
+
+    def nack(self, task, worker):
+        def nack(pipe):
+            if pipe.hget(self.key('owners'), task) != worker:
+                pipe.multi()
+                return
+            attempts = int(pipe.hget(self.key('attempts'), task) or 0) + 1
+            pipe.multi()
+            pipe.zrem(self.key('leases'), task)
+            pipe.hdel(self.key('owners'), task)
+            pipe.hset(self.key('attempts'), task, attempts)
+            if attempts >= self.max_attempts:
+                pipe.sadd(self.key('failed'), task)
+            else:
+                pipe.rpush(self.key('pending'), task)
+        self.transaction(nack, 'owners', 'attempts')
+
+    def transaction(self, func, *names):
+        """Runs func(pipe) as a MULTI/EXEC transaction watching the named keys, retrying on conflicts."""
+        return self.redis.transaction(func, *[self.key(name) for name in names], value_from_callable=True)
+
+    def is_drained(self):
+        # Read together, so a task moving between the two can't look like neither
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.llen(self.key('pending'))
+        pipe.zcard(self.key('leases'))
+        pending, leased = pipe.execute()
+        return pending == 0 and leased == 0
+
+    def counts(self):
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.llen(self.key('pending'))
+        pipe.zcard(self.key('leases'))
+        pipe.scard(self.key('done'))
+        pipe.scard(self.key('failed'))
+        return dict(zip(('pending', 'leased', 'done', 'failed'), pipe.execute()))
+
+    def failed_docs(self):
+        failed = list(self.redis.smembers(self.key('failed')))
+        if not failed:
+            return []
+        return [json.loads(payload) for payload in self.redis.hmget(self.key('tasks'), failed) if payload]
+
+    def upload_key(self, url):
+        return self.key('upload:' + hashlib.sha256(url.encode('utf-8')).hexdigest())
+
+    def begin_upload(self, url, worker):
+        key = self.upload_key(url)
+        while True:
+            # The claim expires on its own if the worker dies mid-upload
+            if self.redis.set(key, f'started:{worker}', nx=True, ex=self.lease_seconds):
+                return UPLOAD_CLAIMED
+            state = self.redis.get(key)
+            # None: the claim was released or expired just now, so try again
+            if state is not None:
+                return UPLOAD_DONE if state.startswith('done:') else UPLOAD_IN_PROGRESS
+
+    def finish_upload(self, url, worker):
+        self.redis.set(self.upload_key(url), f'done:{worker}')
+
+    def release_upload(self, url, worker):
+        key = self.upload_key(url)
+
+        def release(pipe):
+            state = pipe.get(key)
+            pipe.multi()
+            if state == f'started:{worker}':
+                pipe.delete(key)
+        self.redis.transaction(release, key)
+
+    def save_stats(self, worker, stats):
+        self.redis.hset(self.key('stats'), worker, json.dumps(stats, default=str))
+
+    def merged_stats(self):
+        all_stats = self.redis.hgetall(self.key('stats'))
+        return merge_stats({worker: json.loads(stats) for worker, stats in all_stats.items()})
+
+
+def open_work_queue(url, job, **kwargs):
+    """
+    Opens the work queue for a job from a URL:
+    sqlite:///path/to/queue.db (or sqlite:////abs/path) or redis://host:6379/0.
+    """
+    parsed = urlparse(url)
+    if parsed.scheme == 'sqlite':
+        path = parsed.path[1:] if parsed.path.startswith('/') else parsed.path
+        return SqliteWorkQueue(path or 'work_queue.db', job, **kwargs)
+    if parsed.scheme in ('redis', 'rediss'):
+        return RedisWorkQueue(url, job, **kwargs)
+    raise ValueError(f"Unsupported work queue URL: {url}")
+
+
+def default_worker_id():
+    return os.environ.get('WORKER_ID') or f"{os.uname().nodename}-{os.getpid()}"
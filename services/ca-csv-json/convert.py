@@ -1,77 +1,140 @@
+import argparse
 import csv
 import json
+import os
 import sys
 from datetime import datetime
 
-def csv_to_json(csv_file_path, json_file_path):
-    # List to store the data
-    data = []
-
-    # Read the CSV file
+DEFAULT_MAPPING = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mappings', 'carb.json')
+
+# Transforms a mapping field can apply to a column value, in order
+TRANSFORMS = {
+    'strip': lambda value: value.strip(),
+    'lower': lambda value: value.lower(),
+    'upper': lambda value: value.upper(),
+    'int': lambda value: int(value) if value.strip() else None,
+    'float': lambda value: float(value) if value.strip() else None,
+    # '6/15/1975 0:00:00' -> '6/15/1975'
+    'date_only': lambda value: value.split(' ')[0],
+}
+
+def load_mapping(mapping_path):
+    """
+    Load a mapping file describing how CSV rows become records.
+
+    Each entry in "fields" names an output field and takes its value from exactly one of:
+      "const":      a fixed value
+      "column":     a CSV column, optionally passed through "transforms" and
+                    replaced by "default" when empty
+      "row_number": a counter starting at the given value
+    """
+    with open(mapping_path, 'r') as mapping_file:
+        mapping = json.load(mapping_file)
+    for field in mapping['fields']:
+        sources = [source for source in ('const', 'column', 'row_number') if source in field]
+        if len(sources) != 1:
+            raise ValueError(f"Field '{field.get('name')}' needs exactly one of const, column or row_number")
+        for transform in field.get('transforms', []):
+            if transform not in TRANSFORMS:
+                raise ValueError(f"Field '{field['name']}' has unknown transform '{transform}'")
+    return mapping
+
+def map_row(fields, row, index):
+    """Build the output record for the index-th (0-based) CSV row."""
+    record = {}
+    for field in fields:
+        if 'const' in field:
+            value = field['const']
+        elif 'row_number' in field:
+            value = field['row_number'] + index
+        else:
+            value = row[field['column']]
+            for transform in field.get('transforms', []):
+                value = TRANSFORMS[transform](value)
+            if value in ('', None) and 'default' in field:
+                value = field['default']
+        record[field['name']] = value
+    return record
+
+def iter_records(csv_file, mapping):
+    """Check the CSV header against the mapping, then return a lazy iterator of records."""
+    reader = csv.DictReader(csv_file)
+    columns = {field['column'] for field in mapping['fields'] if 'column' in field}
+    missing = columns - set(reader.fieldnames or [])
+    if missing:
+        raise csv.Error(f"columns not found: {', '.join(sorted(missing))}")
+    return (map_row(mapping['fields'], row, index) for index, row in enumerate(reader))
+
+def write_json(records, json_file, metadata):
+    """
+    Write {"data": [...], "metadata": {...}} one record at a time, in the same
+    layout json.dump(indent=4) produces. Returns the record count.
+    """
+    count = 0
+    json_file.write('{\n    "data": [')
+    for record in records:
+        json_file.write(',\n' if count else '\n')
+        lines = json.dumps(record, indent=4).split('\n')
+        json_file.write('\n'.join('        ' + line for line in lines))
+        count += 1
+    json_file.write('\n    ]' if count else ']')
+    metadata = dict(record_count=count, **metadata)
+    lines = json.dumps(metadata, indent=4).split('\n')
+    json_file.write(',\n    "metadata": ' + '\n'.join([lines[0]] + ['    ' + line for line in lines[1:]]) + '\n}')
+    return count
+
+def write_jsonl(records, json_file):
+    """Write one record per line. Returns the record count."""
+    count = 0
+    for record in records:
+        json_file.write(json.dumps(record) + '\n')
+        count += 1
+    return count
+
+def csv_to_json(csv_file_path, json_file_path, mapping_path=DEFAULT_MAPPING, output_format=None):
+    mapping = load_mapping(mapping_path)
+    if output_format is None:
+        output_format = 'jsonl' if json_file_path.endswith('.jsonl') else 'json'
+
+    # Write next to the target and rename at the end, so a failed run leaves no partial output
+    tmp_path = f"{json_file_path}.tmp"
     try:
-        with open(csv_file_path, 'r') as csv_file:
-            print(f"Starting reader '{csv_file_path}'.")
-            csv_reader = csv.DictReader(csv_file)
-            print(f"Finished reader '{csv_file_path}'.")
-            n = 1
-            for row in csv_reader:
-                n = n + 1
-                # Add a new row
-                new_row = {
-                    "updated": "7/3/2024",
-                    "count_by_state": n,
-                    "State": "California",
-                    "epa_region": 9,
-                    "Regulation": row["Regulation"],
-                    "Description": row["Rules"],
-                    "Link": row["Regulatory Text"],
-                    "Timing": row["OriginalAdoptionDate"],
-                    "Addt. Notes 1": "",
-                    "Addt. Notes 2": "",
-                    "Tags": row["Pollutants"]
-                }
-                data.append(new_row)
-    except FileNotFoundError:
-        print(f"Error: CSV file '{csv_file_path}' not found.")
+        with open(csv_file_path, 'r', encoding=mapping.get('encoding', 'utf-8')) as csv_file:
+            print(f"Converting '{csv_file_path}' with mapping '{mapping_path}'.")
+            records = iter_records(csv_file, mapping)
+            with open(tmp_path, 'w') as json_file:
+                if output_format == 'jsonl':
+                    count = write_jsonl(records, json_file)
+                else:
+                    count = write_json(records, json_file, {
+                        "source_file": csv_file_path,
+                        "date_processed": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                    })
+        os.replace(tmp_path, json_file_path)
+    except FileNotFoundError as e:
+        print(f"Error: file '{e.filename}' not found.")
         sys.exit(1)
     except csv.Error as e:
         print(f"Error reading CSV file: {e}")
         sys.exit(1)
-
-    # Transform the data
-    transformed_data = {
-        "data": data,
-        "metadata": {
-            "record_count": len(data),
-            "source_file": csv_file_path,
-            "date_processed": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        }
-    }
-
-    # Write the transformed data to a JSON file
-    try:
-        with open(json_file_path, 'w') as json_file:
-            json.dump(transformed_data, json_file, indent=4)
-        print(f"JSON data has been written to {json_file_path}")
     except IOError:
         print(f"Error: Unable to write to file '{json_file_path}'.")
         sys.exit(1)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
-if __name__ == "__main__":
-
-
-
+    print(f"{count} records have been written to {json_file_path}")
+    return count
 
+def parse_args():
+    parser = argparse.ArgumentParser(description='Convert a rule export CSV to JSON using a field mapping')
+    parser.add_argument('input_csv', help='CSV file to convert')
+    parser.add_argument('output_json', help='Output file; a .jsonl extension selects JSON Lines')
+    parser.add_argument('--mapping', default=DEFAULT_MAPPING, help='Mapping file (default: mappings/carb.json)')
+    parser.add_argument('--format', choices=['json', 'jsonl'], help='Output format (default: from the output extension)')
+    return parser.parse_args()
 
-
-
-
-
-    if len(sys.argv) != 3:
-        print("Usage: python script.py <input_csv_file> <output_json_file>")
-        sys.exit(1)
-
-    input_csv = sys.argv[1]
-    output_json = sys.argv[2]
-
-    csv_to_json(input_csv, output_json)
\ No newline at end of file
+if __name__ == "__main__":
+    args = parse_args()
+    csv_to_json(args.input_csv, args.output_json, args.mapping, args.format)
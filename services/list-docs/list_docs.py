@@ -1,12 +1,27 @@
 #!/usr/bin/env python3
 
+import argparse
 import boto3
 import json
 import csv
 import os
 import logging
+import queue
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
+from botocore.config import Config
 from botocore.exceptions import ClientError
+from s3_lister import S3PrefixLister
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pa_csv
+    import pyarrow.json as pa_json
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
 
 # Configure logging
 logging.basicConfig(
@@ -20,8 +35,14 @@ logging.getLogger('urllib3').setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.WARNING)  # Explicitly set our logger to WARNING
 
-def process_json_object(s3_client, bucket, key, csv_writer):
-    """Process a single JSON object from S3 and write to CSV."""
+FIELDNAMES = ['jurisdiction', 'document_title', 'aq_type', 'pi_url']
+DEFAULT_BUCKETS = ['sbx-kendra-index', 'sbx-colorado-only']
+# Listing threads per bucket; listing pages are cheap next to the object fetches
+LISTER_WORKERS = 8
+_DONE = object()
+
+def process_json_object(s3_client, bucket, key):
+    """Fetch a single JSON object from S3 and return its CSV row, or None on error."""
     try:
         response = s3_client.get_object(Bucket=bucket, Key=key)
         content = json.loads(response['Body'].read().decode('utf-8'))
@@ -38,8 +59,8 @@ def process_json_object(s3_client, bucket, key, csv_writer):
             'pi_url': attributes.get('pi_url', 'N/A')
         }
         
-        csv_writer.writerow(row)
         logger.info(f"Successfully processed {key}")
+        return row
         
     except ClientError as e:
         logger.error(f"Error processing {key} in bucket {bucket}: {str(e)}")
@@ -47,58 +68,254 @@ def process_json_object(s3_client, bucket, key, csv_writer):
         logger.error(f"Error: {key} is not a valid JSON file")
     except Exception as e:
         logger.error(f"Unexpected error processing {key}: {str(e)}")
+    return None
 
-def traverse_bucket(s3_client, bucket_name, csv_writer):
-    """Recursively traverse all objects in an S3 bucket."""
+def traverse_bucket(lister, bucket_index, bucket_name, keys):
+    """List all JSON objects in an S3 bucket onto the shared key queue."""
     logger.info(f"Processing bucket: {bucket_name}")
     try:
-        paginator = s3_client.get_paginator('list_objects_v2')
-        for page in paginator.paginate(Bucket=bucket_name):
-            if 'Contents' not in page:
-                logger.warning(f"No contents found in bucket {bucket_name}")
-                continue
-                
-            for obj in page['Contents']:
-                key = obj['Key']
-                if key.endswith('.json'):
-                    logger.debug(f"Found JSON file: {key}")
-                    process_json_object(s3_client, bucket_name, key, csv_writer)
+        for key in lister.iter_keys(bucket_name, suffixes=['.json']):
+            logger.debug(f"Found JSON file: {key}")
+            keys.put((bucket_index, bucket_name, key))
                     
     except ClientError as e:
         logger.error(f"Error accessing bucket {bucket_name}: {str(e)}")
     except Exception as e:
         logger.error(f"Unexpected error with bucket {bucket_name}: {str(e)}")
+    finally:
+        keys.put(_DONE)
+
+def iter_rows(s3_client, buckets, workers=32, order='completion'):
+    """
+    Yield a row for every JSON object in the given buckets.
+
+    All buckets are listed at once by producer threads, and objects are fetched by a
+    bounded thread pool while listing continues. With order='completion' rows are
+    yielded as soon as they are fetched, so memory stays flat and the writer keeps up
+    with the listing. With order='stable' every row is buffered until listing ends and
+    then yielded by bucket then key, so repeated exports are diffable.
+    """
+    lister = S3PrefixLister(s3_client, max_workers=LISTER_WORKERS)
+    keys = queue.Queue(maxsize=workers * 4)
+    producers = [
+        threading.Thread(target=traverse_bucket, args=(lister, index, bucket, keys), daemon=True)
+        for index, bucket in enumerate(buckets)
+    ]
+    for producer in producers:
+        producer.start()
+
+    buffered = []
+
+    def fetch(bucket_index, bucket, key):
+        return (bucket_index, key), process_json_object(s3_client, bucket, key)
+
+    def collect(done):
+        for future in done:
+            sort_key, row = future.result()
+            if row is None:
+                continue
+            if order == 'stable':
+                buffered.append((sort_key, row))
+            else:
+                yield row
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        remaining = len(producers)
+        while remaining:
+            item = keys.get()
+            if item is _DONE:
+                remaining -= 1
+                continue
+            pending.add(executor.submit(fetch, *item))
+            # Keep the fetch queue bounded and hand back finished rows as we go
+            if len(pending) >= workers * 4:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                yield from collect(done)
+        done, _ = wait(pending)
+        yield from collect(done)
+
+    buffered.sort(key=lambda item: item[0])
+    for _, row in buffered:
+        yield row
+
+class CsvRowWriter:
+    def __init__(self, path):
+        self.file = open(path, 'w', newline='')
+        self.writer = csv.DictWriter(self.file, fieldnames=FIELDNAMES)
+        self.writer.writeheader()
+
+    def write(self, row):
+        self.writer.writerow(string_row(row))
+
+    def close(self):
+        self.file.close()
+
+class JsonlRowWriter:
+    def __init__(self, path):
+        self.file = open(path, 'w', encoding='utf-8')
+
+    def write(self, row):
+        self.file.write(json.dumps(string_row(row), ensure_ascii=False) + '\n')
+
+    def close(self):
+        self.file.close()
+
+class ParquetRowWriter:
+    """Writes rows to Parquet one row group at a time, so only a row group is held in memory."""
+    def __init__(self, path, row_group_size=50000):
+        require_pyarrow()
+        self.schema = pa.schema([(name, pa.string()) for name in FIELDNAMES])
+        self.writer = pq.ParquetWriter(path, self.schema)
+        self.row_group_size = row_group_size
+        self.rows = []
+
+    def write(self, row):
+        self.rows.append(string_row(row))
+        if len(self.rows) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.writer.write_table(pa.Table.from_pylist(self.rows, schema=self.schema))
+            self.rows = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+def string_row(row):
+    """
+    The row with every column as a string, the schema read_table expects of every format;
+    metadata values can be numbers, lists or objects.
+    """
+    return {name: to_string(row.get(name)) for name in FIELDNAMES}
+
+def to_string(value):
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, ensure_ascii=False)
+    return str(value)
+
+ROW_WRITERS = {
+    'csv': CsvRowWriter,
+    'jsonl': JsonlRowWriter,
+    'parquet': ParquetRowWriter,
+}
+
+def require_pyarrow():
+    if pa is None:
+        raise RuntimeError("pyarrow is required for parquet output and reports: pip install pyarrow")
+
+def read_table(path, fmt=None):
+    """
+    Load an export written by this script as an Arrow table.
+    The format is taken from the file extension unless given.
+    """
+    require_pyarrow()
+    fmt = fmt or os.path.splitext(path)[1].lstrip('.')
+    if fmt == 'parquet':
+        return pq.read_table(path)
+    schema = pa.schema([(name, pa.string()) for name in FIELDNAMES])
+    if fmt == 'jsonl':
+        return pa_json.read_json(path, parse_options=pa_json.ParseOptions(explicit_schema=schema))
+    # Read every column as text so values like '2023' stay strings
+    return pa_csv.read_csv(path, convert_options=pa_csv.ConvertOptions(column_types=schema))
+
+def count_by(table, keys):
+    """Group rows by the key columns and count them into a 'documents' column."""
+    counts = table.group_by(keys).aggregate([([], 'count_all')])
+    return counts.rename_columns(['documents' if name == 'count_all' else name for name in counts.column_names])
+
+def missing_values(column):
+    # CSV can't tell None from '', so both count as missing whatever the format
+    return pc.or_(pc.is_null(column), pc.fill_null(pc.is_in(column, value_set=pa.array(['', 'N/A'])), False))
+
+def build_report(table):
+    """
+    Aggregate an export: document counts by jurisdiction and aq_type, missing-field
+    rates, and pi_url values shared by more than one document.
+    """
+    total = table.num_rows
+    counts = count_by(table, ['jurisdiction', 'aq_type'])
+    counts = counts.sort_by([('jurisdiction', 'ascending'), ('aq_type', 'ascending')])
+
+    missing = {}
+    for name in FIELDNAMES:
+        is_missing = missing_values(table[name])
+        missing_count = pc.sum(pc.cast(is_missing, pa.int64())).as_py() or 0
+        missing[name] = (missing_count, missing_count / total if total else 0.0)
+
+    urls = table.filter(pc.invert(missing_values(table['pi_url'])))
+    duplicates = count_by(urls, ['pi_url'])
+    duplicates = duplicates.filter(pc.greater(duplicates['documents'], 1))
+    duplicates = duplicates.sort_by([('documents', 'descending'), ('pi_url', 'ascending')])
+
+    return {'total': total, 'counts': counts, 'missing': missing, 'duplicates': duplicates}
+
+def print_report(report):
+    print(f"Documents: {report['total']}")
+    print("\nDocuments by jurisdiction and aq_type:")
+    for row in report['counts'].to_pylist():
+        print(f"  {row['jurisdiction']} | {row['aq_type']}: {row['documents']}")
+    print("\nMissing fields:")
+    for name, (count, rate) in report['missing'].items():
+        print(f"  {name}: {count} ({rate:.1%})")
+    duplicates = report['duplicates']
+    print(f"\npi_url shared by more than one document: {duplicates.num_rows}")
+    for row in duplicates.to_pylist():
+        print(f"  {row['pi_url']}: {row['documents']}")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Export document metadata from S3 sidecars')
+    parser.add_argument('--buckets', nargs='+', default=DEFAULT_BUCKETS, help='Buckets to process')
+    parser.add_argument('--workers', type=int, default=32, help='Concurrent S3 requests')
+    parser.add_argument('--order', choices=['stable', 'completion'], default='completion',
+                        help='completion: written as fetched; stable: sorted by bucket and key, '
+                             'which holds every row in memory until listing ends')
+    parser.add_argument('--format', choices=sorted(ROW_WRITERS), default='csv', help='Output format')
+    parser.add_argument('--output', help='Output file (default: output/document_metadata_<timestamp>.<format>)')
+    parser.add_argument('--report', action='store_true', help='Print an aggregate report after exporting')
+    parser.add_argument('--report-only', metavar='EXPORT',
+                        help='Print the aggregate report for an existing export without touching S3')
+    return parser.parse_args()
 
 def main():
+    args = parse_args()
+    if args.report_only:
+        print_report(build_report(read_table(args.report_only)))
+        return
+
     logger.info("Starting document metadata extraction")
     
-    # Initialize S3 client using default credentials
-    s3_client = boto3.client('s3')
-    
-    # Create output directory if it doesn't exist
-    output_dir = os.path.join(os.path.dirname(__file__), 'output')
-    os.makedirs(output_dir, exist_ok=True)
-    
-    # Generate output filename with timestamp
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    output_file = os.path.join(output_dir, f'document_metadata_{timestamp}.csv')
+    # Initialize S3 client using default credentials, with a connection per fetch and listing thread
+    pool_size = args.workers + LISTER_WORKERS * len(args.buckets)
+    s3_client = boto3.client('s3', config=Config(max_pool_connections=pool_size))
     
-    # List of buckets to process
-    buckets = ['sbx-kendra-index', 'sbx-colorado-only']
-    
-    # CSV field names
-    fieldnames = ['jurisdiction', 'document_title', 'aq_type', 'pi_url']
+    output_file = args.output
+    if not output_file:
+        # Create output directory if it doesn't exist
+        output_dir = os.path.join(os.path.dirname(__file__), 'output')
+        os.makedirs(output_dir, exist_ok=True)
+        
+        # Generate output filename with timestamp
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        output_file = os.path.join(output_dir, f'document_metadata_{timestamp}.{args.format}')
     
     logger.info(f"Writing results to: {output_file}")
     
-    with open(output_file, 'w', newline='') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
-        
-        for bucket in buckets:
-            traverse_bucket(s3_client, bucket, writer)
+    writer = ROW_WRITERS[args.format](output_file)
+    try:
+        for row in iter_rows(s3_client, args.buckets, workers=args.workers, order=args.order):
+            writer.write(row)
+    finally:
+        writer.close()
     
     logger.info("Process completed successfully")
 
+    if args.report:
+        print_report(build_report(read_table(output_file, args.format)))
+
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -1,12 +1,23 @@
+import argparse
 import boto3
+import hashlib
 import requests
 import os
 import json
 import logging
-from typing import Optional
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional
 from dotenv import load_dotenv
+from io import BytesIO
+from pypdf import PdfReader
+from botocore.config import Config
 from botocore.exceptions import ProfileNotFound
+from requests.adapters import HTTPAdapter
+from s3_lister import S3PrefixLister
 import time
+from collections import deque
 
 # Set up logging
 logging.basicConfig(
@@ -21,14 +32,18 @@ load_dotenv()
 
 class MayanS3Sync:
     def __init__(self, aws_profile='default'):
+        # Parallel workers for S3 listing, uploads and plan execution
+        self.max_workers = int(os.getenv('MAYAN_MAX_WORKERS', '8'))
+        s3_config = Config(max_pool_connections=self.max_workers)
+
         # Initialize S3 client using AWS credentials file
         try:
             session = boto3.Session(profile_name=aws_profile)
-            self.s3 = session.client('s3')
+            self.s3 = session.client('s3', config=s3_config)
         except ProfileNotFound:
             logger.warning(f"AWS profile '{aws_profile}' not found in ~/.aws/credentials")
             logger.warning("Using default credentials provider chain...")
-            self.s3 = boto3.client('s3')
+            self.s3 = boto3.client('s3', config=s3_config)
         
         # Mayan EDMS settings
         self.mayan_url = os.getenv('MAYAN_API_URL', 'http://18.237.103.111')
@@ -36,6 +51,12 @@ class MayanS3Sync:
         self.headers = {
             'Authorization': f'Token {self.mayan_token}'
         }
+
+        # Shared HTTP session so parallel workers reuse pooled connections
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
         
         # S3 settings
         self.bucket_name = os.getenv('S3_BUCKET_NAME', 'sbx-colorado-only')
@@ -47,10 +68,29 @@ class MayanS3Sync:
         # Types to skip
         self.skip_types = set()  # Empty set, no types to skip
 
-        # Add tracking for document processing times
-        self.processing_times = []
+        # Document type label -> ID; the lock stops workers creating the same type twice
+        self.document_type_ids = {}
+        self.document_type_lock = threading.Lock()
+
+        # Adaptive limit on concurrent Mayan requests
+        self.controller = AIMDController(
+            initial_limit=int(os.getenv('MAYAN_INITIAL_CONCURRENCY', '2')),
+            max_limit=self.max_workers
+        )
         self.min_pause_ms = 250  # minimum 0.25 seconds
 
+        # Reuse text already extracted by pdf2opensearch or present in the PDF instead of
+        # having Mayan OCR every upload
+        self.reuse_text = os.getenv('MAYAN_REUSE_TEXT', 'false').lower() == 'true'
+        self.text_bucket = os.getenv('MAYAN_TEXT_BUCKET', 'sbx-open-search')
+        self.ocr_disabled_types = set()
+        self.ocr_settings_lock = threading.Lock()
+
+        # Content hash -> Mayan document ID, persisted between runs
+        self.hash_index = HashIndex(os.getenv('MAYAN_HASH_INDEX', 'mayan_hash_index.json'))
+        # IDs of the documents this tool uploaded; reconcile never deletes anything else
+        self.upload_ledger = UploadLedger(os.getenv('MAYAN_UPLOAD_LEDGER', 'mayan_uploads.json'))
+
         # Validate required environment variables
         self._validate_config()
 
@@ -66,22 +106,26 @@ class MayanS3Sync:
             raise ValueError('S3_BUCKET_NAME must be configured')
 
     def get_document_type_id(self, type_name: str) -> Optional[int]:
-        """Get document type ID from Mayan; create if it doesn't exist."""
-        try:
-            # Check if document type exists
-            response = requests.get(
-                f'{self.mayan_url}/api/v4/document_types/',
-                headers=self.headers
-            )
-            response.raise_for_status()  # Raise an exception for HTTP errors
+        """Get document type ID from Mayan; create if it doesn't exist. Cached per run."""
+        with self.document_type_lock:
+            if type_name not in self.document_type_ids:
+                document_type_id = self._get_or_create_document_type(type_name)
+                if document_type_id is None:
+                    return None
+                self.document_type_ids[type_name] = document_type_id
+            return self.document_type_ids[type_name]
 
-            for doc_type in response.json().get('results', []):
-                if doc_type['label'] == type_name:
-                    return doc_type['id']
+    def _get_or_create_document_type(self, type_name: str) -> Optional[int]:
+        try:
+            # Check if document type exists, caching every type seen
+            for doc_type in self._list_pages(f'{self.mayan_url}/api/v4/document_types/'):
+                self.document_type_ids.setdefault(doc_type['label'], doc_type['id'])
+            if type_name in self.document_type_ids:
+                return self.document_type_ids[type_name]
 
             # Document type does not exist; attempt to create it
-            create_response = requests.post(
-                f'{self.mayan_url}/api/v4/document_types/',
+            create_response = self._request(
+                'POST', f'{self.mayan_url}/api/v4/document_types/',
                 headers=self.headers,
                 json={'label': type_name}
             )
@@ -93,68 +137,71 @@ class MayanS3Sync:
             logger.error(f"Failed to get or create document type '{type_name}': {e}")
             return None
 
-    def calculate_average_processing_time(self) -> float:
-        """Calculate the average processing time from recent documents"""
-        if not self.processing_times:
-            return 2.0  # Default to 2 seconds if no data
-        return sum(self.processing_times) / len(self.processing_times)
-
-    def get_dynamic_pause_ms(self) -> int:
-        """Calculate dynamic pause time based on average processing time"""
-        avg_time = self.calculate_average_processing_time()
-        # Convert to milliseconds and add buffer
-        return int(avg_time * 1000) + self.min_pause_ms
-
-    def update_processing_times(self, elapsed_time: float):
-        """Update the running list of processing times"""
-        self.processing_times.append(elapsed_time)
-        # Keep only last 10 times to be adaptive
-        if len(self.processing_times) > 10:
-            self.processing_times.pop(0)
-
-    def wait_for_document_ready(self, document_id: int, max_attempts: int = 10, initial_pause_ms: Optional[int] = None) -> bool:
-        """Wait for document to be fully processed by polling its status"""
+    def _request(self, method: str, url: str, request_class: Optional[str] = None, **kwargs) -> requests.Response:
+        """
+        Send a Mayan API request under the adaptive concurrency limit. Its latency is
+        compared only with requests of the same class, the HTTP method unless given.
+        """
+        request_class = request_class or method
+        self.controller.acquire()
+        start_time = time.monotonic()
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except requests.exceptions.RequestException:
+            self.controller.release(time.monotonic() - start_time, failed=True, request_class=request_class)
+            raise
+        self.controller.release(time.monotonic() - start_time, status_code=response.status_code,
+                                request_class=request_class)
+        return response
+
+    def wait_for_document_ready(self, document_id: int, max_attempts: int = 10, initial_pause_ms: Optional[int] = None) -> Optional[dict]:
+        """Wait for document to be fully processed by polling its status with backoff; return its data"""
         
-        # Use dynamic pause if not explicitly specified
         if initial_pause_ms is None:
-            initial_pause_ms = self.get_dynamic_pause_ms()
+            initial_pause_ms = self.min_pause_ms
         
         # Initial pause to allow processing to begin
         logger.debug(f"Initial pause of {initial_pause_ms}ms before checking document {document_id} status...")
         time.sleep(initial_pause_ms / 1000)
         start_time = time.time()
+        pause = initial_pause_ms / 1000
 
         for attempt in range(max_attempts):
-            response = requests.get(
-                f'{self.mayan_url}/api/v4/documents/{document_id}/',
+            response = self._request(
+                'GET', f'{self.mayan_url}/api/v4/documents/{document_id}/',
                 headers=self.headers
             )
             
             if not response.ok:
                 logger.error(f"Failed to check document status: {response.text}")
-                return False
+                return None
             
             doc_data = response.json()
             if doc_data.get('file_latest'):
                 elapsed_time = time.time() - start_time
                 logger.info(f"Document {document_id} ready after {elapsed_time:.2f} seconds ({attempt + 1} attempts)")
-                self.update_processing_times(elapsed_time)
-                return True
+                return doc_data
                 
             logger.info(f"Document {document_id} still processing (attempt {attempt + 1}/{max_attempts}, elapsed: {time.time() - start_time:.2f}s)...")
-            time.sleep(1)
+            time.sleep(pause)
+            pause = min(pause * 2, 2.0)
             
         elapsed_time = time.time() - start_time
         logger.error(f"Document {document_id} failed to process after {max_attempts} attempts ({elapsed_time:.2f} seconds)")
-        return False
+        return None
 
-    def upload_document(self, file_key: str, document_type_id: int):
-        """Upload document to Mayan"""
+    def upload_document(self, file_key: str, document_type_id: int, content_hash: Optional[str] = None,
+                        file_content: Optional[bytes] = None) -> Optional[int]:
+        """Upload document to Mayan and return its ID, or None on failure"""
         try:
-            # Download file from S3
-            response = self.s3.get_object(Bucket=self.bucket_name, Key=file_key)
-            file_content = response['Body'].read()
+            # Download file from S3, unless the caller already has it
+            if file_content is None:
+                response = self.s3.get_object(Bucket=self.bucket_name, Key=file_key)
+                file_content = response['Body'].read()
             filename = file_key.split('/')[-1]
+
+            if self.reuse_text:
+                self.disable_auto_ocr(document_type_id)
             
             # Upload to Mayan using the upload endpoint
             files = {
@@ -162,42 +209,167 @@ class MayanS3Sync:
                 'file': (filename, file_content)
             }
             
-            upload_response = requests.post(
-                f'{self.mayan_url}/api/v4/documents/upload/',
+            upload_response = self._request(
+                'POST', f'{self.mayan_url}/api/v4/documents/upload/', request_class='upload',
                 headers=self.headers,
                 files=files
             )
             
             if not upload_response.ok:
                 logger.error(f"Failed to upload document {file_key}: {upload_response.text}")
-                return
+                return None
             
             document_id = upload_response.json()['id']
             
             # Wait for document to be ready
-            if not self.wait_for_document_ready(document_id):
-                return
+            doc_data = self.wait_for_document_ready(document_id)
+            if not doc_data:
+                return None
+
+            # Remember the content so identical files are not uploaded again
+            if content_hash:
+                self.hash_index.add(content_hash, document_id)
+            checksum = doc_data['file_latest'].get('checksum')
+            if checksum:
+                self.hash_index.add(f'sha256:{checksum}', document_id)
+
+            if self.reuse_text:
+                self.attach_text_or_ocr(document_id, file_key, file_content)
             
             # Add to Colorado cabinet using the correct endpoint
-            cabinet_response = requests.post(
-                f'{self.mayan_url}/api/v4/cabinets/{self.cabinet_id}/documents/add/',
+            cabinet_response = self._request(
+                'POST', f'{self.mayan_url}/api/v4/cabinets/{self.cabinet_id}/documents/add/',
                 headers=self.headers,
                 json={'document': str(document_id)}
             )
             
             if not cabinet_response.ok:
                 logger.error(f"Failed to add document to cabinet: {cabinet_response.text}")
-                return
-            
+                return None
+
+            self.upload_ledger.add(document_id)
             logger.info(f"Successfully uploaded {filename} (ID: {document_id})")
+            return document_id
             
         except Exception as e:
             logger.error(f"Error uploading {file_key}: {str(e)}")
+            return None
+
+    def disable_auto_ocr(self, document_type_id: int):
+        """Turn off Mayan's automatic OCR for a document type, once per run"""
+        # Held across the request so concurrent workers don't each send it
+        with self.ocr_settings_lock:
+            if document_type_id in self.ocr_disabled_types:
+                return
+            response = self._request(
+                'PATCH', f'{self.mayan_url}/api/v4/document_types/{document_type_id}/ocr/settings/',
+                headers=self.headers,
+                json={'auto_ocr': False}
+            )
+            if not response.ok:
+                logger.error(f"Failed to disable OCR for document type {document_type_id}: {response.text}")
+                return
+            self.ocr_disabled_types.add(document_type_id)
+
+    def get_extracted_text(self, file_key: str, file_content: bytes) -> Optional[List[str]]:
+        """
+        Return already-extracted text for a document as a list of page texts.
+
+        The PDF's own text layer gives one entry per page. Otherwise the Textract lines
+        written by pdf2opensearch (<root>_part_<n>.json) are returned as a single entry,
+        since those parts carry no page boundaries.
+        """
+        try:
+            pages = [page.extract_text() or '' for page in PdfReader(BytesIO(file_content)).pages]
+            if any(page.strip() for page in pages):
+                return pages
+        except Exception as e:
+            logger.debug(f"No text layer in {file_key}: {e}")
+
+        lines = []
+        root_key = os.path.splitext(file_key)[0]
+        part = 1
+        while True:
+            try:
+                response = self.s3.get_object(Bucket=self.text_bucket, Key=f"{root_key}_part_{part}.json")
+            except self.s3.exceptions.NoSuchKey:
+                break
+            lines.extend(json.loads(response['Body'].read().decode('utf-8')).get('lines', []))
+            part += 1
+        if lines:
+            return ['\n'.join(lines)]
+        return None
+
+    def attach_text_or_ocr(self, document_id: int, file_key: str, file_content: bytes):
+        """
+        Attach extracted text to an uploaded document, or submit it to Mayan OCR. Never
+        raises, so the upload always goes on to the cabinet.
+        """
+        try:
+            if self.attach_extracted_text(document_id, file_key, file_content):
+                return
+        except Exception as e:
+            logger.error(f"Failed to attach extracted text to document {document_id}: {e}")
+        logger.info(f"Submitting document {document_id} ({file_key}) to Mayan OCR")
+        try:
+            self._submit_ocr(document_id)
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Failed to submit document {document_id} for OCR: {e}")
+
+    def attach_extracted_text(self, document_id: int, file_key: str, file_content: bytes, max_attempts: int = 5) -> bool:
+        """Store extracted text as the OCR content of the document's pages; return False if none was attached"""
+        pages_text = self.get_extracted_text(file_key, file_content)
+        if not pages_text:
+            logger.info(f"No extracted text for {file_key}")
+            return False
+
+        # Version pages are created asynchronously after the file is processed
+        pause = self.min_pause_ms / 1000
+        for attempt in range(max_attempts):
+            response = self._request(
+                'GET', f'{self.mayan_url}/api/v4/documents/{document_id}/',
+                headers=self.headers
+            )
+            version = response.json().get('version_active') if response.ok else None
+            pages = list(self._list_pages(
+                f"{self.mayan_url}/api/v4/documents/{document_id}/versions/{version['id']}/pages/"
+            )) if version else []
+            if pages:
+                break
+            time.sleep(pause)
+            pause = min(pause * 2, 2.0)
+        else:
+            logger.error(f"Document {document_id} has no pages to attach text to")
+            return False
+
+        pages.sort(key=lambda page: page.get('page_number', 0))
+        for page, text in zip(pages, pages_text):
+            response = self._request(
+                'PATCH',
+                f"{self.mayan_url}/api/v4/documents/{document_id}/versions/{version['id']}/pages/{page['id']}/ocr/",
+                headers=self.headers,
+                json={'content': text}
+            )
+            if not response.ok:
+                logger.error(f"Failed to attach text to document {document_id} page {page['id']}: {response.text}")
+                return False
+        logger.info(f"Attached extracted text to document {document_id} ({len(pages_text)} pages)")
+        return True
+
+    def _submit_ocr(self, document_id: int) -> bool:
+        """Queue a document for Mayan OCR when auto OCR is off and no text could be reused"""
+        response = self._request(
+            'POST', f'{self.mayan_url}/api/v4/documents/{document_id}/ocr/submit/',
+            headers=self.headers
+        )
+        if not response.ok:
+            logger.error(f"Failed to submit document {document_id} for OCR: {response.text}")
+        return response.ok
 
     def document_exists(self, filename: str) -> bool:
         """Check if document already exists in Mayan by filename"""
-        response = requests.get(
-            f'{self.mayan_url}/api/v4/documents/',
+        response = self._request(
+            'GET', f'{self.mayan_url}/api/v4/documents/',
             headers=self.headers,
             params={'label': filename}
         )
@@ -213,116 +385,699 @@ class MayanS3Sync:
                 
         return False
 
+    def get_document_metadata(self, file_key: str) -> dict:
+        """Read the Attributes object from the document's .metadata.json sidecar"""
+        json_response = self.s3.get_object(
+            Bucket=self.bucket_name,
+            Key=f"{file_key}.metadata.json"
+        )
+        json_data = json.loads(json_response['Body'].read().decode('utf-8'))
+        return json_data.get('Attributes', {})
+
+    def sync_document(self, file_key: str) -> Optional[int]:
+        """Upload a single S3 document using the aq_type from its metadata"""
+        try:
+            metadata = self.get_document_metadata(file_key)
+        except self.s3.exceptions.NoSuchKey:
+            logger.warning(f"Skipping {file_key}: No metadata file found")
+            return None
+        except json.JSONDecodeError:
+            logger.error(f"Skipping {file_key}: Invalid JSON metadata")
+            return None
+
+        aq_type = metadata.get('aq_type', '').strip()
+        if not aq_type:
+            logger.warning(f"Skipping {file_key}: No aq_type in metadata")
+            return None
+        if aq_type in self.skip_types:
+            logger.info(f"Skipping {file_key}: aq_type '{aq_type}' is in skip list")
+            return None
+
+        doc_type_id = self.get_document_type_id(aq_type)
+        return self.upload_document(file_key, doc_type_id)
+
+    def delete_document(self, document_id: int) -> bool:
+        """Delete a single document from Mayan"""
+        delete_response = self._request(
+            'DELETE', f'{self.mayan_url}/api/v4/documents/{document_id}/',
+            headers=self.headers
+        )
+        if delete_response.ok:
+            self.upload_ledger.remove(document_id)
+            logger.info(f"Deleted document {document_id}")
+            return True
+        logger.error(f"Failed to delete document {document_id}")
+        return False
+
     def process_s3_folder(self, batch_size=100):
-        """Process files in S3 folder in batches"""
-        paginator = self.s3.get_paginator('list_objects_v2')
+        """
+        Process files in S3 folder in batches.
+
+        Documents are handled by a pool of workers; the number of requests actually in
+        flight against Mayan is governed by the adaptive controller.
+        """
         processed_count = 0
         skipped_count = 0
-        
-        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=self.folder_path):
-            for obj in page.get('Contents', []):
-                file_key = obj['Key']
-                
-                # Skip metadata files
-                if file_key.endswith('.metadata.json'):
-                    continue
-                
-                # Get metadata first to check aq_type
-                json_key = f"{file_key}.metadata.json"
-                try:
-                    # Get metadata from JSON file
-                    json_response = self.s3.get_object(
-                        Bucket=self.bucket_name,
-                        Key=json_key
-                    )
-                    json_data = json.loads(json_response['Body'].read().decode('utf-8'))
-                    
-                    # Get metadata from Attributes object
-                    metadata = json_data.get('Attributes', {})
-                    
-                    # Get and clean aq_type from metadata
-                    aq_type = metadata.get('aq_type', '').strip()
-                    if not aq_type:
-                        logger.warning(f"Skipping {file_key}: No aq_type in metadata")
-                        continue
-                    
-                    # Skip specified document types
-                    if aq_type in self.skip_types:
-                        skipped_count += 1
-                        logger.info(f"Skipping {file_key}: aq_type '{aq_type}' is in skip list (skipped: {skipped_count})")
-                        continue
-                    
-                    filename = file_key.split('/')[-1]
-                    
-                    # Check if document already exists
-                    if self.document_exists(filename):
-                        skipped_count += 1
-                        logger.info(f"Skipping {file_key}: Already exists in Mayan (skipped: {skipped_count})")
-                        continue
-                    
-                    # Get or create document type
-                    doc_type_id = self.get_document_type_id(aq_type)
-                    
-                    # Upload document
-                    self.upload_document(file_key, doc_type_id)
+        upload_slots = threading.Semaphore(batch_size)
+        batch_full = False
+        pending = set()
+
+        def collect(done):
+            nonlocal processed_count, skipped_count, batch_full
+            for future in done:
+                outcome = future.result()
+                if outcome == 'processed':
                     processed_count += 1
-                    logger.info(f"Processed {file_key} with type {aq_type} ({processed_count}/{batch_size})")
-                    
-                    if processed_count >= batch_size:
-                        logger.info(f"\nBatch limit of {batch_size} reached. Stopping processing.")
-                        logger.info(f"Total documents skipped (already existed): {skipped_count}")
-                        return
-                    
-                except self.s3.exceptions.NoSuchKey:
-                    logger.warning(f"Skipping {file_key}: No metadata file found")
-                    continue
-                except json.JSONDecodeError:
-                    logger.error(f"Skipping {file_key}: Invalid JSON metadata")
-                    continue
-
-    def delete_all_documents(self):
-        """Delete all documents from Mayan"""
-        while True:
-            # Get list of documents
-            response = requests.get(
-                f'{self.mayan_url}/api/v4/documents/',
-                headers=self.headers
-            )
-            
-            if not response.ok:
-                logger.error("Failed to get document list")
-                break
-                
-            documents = response.json()['results']
-            if not documents:
-                logger.info("No more documents to delete")
+                elif outcome == 'skipped':
+                    skipped_count += 1
+                elif outcome == 'batch_full':
+                    batch_full = True
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for obj in self.list_s3_documents():
+                if batch_full:
+                    break
+                pending.add(executor.submit(self._process_s3_object, obj, upload_slots))
+                if len(pending) >= self.max_workers * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+            done, _ = wait(pending)
+            collect(done)
+
+        self.hash_index.save()
+        self.upload_ledger.save()
+        if processed_count >= batch_size:
+            logger.info(f"Batch limit of {batch_size} reached. Stopping processing.")
+        logger.info(f"Processed {processed_count} documents, skipped {skipped_count}")
+        self.controller.log_state()
+
+    def _process_s3_object(self, obj: dict, upload_slots: threading.Semaphore) -> str:
+        """Upload one S3 document if it is new; return 'processed', 'skipped', 'ignored' or 'batch_full'"""
+        file_key = obj['Key']
+        # Get metadata first to check aq_type
+        try:
+            metadata = self.get_document_metadata(file_key)
+        except self.s3.exceptions.NoSuchKey:
+            logger.warning(f"Skipping {file_key}: No metadata file found")
+            return 'ignored'
+        except json.JSONDecodeError:
+            logger.error(f"Skipping {file_key}: Invalid JSON metadata")
+            return 'ignored'
+
+        # Get and clean aq_type from metadata
+        aq_type = metadata.get('aq_type', '').strip()
+        if not aq_type:
+            logger.warning(f"Skipping {file_key}: No aq_type in metadata")
+            return 'ignored'
+
+        # Skip specified document types
+        if aq_type in self.skip_types:
+            logger.info(f"Skipping {file_key}: aq_type '{aq_type}' is in skip list")
+            return 'skipped'
+
+        filename = file_key.split('/')[-1]
+
+        # Check if document already exists
+        if self.document_exists(filename):
+            logger.info(f"Skipping {file_key}: Already exists in Mayan")
+            return 'skipped'
+
+        # Check if the same content was already uploaded under another name. The file is
+        # read once, for the hash and the upload.
+        response = self.s3.get_object(Bucket=self.bucket_name, Key=file_key)
+        file_content = response['Body'].read()
+        content_hash = self.content_hash(file_content)
+        duplicate_id = self.find_duplicate(content_hash)
+        if duplicate_id is not None:
+            logger.info(f"Skipping {file_key}: Same content as Mayan document {duplicate_id}")
+            return 'skipped'
+
+        if not upload_slots.acquire(blocking=False):
+            return 'batch_full'
+
+        # Get or create document type
+        doc_type_id = self.get_document_type_id(aq_type)
+
+        # Upload document
+        self.upload_document(file_key, doc_type_id, content_hash=content_hash, file_content=file_content)
+        logger.info(f"Processed {file_key} with type {aq_type}")
+        return 'processed'
+
+    def delete_all_documents(self, max_workers: Optional[int] = None, rate_limit: Optional[float] = None,
+                             empty_trash: bool = False, max_passes: int = 3) -> bool:
+        """
+        Delete all documents from Mayan with parallel, rate-limited requests.
+
+        Document IDs are collected in one streamed pass ordered by ID and deleted in ID
+        order, so the listing is never re-read while deletions are in flight. Completion
+        is checked with a single count query.
+        """
+        max_workers = max_workers or self.max_workers
+        limiter = RateLimiter(rate_limit or float(os.getenv('MAYAN_DELETE_RATE', '10')))
+
+        for attempt in range(max_passes):
+            document_ids = sorted(doc['id'] for doc in self.list_mayan_documents(params={'_ordering': 'id'}))
+            if not document_ids:
                 break
-                
-            # Delete each document
-            for doc in documents:
-                delete_response = requests.delete(
-                    f'{self.mayan_url}/api/v4/documents/{doc["id"]}/',
-                    headers=self.headers
-                )
-                if delete_response.ok:
-                    logger.info(f"Deleted document {doc['id']}")
-                else:
-                    logger.error(f"Failed to delete document {doc['id']}")
-            
-            # Wait for deletions to complete
-            logger.info("Waiting for deletions to complete...")
-            time.sleep(2)  # Give Mayan time to process deletions
-            
-            # Verify documents are gone
-            verify_response = requests.get(
-                f'{self.mayan_url}/api/v4/documents/',
-                headers=self.headers
+            logger.info(f"Deleting {len(document_ids)} documents (IDs {document_ids[0]}-{document_ids[-1]}, pass {attempt + 1})")
+            deleted = self._delete_concurrently(
+                lambda document_id: f'{self.mayan_url}/api/v4/documents/{document_id}/',
+                document_ids, limiter, max_workers
             )
-            if verify_response.ok and len(verify_response.json()['results']) == 0:
-                logger.info("All documents successfully deleted")
+            logger.info(f"Deleted {deleted}/{len(document_ids)} documents")
+            if deleted == len(document_ids):
                 break
 
+        if empty_trash:
+            trashed_ids = sorted(doc['id'] for doc in self._list_pages(f'{self.mayan_url}/api/v4/trashed_documents/'))
+            logger.info(f"Emptying trash of {len(trashed_ids)} documents")
+            self._delete_concurrently(
+                lambda document_id: f'{self.mayan_url}/api/v4/trashed_documents/{document_id}/',
+                trashed_ids, limiter, max_workers
+            )
+
+        self.controller.log_state()
+        remaining = self.count_documents()
+        if remaining == 0:
+            logger.info("All documents successfully deleted")
+            return True
+        logger.error(f"{'An unknown number of' if remaining is None else remaining} documents remain after deletion")
+        return False
+
+    def _delete_concurrently(self, url_for, ids: List[int], limiter: 'RateLimiter', max_workers: int) -> int:
+        """Send DELETE requests for the given IDs from a thread pool; return how many succeeded"""
+        def delete(object_id):
+            limiter.acquire()
+            # One failed request must not abort the rest of the batch
+            try:
+                response = self._request('DELETE', url_for(object_id), headers=self.headers)
+            except requests.exceptions.RequestException as e:
+                logger.error(f"Failed to delete {object_id}: {e}")
+                return False
+            if not response.ok:
+                logger.error(f"Failed to delete {object_id}: {response.status_code}")
+            return response.ok
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return sum(executor.map(delete, ids))
+
+    def count_documents(self) -> Optional[int]:
+        """Return the number of documents in Mayan using a single list request, or None if unknown"""
+        try:
+            response = self._request(
+                'GET', f'{self.mayan_url}/api/v4/documents/',
+                headers=self.headers,
+                params={'page_size': 1}
+            )
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Failed to get document count: {e}")
+            return None
+        if not response.ok:
+            logger.error("Failed to get document count")
+            return None
+        return response.json().get('count')
+
+    def list_mayan_documents(self, params: Optional[dict] = None) -> Iterator[dict]:
+        """Stream every document in Mayan, following the API's page links"""
+        return self._list_pages(f'{self.mayan_url}/api/v4/documents/', params)
+
+    def list_cabinet_documents(self) -> Iterator[dict]:
+        """Stream the documents in the cabinet this tool uploads to"""
+        return self._list_pages(f'{self.mayan_url}/api/v4/cabinets/{self.cabinet_id}/documents/')
+
+    def _list_pages(self, url: str, params: Optional[dict] = None) -> Iterator[dict]:
+        """Stream the results of a paginated Mayan API list endpoint"""
+        params = {'page_size': 100, **(params or {})}
+        while url:
+            response = self._request('GET', url, headers=self.headers, params=params)
+            response.raise_for_status()
+            page = response.json()
+            for doc in page.get('results', []):
+                yield doc
+            # 'next' already carries the query string
+            url = page.get('next')
+            params = None
+
+    def list_s3_documents(self) -> Iterator[dict]:
+        """Stream every document (not metadata sidecar) under the S3 folder, listing subfolders in parallel"""
+        lister = S3PrefixLister(self.s3, max_workers=self.max_workers)
+        return lister.iter_objects(self.bucket_name, self.folder_path, exclude_suffixes=['.metadata.json'])
+
+    def s3_sha256(self, file_key: str) -> str:
+        """Stream an S3 object and return its SHA-256 hex digest"""
+        response = self.s3.get_object(Bucket=self.bucket_name, Key=file_key)
+        digest = hashlib.sha256()
+        for chunk in response['Body'].iter_chunks(chunk_size=1024 * 1024):
+            digest.update(chunk)
+        return digest.hexdigest()
+
+    def content_hash(self, file_content: bytes) -> str:
+        """
+        Return the hash index key for a file's content.
+
+        Always SHA-256, which is what Mayan stores as a file checksum, so an index rebuilt
+        from Mayan matches every S3 object. S3 ETags are not used: they are MD5s only for
+        single-part uploads, and Mayan has no MD5 to rebuild from.
+        """
+        return f'sha256:{hashlib.sha256(file_content).hexdigest()}'
+
+    def find_duplicate(self, content_hash: str) -> Optional[int]:
+        """Return the ID of a Mayan document with this content, dropping stale index entries"""
+        document_id = self.hash_index.get(content_hash)
+        if document_id is None:
+            return None
+        response = self._request(
+            'GET', f'{self.mayan_url}/api/v4/documents/{document_id}/',
+            headers=self.headers
+        )
+        if response.status_code == 404:
+            self.hash_index.remove(content_hash)
+            return None
+        return document_id
+
+    def rebuild_hash_index(self):
+        """Seed the hash index from the SHA-256 checksums Mayan stores for each document"""
+        count = 0
+        for doc in self.list_mayan_documents():
+            checksum = (doc.get('file_latest') or {}).get('checksum')
+            if checksum:
+                self.hash_index.add(f'sha256:{checksum}', doc['id'])
+                count += 1
+        self.hash_index.save()
+        logger.info(f"Indexed checksums of {count} Mayan documents")
+
+    def build_reconcile_plan(self, verify_checksums: bool = False) -> Dict[str, list]:
+        """
+        Diff the S3 folder against the cabinet and return a plan of adds, deletes and re-uploads.
+
+        Both listings are sorted by label and merge-joined. Matching labels are compared by
+        size, and by SHA-256 against Mayan's stored checksum when verify_checksums is set.
+        Only documents this tool uploaded are deleted or replaced; any other document that
+        would have been is listed under 'unmanaged' instead.
+        """
+        s3_docs = sorted(
+            (obj['Key'].split('/')[-1], obj['Key'], obj['Size'])
+            for obj in self.list_s3_documents()
+        )
+        mayan_docs = sorted(
+            (doc['label'], doc['id'], doc.get('file_latest') or {})
+            for doc in self.list_cabinet_documents()
+        )
+        logger.info(f"Reconciling {len(s3_docs)} S3 documents against {len(mayan_docs)} cabinet documents")
+
+        plan = merge_reconcile_plan(
+            s3_docs, mayan_docs,
+            content_changed=lambda key, size, file_latest: self._content_changed(key, size, file_latest, verify_checksums),
+            is_managed=self.upload_ledger.contains
+        )
+        plan['case_collisions'] = case_collisions(label for label, _, _ in s3_docs)
+        if plan['case_collisions']:
+            logger.warning(
+                f"{len(plan['case_collisions'])} S3 filenames differ from another only by case; "
+                "they are reported in the plan and left alone"
+            )
+        if plan['unmanaged']:
+            logger.warning(f"{len(plan['unmanaged'])} documents were not uploaded by this tool and are left alone")
+        logger.info(
+            f"Plan: {len(plan['add'])} adds, {len(plan['delete'])} deletes, "
+            f"{len(plan['reupload'])} re-uploads"
+        )
+        return plan
+
+    def _content_changed(self, file_key: str, size: int, file_latest: dict, verify_checksums: bool) -> bool:
+        """Compare an S3 object with the latest file of its Mayan document"""
+        if not file_latest:
+            return True
+        if file_latest.get('size') is not None and file_latest['size'] != size:
+            return True
+        if verify_checksums and file_latest.get('checksum'):
+            return self.s3_sha256(file_key) != file_latest['checksum']
+        return False
+
+    def write_plan(self, plan: Dict[str, list], plan_path: str):
+        """Write a reconcile plan to a JSON file"""
+        document = {
+            'generated_at': datetime.now().isoformat(),
+            'bucket': self.bucket_name,
+            'folder': self.folder_path,
+            **plan
+        }
+        with open(plan_path, 'w') as plan_file:
+            json.dump(document, plan_file, indent=2)
+        logger.info(f"Wrote reconcile plan to {plan_path}")
+
+    def execute_plan(self, plan: Dict[str, list], max_workers: Optional[int] = None) -> Dict[str, int]:
+        """Apply a reconcile plan with a pool of parallel workers"""
+        max_workers = max_workers or self.max_workers
+        # A plan file may be old or edited by hand, so check again what this tool uploaded
+        deletes = self._managed_entries(plan.get('delete', []))
+        reuploads = self._managed_entries(plan.get('reupload', []))
+        tasks = (
+            [(self.delete_document, entry['id']) for entry in deletes]
+            + [(self.sync_document, entry['key']) for entry in plan.get('add', [])]
+            + [(self._reupload_document, entry) for entry in reuploads]
+        )
+        counts = {'succeeded': 0, 'failed': 0}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(func, arg) for func, arg in tasks]
+            for future in as_completed(futures):
+                try:
+                    ok = future.result()
+                except Exception as e:
+                    logger.error(f"Plan step failed: {e}")
+                    ok = False
+                counts['succeeded' if ok else 'failed'] += 1
+        self.hash_index.save()
+        self.upload_ledger.save()
+        logger.info(f"Plan applied: {counts['succeeded']} succeeded, {counts['failed']} failed")
+        self.controller.log_state()
+        return counts
+
+    def _managed_entries(self, entries: List[dict]) -> List[dict]:
+        managed = [entry for entry in entries if self.upload_ledger.contains(entry['id'])]
+        for entry in entries:
+            if not self.upload_ledger.contains(entry['id']):
+                logger.warning(f"Leaving document {entry['id']} alone: it was not uploaded by this tool")
+        return managed
+
+    def _reupload_document(self, entry: dict) -> Optional[int]:
+        """
+        Replace a Mayan document whose S3 content has changed. The old document is deleted
+        only once its replacement is uploaded, so a failed upload leaves it in place.
+        """
+        document_id = self.sync_document(entry['key'])
+        if document_id is None:
+            return None
+        if not self.delete_document(entry['id']):
+            logger.error(f"Uploaded {entry['key']} as document {document_id} but could not delete the old document {entry['id']}")
+            return None
+        return document_id
+
+
+class AIMDController:
+    """
+    Additive-increase/multiplicative-decrease limit on concurrent requests.
+
+    The limit grows by roughly one for every `limit` healthy responses and is halved on
+    429/5xx responses, connection errors, or when p95 latency rises well above the best
+    p95 seen so far. Cuts are spaced by a cooldown so one burst of errors halves it once.
+
+    Latency is tracked per request class (e.g. uploads vs. status GETs), so a shift in the
+    mix of cheap and expensive requests doesn't read as the server slowing down.
+    """
+
+    def __init__(self, initial_limit: int = 2, min_limit: int = 1, max_limit: int = 16,
+                 window: int = 50, latency_tolerance: float = 2.0, cooldown: float = 2.0,
+                 log_every: int = 100):
+        self.min_limit = min_limit
+        self.max_limit = max(max_limit, min_limit)
+        self.limit = float(min(max(initial_limit, min_limit), self.max_limit))
+        self.window = window
+        # request class -> recent latencies, and the best p95 seen for that class
+        self.latencies: Dict[str, deque] = {}
+        self.baseline_p95: Dict[str, float] = {}
+        self.latency_tolerance = latency_tolerance
+        self.cooldown = cooldown
+        self.log_every = log_every
+        self.last_decrease = 0.0
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, latency: float, status_code: Optional[int] = None, failed: bool = False,
+                request_class: str = 'default'):
+        with self.condition:
+            self.in_flight -= 1
+            self.requests += 1
+            latencies = self.latencies.setdefault(request_class, deque(maxlen=self.window))
+            latencies.append(latency)
+
+            if failed or status_code == 429 or (status_code is not None and status_code >= 500):
+                self.errors += 1
+                self._decrease('error' if failed else f'HTTP {status_code}')
+            elif self._latency_rising(request_class):
+                self._decrease(f'{request_class} p95 latency rising')
+            else:
+                self.limit = min(self.limit + 1.0 / self.limit, self.max_limit)
+
+            if self.requests % self.log_every == 0:
+                self.log_state()
+            self.condition.notify_all()
+
+    def _latency_rising(self, request_class: str) -> bool:
+        latencies = self.latencies[request_class]
+        if len(latencies) < latencies.maxlen // 2:
+            return False
+        p95 = self._percentile(latencies, 95)
+        baseline = self.baseline_p95.get(request_class)
+        if baseline is None or p95 < baseline:
+            self.baseline_p95[request_class] = p95
+            return False
+        # Let the baseline drift up slowly so a permanently slower server isn't penalised forever
+        baseline += (p95 - baseline) * 0.01
+        self.baseline_p95[request_class] = baseline
+        return p95 > baseline * self.latency_tolerance
+
+    def _decrease(self, reason: str):
+        now = time.monotonic()
+        if now - self.last_decrease < self.cooldown:
+            return
+        self.last_decrease = now
+        self.limit = max(self.limit / 2, self.min_limit)
+        logger.warning(f"Reducing Mayan concurrency to {int(self.limit)} ({reason})")
+
+    @staticmethod
+    def _percentile(latencies, percent: int) -> float:
+        ordered = sorted(latencies)
+        if not ordered:
+            return 0.0
+        return ordered[min(len(ordered) - 1, len(ordered) * percent // 100)]
+
+    def state(self) -> Dict[str, object]:
+        """Current limit and recent latency percentiles per request class"""
+        with self.condition:
+            return {
+                'limit': int(self.limit),
+                'in_flight': self.in_flight,
+                'latency': {
+                    request_class: {'p50': self._percentile(latencies, 50), 'p95': self._percentile(latencies, 95)}
+                    for request_class, latencies in sorted(self.latencies.items())
+                },
+                'requests': self.requests,
+                'errors': self.errors,
+            }
+
+    def log_state(self):
+        state = self.state()
+        latency = ', '.join(
+            f"{request_class} p50 {percentiles['p50']:.2f}s p95 {percentiles['p95']:.2f}s"
+            for request_class, percentiles in state['latency'].items()
+        ) or 'no requests'
+        logger.info(
+            f"Mayan concurrency limit {state['limit']}, latency {latency} "
+            f"({state['requests']} requests, {state['errors']} errors)"
+        )
+
+
+class HashIndex:
+    """Thread-safe content hash -> Mayan document ID map stored as a JSON file"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries: Dict[str, int] = {}
+        if os.path.exists(path):
+            with open(path) as index_file:
+                self.entries = json.load(index_file)
+
+    def get(self, content_hash: str) -> Optional[int]:
+        with self.lock:
+            return self.entries.get(content_hash)
+
+    def add(self, content_hash: str, document_id: int):
+        with self.lock:
+            self.entries[content_hash] = document_id
+
+    def remove(self, content_hash: str):
+        with self.lock:
+            self.entries.pop(content_hash, None)
+
+    def save(self):
+        with self.lock:
+            with open(self.path, 'w') as index_file:
+                json.dump(self.entries, index_file)
+
+
+class UploadLedger:
+    """Thread-safe set of the Mayan document IDs this tool uploaded, stored as a JSON file"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.document_ids = set()
+        if os.path.exists(path):
+            with open(path) as ledger_file:
+                self.document_ids = set(json.load(ledger_file))
+
+    def contains(self, document_id: int) -> bool:
+        with self.lock:
+            return document_id in self.document_ids
+
+    def add(self, document_id: int):
+        with self.lock:
+            self.document_ids.add(document_id)
+
+    def remove(self, document_id: int):
+        with self.lock:
+            self.document_ids.discard(document_id)
+
+    def save(self):
+        with self.lock:
+            with open(self.path, 'w') as ledger_file:
+                json.dump(sorted(self.document_ids), ledger_file)
+
+
+class RateLimiter:
+    """Thread-safe limiter that spaces calls to at most `rate` per second"""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+def merge_reconcile_plan(s3_docs: List[tuple], mayan_docs: List[tuple], content_changed, is_managed) -> Dict[str, list]:
+    """
+    Merge-join S3 documents, as sorted (label, key, size) tuples, with Mayan documents, as
+    sorted (label, id, file_latest) tuples, on their exact labels.
+
+    content_changed(key, size, file_latest) says whether a matched document needs a
+    re-upload, and is_managed(id) whether this tool uploaded a Mayan document. Mayan
+    documents that would be deleted or replaced but aren't managed go under 'unmanaged'.
+    """
+    plan = {'add': [], 'delete': [], 'reupload': [], 'unmanaged': []}
+
+    def delete(doc_id, label, reason):
+        if is_managed(doc_id):
+            plan['delete'].append({'id': doc_id, 'label': label})
+        else:
+            plan['unmanaged'].append({'id': doc_id, 'label': label, 'reason': reason})
+
+    label_collisions = 0
+    i = j = 0
+    while i < len(s3_docs) or j < len(mayan_docs):
+        s3_label = s3_docs[i][0] if i < len(s3_docs) else None
+        mayan_label = mayan_docs[j][0] if j < len(mayan_docs) else None
+
+        if mayan_label is None or (s3_label is not None and s3_label < mayan_label):
+            _, key, _ = s3_docs[i]
+            plan['add'].append({'key': key})
+            i += 1
+            # Only the first of the keys sharing a label is uploaded, as below
+            while i < len(s3_docs) and s3_docs[i][0] == s3_label:
+                label_collisions += 1
+                i += 1
+            continue
+        if s3_label is None or mayan_label < s3_label:
+            _, doc_id, _ = mayan_docs[j]
+            delete(doc_id, mayan_label, 'not in S3')
+            j += 1
+            continue
+
+        # Same label on both sides: pair the first of each group
+        label = s3_label
+        _, key, size = s3_docs[i]
+        _, doc_id, file_latest = mayan_docs[j]
+        i += 1
+        j += 1
+        if content_changed(key, size, file_latest):
+            if is_managed(doc_id):
+                plan['reupload'].append({'key': key, 'id': doc_id})
+            else:
+                plan['unmanaged'].append({'id': doc_id, 'label': label, 'reason': 'content changed'})
+
+        # Sync matches on filename only, so extra S3 keys with this label are never uploaded
+        while i < len(s3_docs) and s3_docs[i][0] == label:
+            label_collisions += 1
+            i += 1
+        # Extra Mayan documents with this label are duplicates
+        while j < len(mayan_docs) and mayan_docs[j][0] == label:
+            delete(mayan_docs[j][1], label, 'duplicate label')
+            j += 1
+
+    if label_collisions:
+        logger.warning(f"{label_collisions} S3 documents share a filename with another document and were left out")
+    return plan
+
+
+def case_collisions(labels) -> List[List[str]]:
+    """Groups of distinct labels that differ only by case"""
+    groups: Dict[str, set] = {}
+    for label in labels:
+        groups.setdefault(label.casefold(), set()).add(label)
+    return [sorted(group) for _, group in sorted(groups.items()) if len(group) > 1]
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Sync documents from S3 to Mayan EDMS')
+    parser.add_argument('--profile', default='default', help='AWS profile to use')
+    subparsers = parser.add_subparsers(dest='command')
+
+    sync_parser = subparsers.add_parser('sync', help='Upload new documents (default)')
+    sync_parser.add_argument('--batch-size', type=int, default=5000)
+
+    reconcile_parser = subparsers.add_parser('reconcile', help='Write a plan of adds, deletes and re-uploads')
+    reconcile_parser.add_argument('--plan', default='reconcile_plan.json', help='Path of the plan file to write')
+    reconcile_parser.add_argument('--verify-checksums', action='store_true',
+                                  help='Compare SHA-256 of same-sized documents (downloads them from S3)')
+    reconcile_parser.add_argument('--execute', action='store_true', help='Apply the plan after writing it')
+    reconcile_parser.add_argument('--workers', type=int, default=None)
+
+    apply_parser = subparsers.add_parser('apply', help='Apply a previously written plan')
+    apply_parser.add_argument('--plan', default='reconcile_plan.json', help='Path of the plan file to apply')
+    apply_parser.add_argument('--workers', type=int, default=None)
+
+    subparsers.add_parser('index', help='Rebuild the content hash index from Mayan checksums')
+
+    delete_parser = subparsers.add_parser('delete-all', help='Delete every document from Mayan')
+    delete_parser.add_argument('--workers', type=int, default=None)
+    delete_parser.add_argument('--rate', type=float, default=None, help='Maximum DELETE requests per second')
+    delete_parser.add_argument('--empty-trash', action='store_true', help='Also permanently delete trashed documents')
+
+    return parser.parse_args(argv)
+
+
 if __name__ == "__main__":
-    syncer = MayanS3Sync(aws_profile='default')
-    logger.info("Processing new documents...")
-    syncer.process_s3_folder(batch_size=5000)
\ No newline at end of file
+    args = parse_args()
+    syncer = MayanS3Sync(aws_profile=args.profile)
+    if args.command == 'reconcile':
+        plan = syncer.build_reconcile_plan(verify_checksums=args.verify_checksums)
+        syncer.write_plan(plan, args.plan)
+        if args.execute:
+            syncer.execute_plan(plan, max_workers=args.workers)
+    elif args.command == 'apply':
+        with open(args.plan) as plan_file:
+            plan = json.load(plan_file)
+        syncer.execute_plan(plan, max_workers=args.workers)
+    elif args.command == 'index':
+        syncer.rebuild_hash_index()
+    elif args.command == 'delete-all':
+        syncer.delete_all_documents(max_workers=args.workers, rate_limit=args.rate, empty_trash=args.empty_trash)
+    else:
+        logger.info("Processing new documents...")
+        syncer.process_s3_folder(batch_size=getattr(args, 'batch_size', 5000))
@@ -0,0 +1,84 @@
+from s3_to_mayan import case_collisions, merge_reconcile_plan
+
+
+def never_changed(key, size, file_latest):
+    return False
+
+
+def managed(*ids):
+    return lambda doc_id: doc_id in ids
+
+
+def test_adds_s3_only_and_deletes_mayan_only_documents():
+    plan = merge_reconcile_plan(
+        [('a.pdf', 'CO/a.pdf', 10), ('b.pdf', 'CO/b.pdf', 20)],
+        [('b.pdf', 2, {}), ('c.pdf', 3, {})],
+        never_changed, managed(2, 3)
+    )
+    assert plan == {
+        'add': [{'key': 'CO/a.pdf'}],
+        'delete': [{'id': 3, 'label': 'c.pdf'}],
+        'reupload': [],
+        'unmanaged': [],
+    }
+
+
+def test_reuploads_changed_content():
+    plan = merge_reconcile_plan(
+        [('a.pdf', 'CO/a.pdf', 10)],
+        [('a.pdf', 1, {'size': 5})],
+        lambda key, size, file_latest: size != file_latest['size'], managed(1)
+    )
+    assert plan['reupload'] == [{'key': 'CO/a.pdf', 'id': 1}]
+    assert plan['delete'] == []
+
+
+def test_never_deletes_or_replaces_documents_it_did_not_upload():
+    plan = merge_reconcile_plan(
+        [('a.pdf', 'CO/a.pdf', 10)],
+        [('a.pdf', 1, {}), ('z.pdf', 9, {})],
+        lambda key, size, file_latest: True, managed()
+    )
+    assert plan['delete'] == []
+    assert plan['reupload'] == []
+    assert plan['unmanaged'] == [
+        {'id': 1, 'label': 'a.pdf', 'reason': 'content changed'},
+        {'id': 9, 'label': 'z.pdf', 'reason': 'not in S3'},
+    ]
+
+
+def test_deletes_duplicate_labels_after_the_first():
+    plan = merge_reconcile_plan(
+        [('a.pdf', 'CO/a.pdf', 10)],
+        [('a.pdf', 1, {}), ('a.pdf', 2, {}), ('a.pdf', 3, {})],
+        never_changed, managed(1, 2)
+    )
+    assert plan['delete'] == [{'id': 2, 'label': 'a.pdf'}]
+    assert plan['unmanaged'] == [{'id': 3, 'label': 'a.pdf', 'reason': 'duplicate label'}]
+
+
+def test_labels_differing_by_case_are_distinct():
+    plan = merge_reconcile_plan(
+        [('Report.pdf', 'CO/Report.pdf', 10)],
+        [('report.pdf', 1, {})],
+        never_changed, managed(1)
+    )
+    assert plan['add'] == [{'key': 'CO/Report.pdf'}]
+    assert plan['delete'] == [{'id': 1, 'label': 'report.pdf'}]
+
+
+def test_extra_s3_keys_with_the_same_label_are_left_out():
+    plan = merge_reconcile_plan(
+        [('a.pdf', 'CO/a.pdf', 10), ('a.pdf', 'NM/a.pdf', 10)],
+        [],
+        never_changed, managed()
+    )
+    assert plan['add'] == [{'key': 'CO/a.pdf'}]
+
+
+def test_case_collisions():
+    assert case_collisions(['a.pdf', 'A.pdf', 'b.pdf', 'a.pdf', 'B.PDF', 'c.pdf']) == [
+        ['A.pdf', 'a.pdf'],
+        ['B.PDF', 'b.pdf'],
+    ]
+    assert case_collisions(['a.pdf', 'b.pdf']) == []
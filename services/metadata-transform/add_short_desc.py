@@ -1,11 +1,12 @@
+import argparse
 import boto3
 import config
 from gspread_array_map import GsheetArrayMap, get_sheet_url
 from metadata_processor import MetadataProcessor
 
 class AddShortDesc(MetadataProcessor):
-    def __init__(self, bucket_name):
-        super().__init__(bucket_name)
+    def __init__(self, bucket_name, dry_run=False):
+        super().__init__(bucket_name, dry_run=dry_run)
         # Path to your service account credentials JSON file
         creds_file = './sbx-kendra-8e724bd9a0ce.json'
 
@@ -55,10 +56,14 @@ class AddShortDesc(MetadataProcessor):
         return metadata
 
 def main():
+    parser = argparse.ArgumentParser(description='Add short descriptions to metadata files')
+    parser.add_argument('--dry-run', action='store_true', help='Report what would change without writing')
+    args = parser.parse_args()
+
     bucket_name = config.bucket_name
 
     # Use the custom processor
-    processor = AddShortDesc(bucket_name)
+    processor = AddShortDesc(bucket_name, dry_run=args.dry_run)
 
     errors = processor.process_all_metadata_files()
 
@@ -1,5 +1,9 @@
 import gspread
+import json
 import logging
+import os
+import re
+from gspread.utils import numericise, rowcol_to_a1
 from google.oauth2.service_account import Credentials
 
 def get_sheet_url(sheet_id):
@@ -11,20 +15,27 @@ class GsheetArrayMap:
     
     Attributes:
         client (gspread.Client): The authenticated gspread client.
+        cache_dir (str): Directory holding local snapshots of previously read columns.
     """
-    def __init__(self, creds_file):
+    def __init__(self, creds_file, cache_dir='.sheet_cache'):
         """
         Initialize the GspreadArrayMap with the provided credentials file.
         
         Args:
             creds_file (str): The path to the Google service account credentials JSON file.
+            cache_dir (str, optional): Directory for local sheet snapshots.
         
         Raises:
             Exception: If there is an error in authentication.
         """
+        self.logger = logging.getLogger(__name__)
+        self.cache_dir = cache_dir
         try:
-            # Define the scope for reading spreadsheets
-            scopes = ['https://www.googleapis.com/auth/spreadsheets.readonly']
+            # Define the scope for reading spreadsheets, and the Drive modifiedTime used for caching
+            scopes = [
+                'https://www.googleapis.com/auth/spreadsheets.readonly',
+                'https://www.googleapis.com/auth/drive.metadata.readonly'
+            ]
             creds = Credentials.from_service_account_file(creds_file, scopes=scopes)
             self.client = gspread.authorize(creds)
         except Exception as e:
@@ -33,6 +44,10 @@ class GsheetArrayMap:
     def get_fields(self, sheet_url, wanted_fields, worksheet_name=None):
         """
         Retrieve filtered data from a Google Sheet.
+
+        Only the wanted columns are fetched, with a single batch_get of column ranges.
+        The result is snapshotted in cache_dir and reused until the sheet's Drive
+        modifiedTime changes.
         
         Args:
             sheet_url (str): The URL of the Google Sheet.
@@ -49,39 +64,107 @@ class GsheetArrayMap:
         """
 
         try:
-            # Set up basic configuration
-            logger = logging.getLogger(__name__)
-
             # Open the Google Sheet
             sheet = self.client.open_by_url(sheet_url)
             # Access the specified worksheet or the first one
-            if worksheet_name:
-                worksheet = sheet.worksheet(worksheet_name)
-            else:
-                worksheet = sheet.sheet1
-            # Retrieve all records
-            records = worksheet.get_all_records()
+            if not worksheet_name:
+                worksheet_name = sheet.sheet1.title
+            modified_time = sheet.get_lastUpdateTime()
         except Exception as e:
             raise Exception(f"Failed to access the sheet: {e}")
 
-        # Get the headers from the first row
-        sheet_fields = worksheet.row_values(1)
-        if not set(wanted_fields).issubset(set(sheet_fields)):
-            raise ValueError("wanted_fields do not match any columns in the sheet.")
+        cache_path = self._cache_path(sheet.id, worksheet_name)
+        snapshot = self._load_snapshot(cache_path)
+        if (snapshot.get('modified_time') == modified_time
+                and set(wanted_fields).issubset(snapshot.get('fields', []))):
+            self.logger.info(f"Using cached snapshot of '{worksheet_name}' ({modified_time})")
+            return [{field: record[field] for field in wanted_fields} for record in snapshot['records']]
 
-        result = []
-        for index, record in enumerate(records):
-            try:
-                # Filter the record to include only wanted_fields
-                filtered_record = {field: record[field] for field in wanted_fields}
-                result.append(filtered_record)
+        try:
+            header, columns = self._get_columns(sheet, worksheet_name, wanted_fields, snapshot.get('header'))
+        except ValueError:
+            raise
+        except Exception as e:
+            raise Exception(f"Failed to access the sheet: {e}")
 
-            except Exception as row_error:
-                logger.error(f"Error processing row {index + 2}: {row_error}")
-                continue  # Continue processing the next row despite the error
+        # Columns come back with trailing blanks trimmed; pad so rows stay aligned
+        row_count = max(len(values) for values in columns.values())
+        result = [
+            {field: numericise(values[row]) if row < len(values) else '' for field, values in columns.items()}
+            for row in range(row_count)
+        ]
 
+        self._save_snapshot(cache_path, {
+            'modified_time': modified_time,
+            'header': header,
+            'fields': list(wanted_fields),
+            'records': result
+        })
         return result
 
+    def _get_columns(self, sheet, worksheet_name, wanted_fields, header=None):
+        """
+        Fetch the wanted columns (below the header row) with one batch_get.
+
+        The header row is only read when there is no usable cached header, or when the
+        cached one is stale because columns were moved.
+        """
+        from_cache = header is not None and set(wanted_fields).issubset(set(header))
+        if not from_cache:
+            header = self._read_header(sheet, worksheet_name, wanted_fields)
+        columns = self._batch_get_columns(sheet, worksheet_name, wanted_fields, header)
+        if columns is None and from_cache:
+            header = self._read_header(sheet, worksheet_name, wanted_fields)
+            columns = self._batch_get_columns(sheet, worksheet_name, wanted_fields, header)
+        if columns is None:
+            raise ValueError("wanted_fields do not match any columns in the sheet.")
+        return header, columns
+
+    def _read_header(self, sheet, worksheet_name, wanted_fields):
+        header = sheet.values_get(f"'{worksheet_name}'!1:1").get('values', [[]])[0]
+        if not set(wanted_fields).issubset(set(header)):
+            raise ValueError("wanted_fields do not match any columns in the sheet.")
+        return header
+
+    def _batch_get_columns(self, sheet, worksheet_name, wanted_fields, header):
+        """
+        Returns {field: values below the header}, or None if a column's header cell doesn't match.
+        """
+        ranges = []
+        for field in wanted_fields:
+            letter = re.sub(r'\d+$', '', rowcol_to_a1(1, header.index(field) + 1))
+            ranges.append(f"'{worksheet_name}'!{letter}:{letter}")
+        response = sheet.values_batch_get(ranges, params={'majorDimension': 'COLUMNS'})
+
+        columns = {}
+        for field, value_range in zip(wanted_fields, response.get('valueRanges', [])):
+            values = (value_range.get('values') or [[]])[0]
+            if not values or values[0] != field:
+                return None
+            columns[field] = values[1:]
+        return columns
+
+    def _cache_path(self, sheet_id, worksheet_name):
+        safe_name = re.sub(r'[^A-Za-z0-9_.-]', '_', worksheet_name)
+        return os.path.join(self.cache_dir, f"{sheet_id}_{safe_name}.json")
+
+    def _load_snapshot(self, cache_path):
+        try:
+            with open(cache_path, 'r') as cache_file:
+                return json.load(cache_file)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_snapshot(self, cache_path, snapshot):
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = f"{cache_path}.tmp"
+            with open(tmp_path, 'w') as cache_file:
+                json.dump(snapshot, cache_file)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            self.logger.warning(f"Could not write sheet snapshot {cache_path}: {e}")
+
 def main():
     """
     Example usage of the GspreadArrayMap class.
@@ -1,47 +1,155 @@
+import copy
 import json
 import logging
+import threading
+import time
 import traceback
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from s3_lister import S3PrefixLister
 
 class MetadataProcessor:
-    def __init__(self, bucket_name):
+    def __init__(self, bucket_name, max_workers=32, progress_every=500, dry_run=False):
         self.logger = logging.getLogger(__name__)
-        self.s3_client = boto3.client('s3')
-        paginator = self.s3_client.get_paginator('list_objects_v2')
-        self.page_iterator = paginator.paginate(Bucket=bucket_name)
+        self.dry_run = dry_run
+        self.max_workers = max_workers
+        self.progress_every = progress_every
+        # Built on first use, so processors run by a MetadataProcessorChain never build
+        # their own and use the chain's instead
+        self._s3_client = None
+        self._lister = None
+        self.client_lock = threading.RLock()
         self.bucket_name = bucket_name
-        
+
+    @property
+    def s3_client(self):
+        # One client shared by all workers, with a connection per worker
+        with self.client_lock:
+            if self._s3_client is None:
+                self._s3_client = boto3.client('s3', config=Config(max_pool_connections=self.max_workers))
+            return self._s3_client
+
+    @s3_client.setter
+    def s3_client(self, s3_client):
+        self._s3_client = s3_client
+
+    @property
+    def lister(self):
+        with self.client_lock:
+            if self._lister is None:
+                self._lister = S3PrefixLister(self.s3_client, max_workers=self.max_workers, logger=self.logger)
+            return self._lister
+
+    @lister.setter
+    def lister(self, lister):
+        self._lister = lister
+
     def process_all_metadata_files(self):
         """
         Processes all metadata files in the S3 bucket.
+
+        Keys are streamed from a parallel prefix listing into a bounded thread pool, so
+        listing, GETs and PUTs overlap. Errors are returned sorted by key regardless of completion order.
+        In dry-run mode nothing is written and a summary of changed fields is printed.
         """
         total_files = 0
         altered_files = 0
         errors = []
-        for page in self.page_iterator:
-            if 'Contents' in page:
-                for obj in page['Contents']:
-                    key = obj['Key']
-                    if self.is_metadata_file(key):
-                        total_files += 1
-                        try:
-                            metadata = self.get_metadata_from_s3(key)
-                            modified_metadata = self.process(metadata)
-                            if modified_metadata:
-                                self.write_metadata_to_s3(key, modified_metadata)
-                                altered_files += 1
-                            else:
-                                self.logger.info(f"Metadata unchanged for {key}")
-                        except Exception as e:
-                            error_message = f"Error processing {key}: {str(e)}"
-                            self.logger.error("Stack trace:\n%s", traceback.format_exc())
-                            errors.append(error_message)
-        return errors
-        
+        field_counts = Counter()
+        pending = set()
+        start_time = time.time()
+
+        def collect(done):
+            nonlocal total_files, altered_files
+            for future in done:
+                key, altered, error_message, fields = future.result()
+                total_files += 1
+                if altered:
+                    altered_files += 1
+                    field_counts.update(fields)
+                if error_message:
+                    errors.append((key, error_message))
+                if total_files % self.progress_every == 0:
+                    self.print_progress(total_files, altered_files, len(errors), start_time)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for key in self.iter_metadata_keys():
+                pending.add(executor.submit(self.process_metadata_file, key))
+                # Keep the queue bounded so listing doesn't run far ahead of the workers
+                if len(pending) >= self.max_workers * 4:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+            done, _ = wait(pending)
+            collect(done)
+
+        self.print_progress(total_files, altered_files, len(errors), start_time)
+        if self.dry_run:
+            self.print_diff_summary(altered_files, field_counts)
+        return [error_message for _, error_message in sorted(errors)]
+
+    def process_metadata_file(self, key):
+        """
+        Reads, processes and writes back a single metadata file.
+
+        Writes are skipped when the processed metadata is canonically identical to what
+        was read, and are conditional on the ETag that was read so a concurrent writer
+        is never clobbered. Returns (key, altered, error_message, changed_fields).
+        """
+        try:
+            metadata, etag = self.get_metadata_and_etag(key)
+            original = copy.deepcopy(metadata)
+            modified_metadata = self.process_with_key(key, etag, metadata)
+            if not modified_metadata or canonicalize(modified_metadata) == canonicalize(original):
+                self.logger.info(f"Metadata unchanged for {key}")
+                return key, False, None, []
+            fields = changed_fields(original, modified_metadata)
+            if not self.dry_run:
+                self.write_metadata_to_s3(key, modified_metadata, etag=etag)
+            return key, True, None, fields
+        except ClientError as e:
+            # S3 answers 412 when the ETag no longer matches, and 409 when another
+            # conditional write to the key is in flight; either way we lost the race
+            if e.response.get('Error', {}).get('Code') in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                return key, False, f"Error processing {key}: modified by another writer, not overwritten", []
+            self.logger.error("Stack trace:\n%s", traceback.format_exc())
+            return key, False, f"Error processing {key}: {str(e)}", []
+        except Exception as e:
+            error_message = f"Error processing {key}: {str(e)}"
+            self.logger.error("Stack trace:\n%s", traceback.format_exc())
+            return key, False, error_message, []
+
+    def print_progress(self, total_files, altered_files, error_count, start_time):
+        elapsed = time.time() - start_time
+        rate = total_files / elapsed if elapsed > 0 else 0.0
+        print(f"{total_files} files processed, {altered_files} altered, {error_count} errors "
+              f"({rate:.1f} files/s, {elapsed:.0f}s elapsed)")
+
+    def print_diff_summary(self, altered_files, field_counts):
+        print(f"Dry run: {altered_files} files would be written")
+        for field, count in field_counts.most_common():
+            print(f"  {field}: {count}")
+
+    def iter_metadata_keys(self):
+        """
+        Yields the keys of the metadata files to process. Defaults to a listing of the bucket.
+        """
+        return self.lister.iter_keys(self.bucket_name, key_filter=self.is_metadata_file)
+
+    def process_with_key(self, key, etag, metadata):
+        """
+        Override this instead of process() when the transformation depends on the object
+        key or the ETag that was read.
+        """
+        return self.process(metadata)
+
     def process(self, metadata):
         """
         Override this method to perform custom transformations on the metadata.
+        Called concurrently from worker threads, so it must not mutate shared state.
         """
         # By default, do nothing
         return None
@@ -58,15 +166,103 @@ class MetadataProcessor:
         """
         Retrieves and loads the metadata JSON from S3.
         """
+        metadata, _ = self.get_metadata_and_etag(key)
+        return metadata
+
+    def get_metadata_and_etag(self, key):
+        """
+        Retrieves and loads the metadata JSON from S3 along with its ETag.
+        """
         response = self.s3_client.get_object(Bucket=self.bucket_name, Key=key)
         content = response['Body'].read().decode('utf-8')
-        metadata = json.loads(content)
-        return metadata
+        return json.loads(content), response['ETag']
 
-    def write_metadata_to_s3(self, key, metadata):
+    def write_metadata_to_s3(self, key, metadata, etag=None):
         """
         Writes the modified metadata back to S3.
+        If etag is given, the write only succeeds if the object still has that ETag.
         """
         content = json.dumps(metadata, indent=2)
-        self.s3_client.put_object(Bucket=self.bucket_name, Key=key, Body=content)
-        
\ No newline at end of file
+        if etag:
+            self.s3_client.put_object(Bucket=self.bucket_name, Key=key, Body=content, IfMatch=etag)
+        else:
+            self.s3_client.put_object(Bucket=self.bucket_name, Key=key, Body=content)
+
+
+class MetadataProcessorChain(MetadataProcessor):
+    """
+    Runs an ordered list of processors over each metadata file in a single bucket pass.
+
+    Each processor gets the output of the previous one, and the file is written at most
+    once. Per-processor time and change counts are printed at the end of the run.
+
+        chain = MetadataProcessorChain(bucket_name, [AddShortDesc(bucket_name), OtherFix(bucket_name)])
+        errors = chain.process_all_metadata_files()
+    """
+    def __init__(self, bucket_name, processors, **kwargs):
+        super().__init__(bucket_name, **kwargs)
+        self.processors = processors
+        # The processors share this chain's client and lister instead of building their own
+        for processor in processors:
+            processor.s3_client = self.s3_client
+            processor.lister = self.lister
+        self.timings = Counter()
+        self.change_counts = Counter()
+        self.stats_lock = threading.Lock()
+
+    def process_all_metadata_files(self):
+        errors = super().process_all_metadata_files()
+        self.print_chain_report()
+        return errors
+
+    def process_with_key(self, key, etag, metadata):
+        current = metadata
+        changed = False
+        for processor in self.processors:
+            name = type(processor).__name__
+            before = canonicalize(current)
+            start_time = time.perf_counter()
+            # Each processor gets its own copy so a failed step can't leave partial edits behind
+            result = processor.process_with_key(key, etag, copy.deepcopy(current))
+            elapsed = time.perf_counter() - start_time
+            step_changed = bool(result) and canonicalize(result) != before
+            with self.stats_lock:
+                self.timings[name] += elapsed
+                if step_changed:
+                    self.change_counts[name] += 1
+            if step_changed:
+                current = result
+                changed = True
+        return current if changed else None
+
+    def print_chain_report(self):
+        print("Processor chain:")
+        for processor in self.processors:
+            name = type(processor).__name__
+            print(f"  {name}: {self.change_counts[name]} changed, {self.timings[name]:.2f}s")
+
+
+def canonicalize(metadata):
+    """
+    Serializes metadata in a canonical form so formatting and key order don't count as changes.
+    """
+    return json.dumps(metadata, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+
+
+def changed_fields(original, modified):
+    """
+    Lists the Attributes (and other top-level fields) that differ between two metadata dicts.
+    """
+    fields = []
+    for name in sorted(set(original) | set(modified)):
+        if name == 'Attributes':
+            before = original.get('Attributes') or {}
+            after = modified.get('Attributes') or {}
+            fields.extend(
+                f"Attributes.{attr}" for attr in sorted(set(before) | set(after))
+                if before.get(attr) != after.get(attr)
+            )
+        elif original.get(name) != modified.get(name):
+            fields.append(name)
+    return fields
+
@@ -0,0 +1,214 @@
+import argparse
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+from metadata_processor import MetadataProcessor
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# Columns that are not metadata Attributes
+KEY_COLUMN = 'key'
+ETAG_COLUMN = 'etag'
+# Attribute columns are namespaced so an attribute named 'key' or 'etag' can't clash
+ATTRIBUTE_PREFIX = 'attr.'
+
+
+class MetadataSnapshot:
+    """
+    Writes every metadata sidecar in a bucket to a single JSONL or Parquet file.
+
+    Each row holds the object key, its ETag and the sidecar's Attributes flattened into
+    'attr.<name>' columns. When an earlier snapshot exists at the same path, only sidecars
+    whose ETag changed are fetched again; the listing alone tells us which ones those are.
+    """
+    def __init__(self, bucket_name, max_workers=32):
+        self.logger = logging.getLogger(__name__)
+        self.bucket_name = bucket_name
+        self.max_workers = max_workers
+        # Reuse the processor's pooled client, lister and sidecar naming convention
+        self.reader = MetadataProcessor(bucket_name, max_workers=max_workers)
+
+    def export(self, path):
+        """
+        Creates or refreshes the snapshot at path. Sidecars that can't be read are left out
+        and reported; returns their error messages, sorted by key.
+        """
+        previous = {}
+        if os.path.exists(path):
+            previous = {row[KEY_COLUMN]: row for row in load_snapshot(path)}
+        self.logger.info(f"Loaded {len(previous)} rows from previous snapshot {path}")
+
+        rows = []
+        stale = []
+        for obj in self.reader.lister.iter_objects(self.bucket_name, key_filter=self.reader.is_metadata_file):
+            row = previous.get(obj['Key'])
+            # Rows from before attribute columns were namespaced are fetched again
+            if row and row[ETAG_COLUMN] == obj['ETag'] and is_namespaced(row):
+                rows.append(row)
+            else:
+                stale.append(obj['Key'])
+
+        start_time = time.time()
+        errors = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for key, row, error_message in executor.map(self.fetch_row, stale):
+                if error_message:
+                    errors.append((key, error_message))
+                else:
+                    rows.append(row)
+        print(f"{len(rows)} sidecars, {len(stale)} fetched, {len(errors)} errors ({time.time() - start_time:.0f}s)")
+
+        rows.sort(key=lambda row: row[KEY_COLUMN])
+        write_snapshot(path, rows)
+        return [error_message for _, error_message in sorted(errors)]
+
+    def fetch_row(self, key):
+        """Returns (key, row, error_message); one unreadable sidecar doesn't stop the export."""
+        try:
+            metadata, etag = self.reader.get_metadata_and_etag(key)
+            return key, snapshot_row(key, etag, metadata), None
+        except Exception as e:
+            self.logger.error(f"Error reading {key}: {e}")
+            return key, None, f"Error reading {key}: {str(e)}"
+
+
+class SnapshotImporter(MetadataProcessor):
+    """
+    Applies an edited snapshot back to the bucket.
+
+    Only the keys in the snapshot are visited, and only sidecars whose Attributes differ
+    from the snapshot are written. A sidecar that changed since the snapshot was taken is
+    reported as a conflict and left alone.
+    """
+    def __init__(self, bucket_name, path, **kwargs):
+        super().__init__(bucket_name, **kwargs)
+        self.path = path
+        self.rows = {row[KEY_COLUMN]: row for row in load_snapshot(path)}
+        # Reading an old snapshot's columns as attributes would wipe every sidecar's Attributes
+        if not all(is_namespaced(row) for row in self.rows.values()):
+            raise ValueError(f"{path} has attribute columns without the '{ATTRIBUTE_PREFIX}' prefix; export it again")
+
+    def iter_metadata_keys(self):
+        return iter(sorted(self.rows))
+
+    def process_with_key(self, key, etag, metadata):
+        row = self.rows[key]
+        if row[ETAG_COLUMN] != etag:
+            raise Exception(f"changed since the snapshot was taken (ETag {etag}, snapshot has {row[ETAG_COLUMN]})")
+        metadata['Attributes'] = row_attributes(row, metadata.get('Attributes') or {})
+        return metadata
+
+
+def snapshot_row(key, etag, metadata):
+    row = {KEY_COLUMN: key, ETAG_COLUMN: etag}
+    for name, value in (metadata.get('Attributes') or {}).items():
+        row[ATTRIBUTE_PREFIX + name] = value
+    return row
+
+
+def is_namespaced(row):
+    return all(
+        name in (KEY_COLUMN, ETAG_COLUMN) or name.startswith(ATTRIBUTE_PREFIX) for name in row
+    )
+
+
+def row_attributes(row, current=None):
+    """
+    Rebuilds the Attributes dict from a snapshot row.
+
+    Parquet snapshots store every attribute as a string, so values that are not strings
+    in the current sidecar are decoded from JSON. Null columns mean the attribute is absent.
+    """
+    current = current or {}
+    attributes = {}
+    for column, value in row.items():
+        if not column.startswith(ATTRIBUTE_PREFIX) or value is None:
+            continue
+        name = column[len(ATTRIBUTE_PREFIX):]
+        if isinstance(value, str) and name in current and not isinstance(current[name], str):
+            try:
+                value = json.loads(value)
+            except ValueError:
+                pass
+        attributes[name] = value
+    return attributes
+
+
+def load_snapshot(path):
+    """
+    Loads a snapshot written by MetadataSnapshot as a list of row dicts.
+    Read-only consumers can use this instead of fetching every sidecar from S3.
+    """
+    if path.endswith('.parquet'):
+        require_pyarrow()
+        return [
+            {name: value for name, value in row.items() if value is not None}
+            for row in pq.read_table(path).to_pylist()
+        ]
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def write_snapshot(path, rows):
+    """
+    Writes rows to path, as Parquet if it ends in .parquet and JSONL otherwise.
+    The file is replaced atomically so a failed export never leaves a partial snapshot.
+    """
+    tmp_path = f"{path}.tmp"
+    if path.endswith('.parquet'):
+        require_pyarrow()
+        columns = [KEY_COLUMN, ETAG_COLUMN] + sorted(
+            {name for row in rows for name in row} - {KEY_COLUMN, ETAG_COLUMN}
+        )
+        data = {name: [parquet_value(row.get(name)) for row in rows] for name in columns}
+        table = pa.table(data, schema=pa.schema([(name, pa.string()) for name in columns]))
+        pq.write_table(table, tmp_path)
+    else:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False) + '\n')
+    os.replace(tmp_path, path)
+
+
+def parquet_value(value):
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value, ensure_ascii=False)
+
+
+def require_pyarrow():
+    if pq is None:
+        raise RuntimeError("pyarrow is required for .parquet snapshots; use a .jsonl path or pip install pyarrow")
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+    parser = argparse.ArgumentParser(description='Export metadata sidecars to a snapshot file, or apply an edited one')
+    parser.add_argument('command', choices=['export', 'import'])
+    parser.add_argument('path', help='Snapshot file (.jsonl or .parquet)')
+    parser.add_argument('--bucket', default=config.bucket_name, help='S3 bucket holding the sidecars')
+    parser.add_argument('--workers', type=int, default=32, help='Concurrent S3 requests')
+    parser.add_argument('--dry-run', action='store_true', help='For import, report what would change without writing')
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        errors = MetadataSnapshot(args.bucket, max_workers=args.workers).export(args.path)
+    else:
+        importer = SnapshotImporter(args.bucket, args.path, max_workers=args.workers, dry_run=args.dry_run)
+        errors = importer.process_all_metadata_files()
+    if errors:
+        print("\nErrors encountered:")
+        for error in errors:
+            print(error)
+
+if __name__ == "__main__":
+    main()
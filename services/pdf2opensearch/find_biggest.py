@@ -1,18 +1,18 @@
 import boto3
+from botocore.config import Config
+from s3_lister import S3PrefixLister
 
 def find_largest_object(bucket_name):
-    s3_client = boto3.client('s3')
+    s3_client = boto3.client('s3', config=Config(max_pool_connections=16))
+    lister = S3PrefixLister(s3_client, max_workers=16)
 
-    paginator = s3_client.get_paginator('list_objects_v2')
     largest_object = None
     largest_size = 0
 
-    for page in paginator.paginate(Bucket=bucket_name):
-        if 'Contents' in page:
-            for obj in page['Contents']:
-                if obj['Size'] > largest_size:
-                    largest_size = obj['Size']
-                    largest_object = obj
+    for obj in lister.iter_objects(bucket_name):
+        if obj['Size'] > largest_size:
+            largest_size = obj['Size']
+            largest_object = obj
 
     if largest_object:
         print(f"Largest object: {largest_object['Key']}")
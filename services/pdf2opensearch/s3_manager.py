@@ -2,22 +2,27 @@ import logging
 import boto3
 import json
 from typing import List, Optional
+from botocore.config import Config
 from botocore.exceptions import BotoCoreError, ClientError
+from s3_lister import S3PrefixLister
 
 class S3Manager:
     """
     Manages S3 operations including listing objects in a folder and uploading documents.
     """
 
-    def __init__(self, region_name: Optional[str] = None, logger: Optional[logging.Logger] = None) -> None:
+    def __init__(self, region_name: Optional[str] = None, logger: Optional[logging.Logger] = None,
+                 max_workers: int = 16) -> None:
         """
         Initialize the S3Manager.
 
         :param region_name: AWS region for S3 operations. If None, uses the default region.
         :param logger: Optional logger instance. If None, a default logger is used.
+        :param max_workers: Number of prefixes listed concurrently.
         """
-        self.s3 = boto3.client('s3', region_name=region_name)
+        self.s3 = boto3.client('s3', region_name=region_name, config=Config(max_pool_connections=max_workers))
         self.logger = logger or self._get_logger()
+        self.lister = S3PrefixLister(self.s3, max_workers=max_workers, logger=self.logger)
 
     def _get_logger(self) -> logging.Logger:
         logger = logging.getLogger(self.__class__.__name__)
@@ -39,15 +44,8 @@ class S3Manager:
         :return: A list of object keys under the specified folder.
         """
         exclude_extensions = exclude_extensions or []
-        paginator = self.s3.get_paginator('list_objects_v2')
-        response_iterator = paginator.paginate(Bucket=bucket_name, Prefix=folder)
-
-        object_keys = []
-        for page in response_iterator:
-            for obj in page.get('Contents', []):
-                key = obj['Key']
-                if not any(key.endswith(ext) for ext in exclude_extensions):
-                    object_keys.append(key)
+        # Prefixes are listed in parallel; sort to keep the lexicographic order of a serial listing
+        object_keys = sorted(self.lister.iter_keys(bucket_name, folder, exclude_suffixes=exclude_extensions))
 
         self.logger.info(f"Found {len(object_keys)} objects under folder: {folder}, excluding extensions: {exclude_extensions}")
         return object_keys
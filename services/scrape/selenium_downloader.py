@@ -1,6 +1,5 @@
 import os
 import platform
-import time
 import logging
 from selenium import webdriver
 from selenium.webdriver.chrome.service import Service
@@ -9,6 +8,7 @@ from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.common.exceptions import TimeoutException, NoSuchElementException
+from download_events import enable_download_events, set_download_dir, wait_for_download
 
 class SeleniumDownloader():
     def __init__(self, download_dir):
@@ -34,6 +34,7 @@ class SeleniumDownloader():
             "safebrowsing.enabled": True
         }
         chrome_options.add_experimental_option("prefs", prefs)
+        enable_download_events(chrome_options)
 
         # Determine the correct path to chromedriver
         if platform.system() == 'Windows':
@@ -47,11 +48,8 @@ class SeleniumDownloader():
         # Initialize the Chrome driver with the Service object
         self.driver = webdriver.Chrome(service=service, options=chrome_options)
 
-        # Set download behavior using DevTools protocol
-        self.driver.execute_cdp_cmd(
-            "Page.setDownloadBehavior",
-            {"behavior": "allow", "downloadPath": self.download_dir}
-        )
+        # Set download behavior using DevTools protocol, with download events on
+        set_download_dir(self.driver, self.download_dir)
 
     def __enter__(self):
         return self
@@ -60,6 +58,7 @@ class SeleniumDownloader():
         self.driver.quit()
         
     def download_onbase_pdf(self, url):
+        """Downloads an OnBase document into download_dir and returns its path, or None."""
         try:
             # Navigate to the URL
             self.driver.get(url)
@@ -77,10 +76,11 @@ class SeleniumDownloader():
             # Find and click the download link
             mainContentElement = self.driver.find_element(By.ID, "main-content")
             target_anchor = mainContentElement.find_element(By.TAG_NAME, "a")
+            existing = os.listdir(self.download_dir)
             target_anchor.click()
 
             # Wait for the download to complete
-            time.sleep(10)  # Adjust this time based on your network speed and file size
+            return self.wait_for_download(url, existing)
         except TimeoutException as e:
             self.logger.error(f"Timeout while downloading from {url}: {e}")
         except NoSuchElementException as e:
@@ -89,6 +89,7 @@ class SeleniumDownloader():
             self.logger.error(f"Error downloading from {url}: {e}")
             
     def download_google_url(self, url):
+        """Downloads a Google Drive sharing link into download_dir and returns its path, or None."""
         try:
             # Navigate to the Google Drive sharing link
             self.driver.get(url)
@@ -97,14 +98,21 @@ class SeleniumDownloader():
             download_button = WebDriverWait(self.driver, 15).until(
                 EC.element_to_be_clickable((By.XPATH, "//div[@data-tooltip='Download']"))
             )
+            existing = os.listdir(self.download_dir)
             download_button.click()
 
-            # Wait for the file to be downloaded (adjust the time as needed)
-            time.sleep(10)
+            # Wait for the file to be downloaded
+            return self.wait_for_download(url, existing)
         except TimeoutException as e:
             self.logger.error(f"Timeout while downloading from {url}: {e}")
         except Exception as e:
             self.logger.error(f"Error downloading from {url}: {e}")
 
-
-
+    def wait_for_download(self, url, existing, timeout=60):
+        # Returns as soon as Chrome reports the download finished, instead of a fixed sleep
+        path = wait_for_download(self.driver, self.download_dir, timeout=timeout, ignore=existing)
+        if path:
+            self.logger.info(f"Downloaded {url} to {path}")
+        else:
+            self.logger.error(f"Download from {url} did not finish within {timeout}s")
+        return path